@@ -1,8 +1,18 @@
-from flask import Flask, render_template, request, redirect, url_for, flash
+from flask import (Flask, Response, render_template, request, redirect, url_for,
+                   flash, jsonify)
 import firebase_admin
 from firebase_admin import credentials, firestore
-from send_message import send_whatsapp_message
-from datetime import datetime
+# send_message, aggregates, visit_analytics and visit_log are shared with
+# recognition and come from face_recognition_module on PYTHONPATH.
+from send_message import send_whatsapp_message, message_key, outbox
+from bulk_jobs import BulkSendJobs
+from aggregates import AggregateCounters, Reconciler
+from customer_api import (API_FIELDS, CollectionVersion, customer_record,
+                          ndjson_lines, encoded_stream, query_etag)
+import visit_analytics
+from visit_log import UTC_OFFSET_HOURS, local_day
+from datetime import datetime, timedelta, timezone
+import hashlib
 import os
 
 app = Flask(__name__)
@@ -18,86 +28,300 @@ if not firebase_admin._apps:
     firebase_admin.initialize_app(cred)
 
 db = firestore.client()
+jobs = BulkSendJobs(send_whatsapp_message, outbox)
+aggregates = AggregateCounters(db)
+Reconciler(aggregates).start()
+
+READ_MODEL = os.environ.get("DASHBOARD_READ_MODEL", "firestore")
+PAGE_SIZE = int(os.environ.get("DASHBOARD_PAGE_SIZE", "50"))
+MAX_PAGE_SIZE = 200
+API_PAGE_SIZE = 500
+API_MAX_PAGE_SIZE = 5000
+ANALYTICS_DAYS = 30
+ANALYTICS_MAX_DAYS = 366
+# Hours and days on the analytics page, and "today" in the header, are in
+# the store's time zone, as the visit counters are.
+ANALYTICS_UTC_OFFSET = UTC_OFFSET_HOURS
+# Fixed choices instead of scanning every customer for distinct values.
+GENDERS = ["Male", "Female"]
+EMOTIONS = ["angry", "disgust", "fear", "happy", "sad", "surprise", "neutral"]
+
+customer_view = None
+if READ_MODEL == "memory":
+    # Optional in-process copy of the customers collection, kept current by
+    # a snapshot listener; pages are served from it once it has loaded.
+    from customer_view import CustomerView
+    customer_view = CustomerView()
+    customer_view.start(db)
+
+
+def view_ready():
+    return customer_view is not None and customer_view.ready
+
+
+# The API's ETag version: the in-memory view's change count when it serves
+# the data, otherwise two tiny listeners on the newest customer documents.
+collection_version = None
+if customer_view is None:
+    collection_version = CollectionVersion(db)
+    collection_version.start()
+
+
+def data_version():
+    if view_ready():
+        return customer_view.version, customer_view.last_modified
+    if collection_version is not None:
+        return collection_version.version, collection_version.last_modified
+    return None, None
+
+
+def customer_age(data):
+    dob = data.get("date_of_birth")
+    if not dob:
+        return None
+    try:
+        dob_date = datetime.strptime(dob, "%Y-%m-%d")
+        return (datetime.now().date() - dob_date.date()).days // 365
+    except Exception:
+        return None
+
+
+def read_filters(args):
+    return {
+        "gender": args.get("gender"),
+        "emotion": args.get("emotion"),
+        "visit_date": args.get("visit_date"),
+        "age_min": args.get("age_min", type=int),
+        "age_max": args.get("age_max", type=int),
+    }
 
 
-@app.route("/")
-def dashboard():
-    if request.args.get("action") == "reset":
-        return redirect(url_for("dashboard"))
-
-    gender_filter = request.args.get("gender")
-    emotion_filter = request.args.get("emotion")
-    visit_date_filter = request.args.get("visit_date")
-
-    customers_ref = db.collection("customers")
-    docs = customers_ref.stream()
+def customers_query(filters):
+    # Every filter becomes a Firestore constraint so only matching documents
+    # are read. The composite indexes these combinations need are listed in
+    # firestore.indexes.json.
+    query = db.collection("customers")
+    if filters["gender"]:
+        query = query.where("gender", "==", filters["gender"])
+    if filters["emotion"]:
+        query = query.where("last_emotion", "==", filters["emotion"])
+
+    order = []
+    today = datetime.now().date()
+    # Same rule as customer_age: age is whole 365-day periods since birth.
+    if filters["age_min"]:
+        latest_dob = today - timedelta(days=365 * filters["age_min"])
+        query = query.where("date_of_birth", "<=", latest_dob.isoformat())
+    if filters["age_max"]:
+        earliest_dob = today - timedelta(days=365 * (filters["age_max"] + 1))
+        query = query.where("date_of_birth", ">", earliest_dob.isoformat())
+    if filters["age_min"] or filters["age_max"]:
+        order.append("date_of_birth")
+
+    # A range on last_visit cannot match documents without the field, so
+    # customers who have never visited are left out; the in-memory view
+    # does the same. The form says so next to the date.
+    if filters["visit_date"]:
+        try:
+            day = datetime.strptime(filters["visit_date"], "%Y-%m-%d")
+        except ValueError:
+            day = None
+        if day is not None:
+            day = day.replace(tzinfo=timezone.utc)
+            query = query.where("last_visit", ">=", day).where(
+                "last_visit", "<", day + timedelta(days=1))
+            order.append("last_visit")
+
+    for field in order:
+        query = query.order_by(field)
+    # The document id makes the order total, so page cursors are stable.
+    return query.order_by(firestore.FieldPath.document_id())
+
+
+def count_query(query):
+    return query.count(alias="total").get()[0][0].value
+
+
+def customers_page(query, page_size, after=None, before=None):
+    collection = db.collection("customers")
+    if before:
+        anchor = collection.document(before).get()
+        if anchor.exists:
+            docs = query.end_before(anchor).limit_to_last(page_size + 1).get()
+            prev_cursor = docs[1].id if len(docs) > page_size else None
+            docs = docs[-page_size:]
+            next_cursor = docs[-1].id if docs else None
+            return docs, prev_cursor, next_cursor
+
+    page_query = query
+    if after:
+        anchor = collection.document(after).get()
+        if anchor.exists:
+            page_query = page_query.start_after(anchor)
+    docs = page_query.limit(page_size + 1).get()
+    next_cursor = docs[page_size - 1].id if len(docs) > page_size else None
+    docs = docs[:page_size]
+    prev_cursor = docs[0].id if after and docs else None
+    return docs, prev_cursor, next_cursor
+
+
+def page_url(**cursor):
+    args = request.args.to_dict()
+    args.pop("after", None)
+    args.pop("before", None)
+    args.update(cursor)
+    return url_for("dashboard", **args)
+
+
+def read_aggregates():
+    try:
+        return aggregates.read()
+    except Exception as e:
+        print(f"Failed to read aggregates: {e}")
+        return None
+
+
+def has_filters(filters):
+    return any(value is not None and value != "" for value in filters.values())
+
+
+def firestore_listing(filters, page_size, after=None, before=None,
+                      totals=None):
+    query = customers_query(filters)
+    docs, prev_cursor, next_cursor = customers_page(
+        query, page_size, after=after, before=before)
 
     customers = []
-    total_customers = 0
-    male_count = 0
-    female_count = 0
-
-    unique_gender = set()
-    unique_emotions = set()
-
-    age_min = request.args.get("age_min", type=int)
-    age_max = request.args.get("age_max", type=int)
-
     for doc in docs:
         data = doc.to_dict()
-
-        dob = data.get("date_of_birth")
-
-        if dob:
-            try:
-                dob_date = datetime.strptime(dob, "%Y-%m-%d")
-                age = (datetime.now().date() - dob_date.date()).days // 365
-                data["age"] = age
-            except Exception:
-                data["age"] = None
-        else:
-            data["age"] = None
-
-        if data.get("gender"):
-            unique_gender.add(data["gender"])
-        if data.get("last_emotion"):
-            unique_emotions.add(data["last_emotion"])
-
-        if gender_filter and data.get("gender") != gender_filter:
-            continue
-        if emotion_filter and data.get("last_emotion") != emotion_filter:
-            continue
-        if visit_date_filter and isinstance(data.get("last_visit"), datetime):
-            visit_date = data["last_visit"].strftime("%Y-%m-%d")
-            if visit_date != visit_date_filter:
-                continue
-
-        if age_min and (data.get("age") is None or data["age"] < age_min):
-            continue
-
-        if age_max and (data.get("age") is None or data["age"] > age_max):
-            continue
-
+        data["age"] = customer_age(data)
         customers.append(data)
 
-        total_customers += 1
-        if data.get("gender") == "Male":
-            male_count += 1
-        elif data.get("gender") == "Female":
-            female_count += 1
+    if totals is not None and not has_filters(filters):
+        # The unfiltered header comes from the maintained counters.
+        stats = {
+            "total": totals["total"],
+            "male": totals["gender"].get("Male", 0),
+            "female": totals["gender"].get("Female", 0)
+        }
+        return customers, prev_cursor, next_cursor, stats
+
+    # Count aggregations are billed per 1000 index entries, not per document.
+    total_customers = count_query(query)
+    if filters["gender"]:
+        male_count = total_customers if filters["gender"] == "Male" else 0
+        female_count = total_customers if filters["gender"] == "Female" else 0
+    else:
+        male_count = count_query(query.where("gender", "==", "Male"))
+        female_count = count_query(query.where("gender", "==", "Female"))
 
     stats = {
         "total": total_customers,
         "male": male_count,
         "female": female_count
     }
+    return customers, prev_cursor, next_cursor, stats
+
+
+@app.route("/")
+def dashboard():
+    if request.args.get("action") == "reset":
+        return redirect(url_for("dashboard"))
+
+    filters = read_filters(request.args)
+    page_size = request.args.get("page_size", PAGE_SIZE, type=int)
+    page_size = max(1, min(page_size or PAGE_SIZE, MAX_PAGE_SIZE))
+
+    after = request.args.get("after")
+    before = request.args.get("before")
+    totals = read_aggregates()
+
+    if view_ready():
+        customers, prev_cursor, next_cursor, stats = customer_view.query(
+            filters, page_size, after=after, before=before)
+        genders, emotions = customer_view.distinct()
+    else:
+        customers, prev_cursor, next_cursor, stats = firestore_listing(
+            filters, page_size, after, before, totals)
+        genders, emotions = GENDERS, EMOTIONS
+        if totals is not None:
+            genders = sorted(g for g, n in totals["gender"].items() if n > 0) or GENDERS
+            emotions = sorted(e for e, n in totals["emotion"].items() if n > 0) or EMOTIONS
+
+    visits_today = None
+    if totals is not None:
+        visits_today = totals["visits"].get(
+            local_day(utc_offset_hours=ANALYTICS_UTC_OFFSET).isoformat(), 0)
 
     return render_template("dashboard.html", customers=customers, stats=stats,
-                           genders=sorted(unique_gender),
-                           emotions=sorted(unique_emotions),
+                           genders=genders,
+                           emotions=emotions,
+                           jobs=jobs.recent(),
+                           totals=totals,
+                           visits_today=visits_today,
+                           page_size=page_size,
+                           prev_url=page_url(before=prev_cursor) if prev_cursor else None,
+                           next_url=page_url(after=next_cursor) if next_cursor else None,
                            request=request)
 
 
+@app.route("/api/customers")
+def api_customers():
+    # Newline-delimited JSON, one customer per line, ordered like the
+    # dashboard. The next page starts after the id in X-Next-Cursor.
+    filters = read_filters(request.args)
+    limit = request.args.get("limit", API_PAGE_SIZE, type=int)
+    limit = max(1, min(limit or API_PAGE_SIZE, API_MAX_PAGE_SIZE))
+    after = request.args.get("after")
+    compress = request.accept_encodings["gzip"] > 0
+
+    version, last_modified = data_version()
+    etag = query_etag(version, request.args, compress) if version else None
+    if etag is not None:
+        not_modified = request.if_none_match.contains_weak(etag)
+        if not request.if_none_match and last_modified is not None and \
+                request.if_modified_since is not None:
+            not_modified = last_modified.replace(microsecond=0) <= \
+                request.if_modified_since
+        if not_modified:
+            # Answered from the version alone, without reading customers.
+            response = Response(status=304)
+            response.set_etag(etag, weak=True)
+            return response
+
+    if view_ready():
+        rows, _, next_cursor, _ = customer_view.query(
+            filters, limit, after=after)
+        records = (customer_record(row["id"], row) for row in rows)
+    else:
+        docs, _, next_cursor = customers_page(
+            customers_query(filters).select(API_FIELDS), limit, after=after)
+
+        def records_from(docs):
+            for doc in docs:
+                data = doc.to_dict()
+                data["age"] = customer_age(data)
+                yield customer_record(doc.id, data)
+        records = records_from(docs)
+
+    response = Response(encoded_stream(ndjson_lines(records), compress),
+                        mimetype="application/x-ndjson")
+    response.headers["Vary"] = "Accept-Encoding"
+    if compress:
+        response.headers["Content-Encoding"] = "gzip"
+    if next_cursor:
+        response.headers["X-Next-Cursor"] = next_cursor
+        next_args = dict(request.args.to_dict(), after=next_cursor)
+        response.headers["Link"] = \
+            f'<{url_for("api_customers", **next_args)}>; rel="next"'
+    if etag is not None:
+        response.set_etag(etag, weak=True)
+        response.headers["Cache-Control"] = "no-cache"
+    if last_modified is not None:
+        response.last_modified = last_modified
+    return response
+
+
 @app.route("/send_messages", methods=["POST"])
 def send_messages():
     action = request.form.get("action")
@@ -107,19 +331,11 @@ def send_messages():
         flash("Message cannot be empty!", "danger")
         return redirect(url_for("dashboard"))
 
-    gender_filter = request.form.get("gender")
-    emotion_filter = request.form.get("emotion")
-    visit_date_filter = request.form.get("visit_date")
-    age_min = request.form.get("age_min", type=int)
-    age_max = request.form.get("age_max", type=int)
+    filters = read_filters(request.form)
 
-    has_filter = any([
-        gender_filter,
-        emotion_filter,
-        visit_date_filter,
-        age_min is not None,
-        age_max is not None
-    ])
+    # Resubmitting the same message on the same day does not message
+    # anyone twice.
+    campaign = "bulk-" + hashlib.sha1(message.encode("utf-8")).hexdigest()[:12]
 
     if action == "selected":
         selected_numbers = request.form.getlist("selected_customers")
@@ -127,58 +343,80 @@ def send_messages():
             flash("No customers selected", "warning")
             return redirect(url_for("dashboard"))
 
-        for number in selected_numbers:
-            send_whatsapp_message(number, message)
-
-        flash(
-            f"Message sent to {len(selected_numbers)} selected customers!", "success")
+        def resolve():
+            for number in dict.fromkeys(selected_numbers):
+                yield number, message_key(campaign, number)
 
     elif action == "filtered":
-
-        if not has_filter:
+        if not has_filters(filters):
             flash("No filter is applied!", "warning")
             return redirect(url_for("dashboard"))
 
-        customers_ref = db.collection("customers")
-        docs = customers_ref.stream()
+        def resolve():
+            if view_ready():
+                numbers = (phone for _, phone in customer_view.phones_matching(
+                    filters))
+            else:
+                numbers = (doc.to_dict().get("phone_number")
+                           for doc in customers_query(filters).stream())
+            seen = set()
+            for number in numbers:
+                if number and number not in seen:
+                    seen.add(number)
+                    yield number, message_key(campaign, number)
+
+    else:
+        flash("Unknown action", "danger")
+        return redirect(url_for("dashboard"))
+
+    job = jobs.submit(message, resolve)
+    if request.accept_mimetypes.best == "application/json":
+        return jsonify({"job_id": job.id,
+                        "status_url": url_for("job_status", job_id=job.id)}), 202
+    flash(f"Sending in the background (job {job.id}).", "success")
+    return redirect(url_for("dashboard"))
+
 
-        count = 0
-        for doc in docs:
-            data = doc.to_dict()
+@app.route("/jobs")
+def list_jobs():
+    return jsonify(jobs.recent())
 
-            dob = data.get("date_of_birth")
 
-            if dob:
-                try:
-                    dob_date = datetime.strptime(dob, "%Y-%m-%d")
-                    age = (datetime.now().date() - dob_date.date()).days // 365
-                    data["age"] = age
-                except Exception:
-                    data["age"] = None
-            else:
-                data["age"] = None
-
-            if gender_filter and data.get("gender") != gender_filter:
-                continue
-            if emotion_filter and data.get("last_emotion") != emotion_filter:
-                continue
-            if visit_date_filter and isinstance(data.get("last_visit"), datetime):
-                visit_date = data["last_visit"].strftime("%Y-%m-%d")
-                if visit_date != visit_date_filter:
-                    continue
-
-            if age_min and (age is None or age < age_min):
-                continue
-            if age_max and (age is None or age > age_max):
-                continue
-
-            if data.get("phone_number"):
-                send_whatsapp_message(data["phone_number"], message)
-                count += 1
-
-        flash(f"Message sent to {count} filtered customers!", "success")
+@app.route("/jobs/<job_id>")
+def job_status(job_id):
+    status = jobs.status(job_id)
+    if status is None:
+        return jsonify({"error": "Unknown job"}), 404
+    return jsonify(status)
+
+
+@app.route("/jobs/<job_id>/cancel", methods=["POST"])
+def cancel_job(job_id):
+    job = jobs.cancel(job_id)
+    if request.accept_mimetypes.best == "application/json":
+        if job is None:
+            return jsonify({"error": "Unknown job"}), 404
+        return jsonify(jobs.status(job_id))
+    if job is None:
+        flash("Unknown job", "warning")
+    else:
+        flash(f"Job {job_id} cancelled.", "warning")
     return redirect(url_for("dashboard"))
 
 
+@app.route("/analytics")
+def analytics():
+    days = request.args.get("days", ANALYTICS_DAYS, type=int)
+    days = max(1, min(days or ANALYTICS_DAYS, ANALYTICS_MAX_DAYS))
+    result = visit_analytics.summary(days=days,
+                                     utc_offset_hours=ANALYTICS_UTC_OFFSET)
+    if request.args.get("format") == "json":
+        result["start"] = result["start"].isoformat()
+        result["days"] = [day.isoformat() for day in result["days"]]
+        return jsonify(result)
+    return render_template("analytics.html", result=result, days=days,
+                           peak=max(result["hourly"]) or 1)
+
+
 if __name__ == "__main__":
     app.run(debug=True)
@@ -0,0 +1,177 @@
+import collections
+import os
+import threading
+import time
+import uuid
+from concurrent.futures import ThreadPoolExecutor
+
+
+JOB_WORKERS = int(os.getenv('BULK_SEND_WORKERS', '8'))
+MAX_JOBS_KEPT = 50
+
+PENDING = 'pending'
+RESOLVING = 'resolving'
+RUNNING = 'running'
+DONE = 'done'
+CANCELLED = 'cancelled'
+FAILED = 'failed'
+FINISHED = (DONE, CANCELLED, FAILED)
+
+
+class BulkSendJob:
+    def __init__(self, message, resolve, send, workers=JOB_WORKERS,
+                 withdraw=None):
+        self.id = uuid.uuid4().hex[:12]
+        self.message = message
+        self.resolve = resolve
+        self.send = send
+        self.workers = workers
+        self.withdraw = withdraw
+        self.status = PENDING
+        self.created_at = time.time()
+        self.finished_at = None
+        self.error = None
+        self.keys = []
+        self.counters = {'total': 0, 'queued': 0, 'duplicates': 0,
+                         'failed': 0, 'skipped': 0}
+
+        self._lock = threading.Lock()
+        self._cancel = threading.Event()
+
+    def cancel(self):
+        self._cancel.set()
+        self._withdraw()
+
+    def queued_keys(self):
+        # Only the keys this job inserted; keys that were already in the
+        # outbox belong to another job.
+        with self._lock:
+            return list(self.keys)
+
+    def _withdraw(self):
+        # Messages this job queued but that are not sent yet are withdrawn
+        # too.
+        keys = self.queued_keys()
+        if self.withdraw is not None and keys:
+            self.withdraw(keys)
+
+    def _count(self, outcome):
+        with self._lock:
+            self.counters[outcome] += 1
+
+    def _send_one(self, phone, key):
+        if self._cancel.is_set():
+            self._count('skipped')
+            return
+        try:
+            queued = self.send(phone, self.message, key=key)
+        except Exception as e:
+            self._count('failed')
+            print(f"Bulk send job {self.id}: could not queue {phone}: {e}")
+            return
+        with self._lock:
+            if queued:
+                self.keys.append(key)
+                self.counters['queued'] += 1
+            else:
+                self.counters['duplicates'] += 1
+
+    def run(self):
+        try:
+            self.status = RESOLVING
+            # The recipient set is fixed here; customers added while the job
+            # runs are not messaged.
+            recipients = list(self.resolve())
+            self.counters['total'] = len(recipients)
+
+            self.status = RUNNING
+            with ThreadPoolExecutor(self.workers,
+                                    thread_name_prefix=f'bulk-{self.id}') as pool:
+                for phone, key in recipients:
+                    if self._cancel.is_set():
+                        break
+                    pool.submit(self._send_one, phone, key)
+            self.counters['skipped'] = self.counters['total'] - (
+                self.counters['queued'] + self.counters['duplicates'] +
+                self.counters['failed'])
+            if self._cancel.is_set():
+                # Catches sends that were queued while cancel() ran.
+                self._withdraw()
+                self.status = CANCELLED
+            else:
+                self.status = DONE
+        except Exception as e:
+            self.error = str(e)
+            self.status = FAILED
+            print(f"Bulk send job {self.id} failed: {e}")
+        finally:
+            self.finished_at = time.time()
+
+    def snapshot(self, delivery=None):
+        with self._lock:
+            counters = dict(self.counters)
+        snapshot = {
+            'id': self.id,
+            'status': self.status,
+            'message': self.message,
+            'created_at': self.created_at,
+            'finished_at': self.finished_at,
+            'error': self.error,
+            **counters,
+        }
+        if delivery is not None:
+            snapshot['delivery'] = delivery
+        return snapshot
+
+
+class BulkSendJobs:
+    def __init__(self, send, outbox=None, workers=JOB_WORKERS,
+                 max_kept=MAX_JOBS_KEPT):
+        self.send = send
+        self.outbox = outbox
+        self.workers = workers
+        self.max_kept = max_kept
+        self._jobs = collections.OrderedDict()
+        self._lock = threading.Lock()
+
+    def submit(self, message, resolve):
+        withdraw = self.outbox.cancel if self.outbox is not None else None
+        job = BulkSendJob(message, resolve, self.send, self.workers, withdraw)
+        with self._lock:
+            self._jobs[job.id] = job
+            self._forget_finished()
+        threading.Thread(target=job.run, name=f'bulk-send-{job.id}',
+                         daemon=True).start()
+        return job
+
+    def _forget_finished(self):
+        for job_id in list(self._jobs):
+            if len(self._jobs) <= self.max_kept:
+                return
+            if self._jobs[job_id].status in FINISHED:
+                del self._jobs[job_id]
+
+    def get(self, job_id):
+        with self._lock:
+            return self._jobs.get(job_id)
+
+    def cancel(self, job_id):
+        job = self.get(job_id)
+        if job is None:
+            return None
+        job.cancel()
+        return job
+
+    def status(self, job_id):
+        job = self.get(job_id)
+        if job is None:
+            return None
+        delivery = None
+        if self.outbox is not None and job.status in (RUNNING,) + FINISHED:
+            delivery = self.outbox.counts_for(job.queued_keys())
+        return job.snapshot(delivery)
+
+    def recent(self, limit=10):
+        with self._lock:
+            jobs = list(self._jobs.values())[-limit:]
+        return [job.snapshot() for job in reversed(jobs)]
@@ -0,0 +1,157 @@
+import datetime
+import hashlib
+import json
+import os
+import threading
+import time
+import zlib
+from firebase_admin import firestore
+
+
+API_FIELDS = ["name", "phone_number", "gender", "date_of_birth",
+              "last_emotion", "last_visit", "created_at", "updated_at"]
+GZIP_LEVEL = 6
+FLUSH_LINES = 200
+COUNT_SECONDS = float(os.getenv("API_COUNT_SECONDS", "10"))
+
+
+class CollectionVersion:
+    # Tracks the newest registration/edit (updated_at) and the newest visit
+    # (last_visit) with two single-document listeners. Together they change
+    # whenever a customer is added, edited or seen, so they serve as the
+    # data version without reading the collection. Deleting a customer moves
+    # neither head, so a count() aggregation, refreshed at most every
+    # count_seconds, is part of the version too.
+
+    FIELDS = ("updated_at", "last_visit")
+
+    def __init__(self, db, count_seconds=COUNT_SECONDS):
+        self.db = db
+        self.count_seconds = count_seconds
+        self._heads = {}
+        self._lock = threading.Lock()
+        self._watches = []
+        self._count = None
+        self._counted_at = float("-inf")
+        self._count_changed_at = None
+        self._count_lock = threading.Lock()
+
+    def start(self):
+        customers = self.db.collection("customers")
+        for field in self.FIELDS:
+            query = customers.order_by(
+                field, direction=firestore.Query.DESCENDING).limit(1)
+            self._watches.append(query.on_snapshot(
+                lambda docs, changes, read_time, field=field:
+                self._on_snapshot(field, docs)))
+
+    def stop(self):
+        for watch in self._watches:
+            watch.unsubscribe()
+
+    def _on_snapshot(self, field, docs):
+        head = (None, None)
+        if docs:
+            head = (docs[0].id, (docs[0].to_dict() or {}).get(field))
+        with self._lock:
+            self._heads[field] = head
+
+    def _customer_count(self):
+        with self._count_lock:
+            if time.monotonic() - self._counted_at < self.count_seconds:
+                return self._count
+            self._counted_at = time.monotonic()
+            try:
+                result = self.db.collection("customers").count().get()
+                count = result[0][0].value
+            except Exception as e:
+                print(f"Customer count failed: {e}")
+                return self._count
+            if self._count is not None and count != self._count:
+                self._count_changed_at = datetime.datetime.now(
+                    datetime.timezone.utc)
+            self._count = count
+            return count
+
+    @property
+    def version(self):
+        with self._lock:
+            if len(self._heads) < len(self.FIELDS):
+                return None
+            heads = [self._heads[field] for field in self.FIELDS]
+        count = self._customer_count()
+        if count is None:
+            return None
+        text = "|".join(f"{doc_id}@{stamp}" for doc_id, stamp in heads)
+        text += f"#{count}"
+        return hashlib.sha1(text.encode("utf-8")).hexdigest()[:16]
+
+    @property
+    def last_modified(self):
+        with self._lock:
+            stamps = [stamp for _, stamp in self._heads.values()
+                      if isinstance(stamp, datetime.datetime)]
+        if self._count_changed_at is not None:
+            stamps.append(self._count_changed_at)
+        if not stamps:
+            return None
+        return max(stamp if stamp.tzinfo else
+                   stamp.replace(tzinfo=datetime.timezone.utc)
+                   for stamp in stamps)
+
+
+def json_value(value):
+    if isinstance(value, datetime.datetime):
+        if value.tzinfo is None:
+            value = value.replace(tzinfo=datetime.timezone.utc)
+        return value.isoformat()
+    if isinstance(value, datetime.date):
+        return value.isoformat()
+    return value
+
+
+def customer_record(customer_id, data):
+    record = {"id": customer_id}
+    for field in API_FIELDS + ["age"]:
+        if field in data:
+            record[field] = json_value(data[field])
+    return record
+
+
+def ndjson_lines(records):
+    for record in records:
+        yield json.dumps(record, separators=(",", ":"),
+                         ensure_ascii=False) + "\n"
+
+
+def encoded_stream(lines, compress):
+    # Lines are written in chunks so a large page starts reaching the client
+    # before it has all been serialized.
+    compressor = zlib.compressobj(GZIP_LEVEL, zlib.DEFLATED, 31) \
+        if compress else None
+    chunk = []
+    for line in lines:
+        chunk.append(line)
+        if len(chunk) >= FLUSH_LINES:
+            data = "".join(chunk).encode("utf-8")
+            chunk = []
+            if compressor is None:
+                yield data
+            else:
+                data = compressor.compress(data)
+                if data:
+                    yield data
+    data = "".join(chunk).encode("utf-8")
+    if compressor is None:
+        if data:
+            yield data
+    else:
+        yield compressor.compress(data) + compressor.flush()
+
+
+def query_etag(version, args, compress):
+    # Ages are derived from today's date, so the day is part of the version.
+    text = datetime.date.today().isoformat() + "?" + "&".join(
+        f"{key}={value}" for key, value in sorted(args.items(multi=True)))
+    digest = hashlib.sha1(text.encode("utf-8")).hexdigest()[:12]
+    return f"{version}-{digest}-{'gz' if compress else 'id'}"
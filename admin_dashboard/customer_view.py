@@ -0,0 +1,465 @@
+import argparse
+import collections
+import datetime
+import os
+import random
+import sys
+import threading
+import time
+import numpy as np
+
+
+INITIAL_CAPACITY = 1024
+MISSING = -1
+NO_DAY = -1
+ENCODING_DIM = 128
+
+
+def rss_bytes():
+    # Resident set size of this process, from /proc where there is one.
+    try:
+        with open('/proc/self/statm') as f:
+            return int(f.read().split()[1]) * os.sysconf('SC_PAGE_SIZE')
+    except (OSError, ValueError, AttributeError):
+        import resource
+        return resource.getrusage(resource.RUSAGE_SELF).ru_maxrss * 1024
+
+
+def date_ordinal(value):
+    if not value:
+        return NO_DAY
+    try:
+        return datetime.datetime.strptime(value, "%Y-%m-%d").toordinal()
+    except (TypeError, ValueError):
+        return NO_DAY
+
+
+def visit_day(value):
+    if not isinstance(value, datetime.datetime):
+        return NO_DAY
+    if value.tzinfo is not None:
+        value = value.astimezone(datetime.timezone.utc)
+    return value.toordinal()
+
+
+class Vocabulary:
+    def __init__(self):
+        self.values = []
+        self.codes = {}
+
+    def code(self, value):
+        if value is None or value == "":
+            return MISSING
+        code = self.codes.get(value)
+        if code is None:
+            code = self.codes[value] = len(self.values)
+            self.values.append(value)
+        return code
+
+    def lookup(self, value):
+        return self.codes.get(value, MISSING)
+
+
+class CustomerView:
+    def __init__(self, capacity=INITIAL_CAPACITY):
+        self.genders = Vocabulary()
+        self.emotions = Vocabulary()
+        self.counters = {'upserts': 0, 'deletes': 0, 'rebuilds': 0}
+        # Changes applied so far; with the per-process epoch it versions the
+        # view for HTTP caching.
+        self.changes = 0
+        self.last_modified = None
+        self._epoch = os.urandom(4).hex()
+
+        self._lock = threading.Lock()
+        self._ready = threading.Event()
+        self._watch = None
+        self._slots = {}
+        self._free = []
+        self._size = 0
+        self._allocate(capacity)
+        self._dirty = True
+
+    def _allocate(self, capacity):
+        def grow(old, dtype, fill):
+            column = np.full(capacity, fill, dtype=dtype)
+            if old is not None:
+                column[:len(old)] = old
+            return column
+
+        self.alive = grow(getattr(self, 'alive', None), bool, False)
+        self.gender = grow(getattr(self, 'gender', None), np.int16, MISSING)
+        self.emotion = grow(getattr(self, 'emotion', None), np.int16, MISSING)
+        self.dob = grow(getattr(self, 'dob', None), np.int32, NO_DAY)
+        self.visit_day = grow(getattr(self, 'visit_day', None), np.int32, NO_DAY)
+        self.ids = grow(getattr(self, 'ids', None), object, None)
+        self.names = grow(getattr(self, 'names', None), object, None)
+        self.phones = grow(getattr(self, 'phones', None), object, None)
+        self.last_visit = grow(getattr(self, 'last_visit', None), object, None)
+
+    def __len__(self):
+        return len(self._slots)
+
+    @property
+    def ready(self):
+        return self._ready.is_set()
+
+    @property
+    def version(self):
+        if not self.ready:
+            return None
+        with self._lock:
+            return f"{self._epoch}.{self.changes}"
+
+    def start(self, db):
+        self._watch = db.collection("customers").on_snapshot(self._on_snapshot)
+
+    def stop(self):
+        if self._watch is not None:
+            self._watch.unsubscribe()
+
+    def _on_snapshot(self, docs, changes, read_time):
+        with self._lock:
+            for change in changes:
+                if change.type.name == 'REMOVED':
+                    self._delete(change.document.id)
+                else:
+                    self._upsert(change.document.id, change.document.to_dict() or {})
+            if changes:
+                self.changes += 1
+                self.last_modified = read_time
+        # The first callback carries the whole collection.
+        self._ready.set()
+
+    def apply(self, upserts=(), deletes=()):
+        with self._lock:
+            for customer_id, data in upserts:
+                self._upsert(customer_id, data)
+            for customer_id in deletes:
+                self._delete(customer_id)
+            self.changes += 1
+            self.last_modified = datetime.datetime.now(datetime.timezone.utc)
+        self._ready.set()
+
+    def _upsert(self, customer_id, data):
+        slot = self._slots.get(customer_id)
+        if slot is None:
+            if self._free:
+                slot = self._free.pop()
+            else:
+                if self._size == len(self.alive):
+                    self._allocate(2 * len(self.alive))
+                slot = self._size
+                self._size += 1
+            self._slots[customer_id] = slot
+
+        self.alive[slot] = True
+        self.ids[slot] = customer_id
+        self.names[slot] = data.get("name")
+        self.phones[slot] = data.get("phone_number")
+        self.gender[slot] = self.genders.code(data.get("gender"))
+        self.emotion[slot] = self.emotions.code(data.get("last_emotion"))
+        self.dob[slot] = date_ordinal(data.get("date_of_birth"))
+        self.visit_day[slot] = visit_day(data.get("last_visit"))
+        self.last_visit[slot] = data.get("last_visit")
+        self.counters['upserts'] += 1
+        self._dirty = True
+
+    def _delete(self, customer_id):
+        slot = self._slots.pop(customer_id, None)
+        if slot is None:
+            return
+        self.alive[slot] = False
+        for column in (self.ids, self.names, self.phones, self.last_visit):
+            column[slot] = None
+        self._free.append(slot)
+        self.counters['deletes'] += 1
+        self._dirty = True
+
+    def _ensure_index(self):
+        # Indexes are rebuilt lazily, so a burst of listener changes costs
+        # one rebuild on the next query. They are laid out in customer id
+        # order, which is also the page order, so a filter result is a
+        # single boolean selection with no re-sorting.
+        if not self._dirty:
+            return
+        n = self._size
+        alive = np.flatnonzero(self.alive[:n])
+        ids = np.array([self.ids[slot] for slot in alive], dtype=str)
+        self._id_order = alive[np.argsort(ids, kind='stable')]
+        self._id_rank = np.zeros(n, dtype=np.int64)
+        self._id_rank[self._id_order] = np.arange(len(self._id_order))
+
+        gender = self.gender[self._id_order]
+        emotion = self.emotion[self._id_order]
+        self._gender_masks = [gender == code
+                              for code in range(len(self.genders.values))]
+        self._emotion_masks = [emotion == code
+                               for code in range(len(self.emotions.values))]
+        dob = self.dob[self._id_order]
+        self._dob_order = np.argsort(dob, kind='stable')
+        self._dob_sorted = dob[self._dob_order]
+        visits = self.visit_day[self._id_order]
+        self._visit_order = np.argsort(visits, kind='stable')
+        self._visit_sorted = visits[self._visit_order]
+
+        self._distinct = (
+            sorted(value for value, mask in zip(self.genders.values,
+                                                self._gender_masks) if mask.any()),
+            sorted(value for value, mask in zip(self.emotions.values,
+                                                self._emotion_masks) if mask.any()))
+        self._dirty = False
+        self.counters['rebuilds'] += 1
+
+    @staticmethod
+    def _range_mask(n, order, sorted_values, low, high):
+        # Rows whose value lies in [low, high), found by binary search.
+        mask = np.zeros(n, dtype=bool)
+        start = np.searchsorted(sorted_values, low, side='left')
+        stop = np.searchsorted(sorted_values, high, side='left')
+        mask[order[start:stop]] = True
+        return mask
+
+    def _category_mask(self, masks, vocabulary, value):
+        code = vocabulary.lookup(value)
+        if code == MISSING:
+            return None
+        return masks[code]
+
+    def select(self, filters, today=None):
+        with self._lock:
+            return self._select(filters, today)
+
+    def query(self, filters, page_size, after=None, before=None, today=None):
+        # Filtering and paging share one lock acquisition: slots are only
+        # meaningful against the index they were selected from.
+        with self._lock:
+            slots = self._select(filters, today)
+            rows, prev_cursor, next_cursor = self._page(
+                slots, page_size, after=after, before=before)
+            stats = {
+                "total": len(slots),
+                "male": self._count_gender(slots, "Male"),
+                "female": self._count_gender(slots, "Female")
+            }
+            return rows, prev_cursor, next_cursor, stats
+
+    def phones_matching(self, filters, today=None):
+        with self._lock:
+            return [(self.ids[slot], self.phones[slot])
+                    for slot in self._select(filters, today)]
+
+    def _select(self, filters, today=None):
+        today = (today or datetime.date.today()).toordinal()
+        self._ensure_index()
+        n = len(self._id_order)
+        mask = np.ones(n, dtype=bool)
+
+        if filters.get("gender"):
+            gender = self._category_mask(
+                self._gender_masks, self.genders, filters["gender"])
+            if gender is None:
+                return np.empty(0, dtype=np.int64)
+            mask &= gender
+        if filters.get("emotion"):
+            emotion = self._category_mask(
+                self._emotion_masks, self.emotions, filters["emotion"])
+            if emotion is None:
+                return np.empty(0, dtype=np.int64)
+            mask &= emotion
+
+        # Same rule as customer_age: whole 365-day periods since birth.
+        if filters.get("age_min") or filters.get("age_max"):
+            low, high = 1, today + 1
+            if filters.get("age_min"):
+                high = today - 365 * filters["age_min"] + 1
+            if filters.get("age_max"):
+                low = today - 365 * (filters["age_max"] + 1) + 1
+            mask &= self._range_mask(n, self._dob_order, self._dob_sorted,
+                                     low, high)
+
+        if filters.get("visit_date"):
+            day = date_ordinal(filters["visit_date"])
+            if day == NO_DAY:
+                return np.empty(0, dtype=np.int64)
+            mask &= self._range_mask(n, self._visit_order,
+                                     self._visit_sorted, day, day + 1)
+
+        return self._id_order.take(np.flatnonzero(mask))
+
+    def _page(self, slots, page_size, after=None, before=None):
+        ranks = self._id_rank[slots]
+        start, stop = 0, len(slots)
+        if before and before in self._slots:
+            stop = int(np.searchsorted(
+                ranks, self._id_rank[self._slots[before]], side='left'))
+            start = max(0, stop - page_size)
+        else:
+            if after and after in self._slots:
+                start = int(np.searchsorted(
+                    ranks, self._id_rank[self._slots[after]], side='right'))
+            stop = min(len(slots), start + page_size)
+        page = slots[start:stop]
+        prev_cursor = self.ids[page[0]] if start > 0 and len(page) else None
+        next_cursor = self.ids[page[-1]] if stop < len(slots) and len(page) else None
+        return self._rows(page), prev_cursor, next_cursor
+
+    def _rows(self, slots):
+        today = datetime.date.today().toordinal()
+        rows = []
+        for slot in slots:
+            dob = int(self.dob[slot])
+            gender, emotion = int(self.gender[slot]), int(self.emotion[slot])
+            rows.append({
+                "id": self.ids[slot],
+                "name": self.names[slot],
+                "phone_number": self.phones[slot],
+                "gender": self.genders.values[gender] if gender != MISSING else None,
+                "date_of_birth": datetime.date.fromordinal(dob).isoformat()
+                if dob != NO_DAY else None,
+                "age": (today - dob) // 365 if dob != NO_DAY else None,
+                "last_emotion": self.emotions.values[emotion]
+                if emotion != MISSING else None,
+                "last_visit": self.last_visit[slot],
+            })
+        return rows
+
+    def _count_gender(self, slots, value):
+        code = self.genders.lookup(value)
+        if code == MISSING:
+            return 0
+        return int(np.count_nonzero(self.gender[slots] == code))
+
+    def distinct(self):
+        with self._lock:
+            self._ensure_index()
+            return self._distinct
+
+    def memory_usage(self):
+        # The view's own columns and indexes only. The listener's Watch also
+        # keeps a DocumentSnapshot of every customer, encodings included, and
+        # has no field projection; that cache is only visible in rss_bytes.
+        with self._lock:
+            n = self._size
+            numeric = sum(column[:n].nbytes for column in (
+                self.alive, self.gender, self.emotion, self.dob, self.visit_day))
+            # Object columns hold pointers; the strings they point to are
+            # counted separately.
+            pointers = sum(column[:n].nbytes for column in (
+                self.ids, self.names, self.phones, self.last_visit))
+            strings = sum(sys.getsizeof(value) for column in (
+                self.ids, self.names, self.phones, self.last_visit)
+                for value in column[:n] if value is not None)
+            index = 0
+            if not self._dirty:
+                index = sum(array.nbytes for array in (
+                    self._id_order, self._id_rank, self._dob_order,
+                    self._dob_sorted, self._visit_order, self._visit_sorted))
+                index += sum(mask.nbytes for mask in
+                             self._gender_masks + self._emotion_masks)
+        return {'customers': len(self._slots), 'numeric_bytes': numeric,
+                'pointer_bytes': pointers, 'string_bytes': strings,
+                'index_bytes': index,
+                'total_bytes': numeric + pointers + strings + index,
+                'rss_bytes': rss_bytes()}
+
+
+def synthetic_customers(count, seed=0, samples=0, legacy=False):
+    # samples > 0 adds encodings like registered customers have, packed or
+    # as the legacy flat list.
+    rng = random.Random(seed)
+    today = datetime.date.today()
+    emotions = ["angry", "disgust", "fear", "happy", "sad", "surprise",
+                "neutral", None]
+    for i in range(count):
+        dob = today - datetime.timedelta(days=rng.randint(16 * 365, 80 * 365))
+        visit = None
+        if rng.random() < 0.8:
+            visit = datetime.datetime.now(datetime.timezone.utc) - \
+                datetime.timedelta(days=rng.randint(0, 60),
+                                   seconds=rng.randint(0, 86400))
+        data = {
+            "name": f"Customer {i}",
+            "phone_number": f"+9617{rng.randint(0, 9999999):07d}",
+            "gender": rng.choice(["Male", "Female"]),
+            "date_of_birth": dob.isoformat(),
+            "last_emotion": rng.choice(emotions),
+            "last_visit": visit,
+        }
+        if samples and legacy:
+            data["encodings"] = [rng.gauss(0, 0.09)
+                                 for _ in range(samples * ENCODING_DIM)]
+        elif samples:
+            data["encodings_packed"] = {
+                'version': 1, 'dtype': 'float32', 'count': samples,
+                'dim': ENCODING_DIM, 'model': 'dlib_resnet_v1',
+                'data': rng.randbytes(4 * samples * ENCODING_DIM)}
+        yield f"{100000 + i}", data
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(
+        description="Memory and filter latency of the in-memory customer view")
+    parser.add_argument('--customers', type=int, default=100000)
+    parser.add_argument('--repeat', type=int, default=200)
+    parser.add_argument('--samples', type=int, default=5,
+                        help="encodings per customer in the simulated "
+                             "listener cache (0 to leave them out)")
+    parser.add_argument('--legacy-encodings', action='store_true',
+                        help="store encodings as the old flat float list")
+    args = parser.parse_args()
+
+    # Stands in for the listener's document cache: the Watch holds every
+    # full document for as long as the listener runs.
+    rss_start = rss_bytes()
+    documents = dict(synthetic_customers(args.customers, samples=args.samples,
+                                         legacy=args.legacy_encodings))
+    rss_documents = rss_bytes()
+
+    view = CustomerView()
+    start = time.perf_counter()
+    view.apply(documents.items())
+    load_seconds = time.perf_counter() - start
+
+    start = time.perf_counter()
+    view.select({})
+    index_seconds = time.perf_counter() - start
+
+    usage = view.memory_usage()
+    scale = 100000 / max(1, args.customers)
+    print(f"{args.customers} customers loaded in {load_seconds:.2f}s, "
+          f"indexes built in {1000 * index_seconds:.1f}ms")
+    print(f"memory: numeric={usage['numeric_bytes'] / 2**20:.2f}MiB "
+          f"pointers={usage['pointer_bytes'] / 2**20:.2f}MiB "
+          f"strings={usage['string_bytes'] / 2**20:.2f}MiB "
+          f"indexes={usage['index_bytes'] / 2**20:.2f}MiB "
+          f"total={usage['total_bytes'] / 2**20:.2f}MiB "
+          f"({usage['total_bytes'] * scale / 2**20:.2f}MiB per 100k customers)")
+    print(f"RSS: documents with {args.samples} "
+          f"{'legacy' if args.legacy_encodings else 'packed'} encodings "
+          f"{(rss_documents - rss_start) * scale / 2**20:.0f}MiB, view "
+          f"{(usage['rss_bytes'] - rss_documents) * scale / 2**20:.0f}MiB, "
+          f"process {usage['rss_bytes'] / 2**20:.0f}MiB (per 100k customers "
+          f"except process)")
+
+    yesterday = (datetime.datetime.now(datetime.timezone.utc) -
+                 datetime.timedelta(days=1)).date().isoformat()
+    cases = collections.OrderedDict([
+        ('gender', {'gender': 'Female'}),
+        ('gender+emotion', {'gender': 'Male', 'emotion': 'happy'}),
+        ('age', {'age_min': 25, 'age_max': 40}),
+        ('visit_date', {'visit_date': yesterday}),
+        ('all', {'gender': 'Female', 'emotion': 'sad', 'age_min': 30,
+                 'age_max': 60, 'visit_date': yesterday}),
+    ])
+    for label, filters in cases.items():
+        start = time.perf_counter()
+        for _ in range(args.repeat):
+            slots = view.select(filters)
+        elapsed = (time.perf_counter() - start) / args.repeat
+        print(f"{label:>15}: {len(slots):>7} matches in "
+              f"{1e6 * elapsed:.0f}us")
+    start = time.perf_counter()
+    for _ in range(args.repeat):
+        view.distinct()
+    print(f"{'distinct':>15}: {1e6 * (time.perf_counter() - start) / args.repeat:.0f}us")
@@ -0,0 +1,204 @@
+import argparse
+import collections
+import os
+import random
+import threading
+import time
+from firebase_admin import firestore
+from google.api_core.exceptions import AlreadyExists
+
+
+AGGREGATES_COLLECTION = 'aggregates'
+CUSTOMERS_DOC = 'customers'
+SHARDS = int(os.getenv('AGGREGATE_SHARDS', '10'))
+CACHE_SECONDS = float(os.getenv('AGGREGATE_CACHE_SECONDS', '5'))
+RECONCILE_SECONDS = float(os.getenv('AGGREGATE_RECONCILE_SECONDS', '0'))
+# What the emotion worker reports before it has a reading; not an emotion.
+UNKNOWN_EMOTION = 'Unknown'
+
+
+def empty_totals():
+    return {'total': 0, 'gender': {}, 'emotion': {}, 'visits': {}}
+
+
+def counted_emotion(value):
+    return value if value and value != UNKNOWN_EMOTION else None
+
+
+def _increments(counts):
+    return {key: firestore.Increment(value)
+            for key, value in counts.items() if value}
+
+
+class AggregateCounters:
+    # Sharded counters: each write increments one random shard document so
+    # concurrent writers do not contend on a single document, and a read
+    # sums all shards in one round trip.
+
+    def __init__(self, db, shards=SHARDS, cache_seconds=CACHE_SECONDS):
+        self.db = db
+        self.shards = shards
+        self.cache_seconds = cache_seconds
+        self._cached = None
+        self._cached_at = 0.0
+        self._lock = threading.Lock()
+
+    def _shard_refs(self):
+        shards = self.db.collection(AGGREGATES_COLLECTION) \
+            .document(CUSTOMERS_DOC).collection('shards')
+        return [shards.document(str(i)) for i in range(self.shards)]
+
+    def _shard(self):
+        return self._shard_refs()[random.randrange(self.shards)]
+
+    def add(self, batch, total=0, gender=None, emotion=None, visits=None):
+        fields = {}
+        if total:
+            fields['total'] = firestore.Increment(total)
+        for name, counts in (('gender', gender), ('emotion', emotion),
+                             ('visits', visits)):
+            if counts:
+                increments = _increments(counts)
+                if increments:
+                    fields[name] = increments
+        if fields:
+            batch.set(self._shard(), fields, merge=True)
+        return bool(fields)
+
+    def customer_added(self, batch, gender):
+        return self.add(batch, total=1, gender={gender: 1} if gender else None)
+
+    def read(self, max_age=None):
+        max_age = self.cache_seconds if max_age is None else max_age
+        with self._lock:
+            if self._cached is not None and \
+                    time.monotonic() - self._cached_at < max_age:
+                return self._cached
+
+        totals = empty_totals()
+        for snapshot in self.db.get_all(self._shard_refs()):
+            data = snapshot.to_dict() or {}
+            totals['total'] += data.get('total', 0)
+            for name in ('gender', 'emotion', 'visits'):
+                for key, value in (data.get(name) or {}).items():
+                    totals[name][key] = totals[name].get(key, 0) + value
+
+        with self._lock:
+            self._cached = totals
+            self._cached_at = time.monotonic()
+        return totals
+
+
+def scan_customers(db):
+    gender = collections.Counter()
+    emotion = collections.Counter()
+    total = 0
+    for doc in db.collection('customers').select(
+            ['gender', 'last_emotion']).stream():
+        data = doc.to_dict() or {}
+        total += 1
+        if data.get('gender'):
+            gender[data['gender']] += 1
+        if counted_emotion(data.get('last_emotion')):
+            emotion[data['last_emotion']] += 1
+    return {'total': total, 'gender': dict(gender), 'emotion': dict(emotion)}
+
+
+def reconcile(counters):
+    # Writes the difference between a full scan and the counters as one more
+    # increment, so updates landing during the scan are not overwritten.
+    # Visits per day have no other source of truth and are left as they are.
+    exact = scan_customers(counters.db)
+    current = counters.read(max_age=0)
+
+    drift = {'total': exact['total'] - current['total']}
+    for name in ('gender', 'emotion'):
+        keys = set(exact[name]) | set(current[name])
+        drift[name] = {key: exact[name].get(key, 0) - current[name].get(key, 0)
+                       for key in keys}
+
+    batch = counters.db.batch()
+    if counters.add(batch, total=drift['total'], gender=drift['gender'],
+                    emotion=drift['emotion']):
+        batch.commit()
+    return drift
+
+
+def seed(counters):
+    # Counters start at zero, so customers registered before they existed
+    # are missing until a reconcile. The first caller creates the marker
+    # document and runs one; everyone later finds it and does nothing.
+    marker = counters.db.collection(AGGREGATES_COLLECTION) \
+        .document(CUSTOMERS_DOC)
+    try:
+        marker.create({'seeded_at': firestore.SERVER_TIMESTAMP})
+    except AlreadyExists:
+        return None
+    try:
+        return reconcile(counters)
+    except Exception:
+        marker.delete()
+        raise
+
+
+class Reconciler:
+    def __init__(self, counters, interval=RECONCILE_SECONDS):
+        self.counters = counters
+        self.interval = interval
+        self._stop_event = threading.Event()
+        self._thread = threading.Thread(
+            target=self._run, name='aggregate-reconcile', daemon=True)
+
+    def start(self):
+        self._thread.start()
+
+    def stop(self):
+        self._stop_event.set()
+
+    def _run(self):
+        try:
+            drift = seed(self.counters)
+            if drift is not None:
+                print(f"Aggregates seeded: {drift}")
+        except Exception as e:
+            print(f"Aggregate seeding failed: {e}")
+        if self.interval <= 0:
+            return
+        while not self._stop_event.wait(self.interval):
+            try:
+                drift = reconcile(self.counters)
+                print(f"Aggregates reconciled, drift: {drift}")
+            except Exception as e:
+                print(f"Aggregate reconcile failed: {e}")
+
+
+if __name__ == "__main__":
+    import firebase_admin
+    from firebase_admin import credentials
+
+    parser = argparse.ArgumentParser(
+        description="Show, seed or reconcile the sharded customer aggregates")
+    parser.add_argument('command', choices=['show', 'seed', 'reconcile'])
+    parser.add_argument('--every', type=float, default=0,
+                        help="keep reconciling every this many seconds")
+    args = parser.parse_args()
+
+    cred_path = os.environ.get("FIREBASE_CREDENTIAL_PATH")
+    if not cred_path:
+        raise ValueError("FIREBASE_CRED_PATH not set in environment variables")
+    firebase_admin.initialize_app(credentials.Certificate(cred_path))
+    counters = AggregateCounters(firestore.client())
+
+    if args.command == 'show':
+        print(counters.read(max_age=0))
+    elif args.command == 'seed':
+        drift = seed(counters)
+        print("Already seeded" if drift is None else f"Seeded: {drift}")
+    else:
+        while True:
+            start = time.perf_counter()
+            print(f"Drift repaired: {reconcile(counters)} "
+                  f"({time.perf_counter() - start:.1f}s)")
+            if args.every <= 0:
+                break
+            time.sleep(args.every)
@@ -0,0 +1,293 @@
+import os
+import threading
+import time
+import cv2
+import face_recognition
+import serial
+from dotenv import load_dotenv
+from tracker import FaceTracker
+from pipeline import BoundedQueue, Stage, PipelineStats
+from emotion_worker import EmotionWorker
+from detection_scheduler import DetectionScheduler
+
+load_dotenv()
+
+# The camera pipeline only: importing this module starts nothing, so camera
+# processes can use it without their own Firestore client or workers.
+
+ARDUINO_PORT = os.getenv('ARDUINO_PORT', 'COM3')
+THRESHOLD_DISTANCE = 100
+
+CAMERA_INDEX = int(os.getenv('CAMERA_INDEX', '0'))
+FRAME_QUEUE_SIZE = int(os.getenv('FRAME_QUEUE_SIZE', '2'))
+RESULT_QUEUE_SIZE = int(os.getenv('RESULT_QUEUE_SIZE', '2'))
+QUEUE_POLICY = os.getenv('PIPELINE_QUEUE_POLICY', 'drop_oldest')
+INFERENCE_WORKERS = int(os.getenv('INFERENCE_WORKERS', '1'))
+STATS_INTERVAL = float(os.getenv('PIPELINE_STATS_INTERVAL', '10'))
+EMOTION_SAMPLE_FRAMES = int(os.getenv('EMOTION_SAMPLE_FRAMES', '10'))
+EMOTION_SAMPLE_MS = int(os.getenv('EMOTION_SAMPLE_MS', '500'))
+EMOTION_BATCH_SIZE = int(os.getenv('EMOTION_BATCH_SIZE', '8'))
+EMOTION_SMOOTHING = float(os.getenv('EMOTION_SMOOTHING', '0.3'))
+EMOTION_MIN_SAMPLES = 3
+EMOTION_SETTLE_SECONDS = 2.0
+CAMERA_IDLE = object()
+
+
+def open_sensor(port=ARDUINO_PORT):
+    sensor = serial.Serial(port, 9600, timeout=1)
+    time.sleep(2)
+    return sensor
+
+
+def get_distance(sensor):
+    try:
+        line_bytes = sensor.readline()
+        if line_bytes:
+            line = line_bytes.decode('utf-8').strip()
+            if line.startswith("distance:"):
+                distance = float(line.split(":")[1])
+                return distance
+    except Exception as e:
+        print("Error reading distance:", e)
+    return None
+
+
+def draw_results(frame, results):
+    for (top, right, bottom, left), name, emotion in results:
+        if name == "Unknown":
+            color = (0, 0, 255)
+        else:
+            color = (0, 255, 0)
+
+        cv2.rectangle(frame, (left, top),
+                      (right, bottom), (0, 255, 0), 2)
+        cv2.putText(frame, name, (left, top - 10),
+                    cv2.FONT_HERSHEY_SIMPLEX, 0.9, color, 2)
+        cv2.putText(frame, emotion, (left, top - 30),
+                    cv2.FONT_HERSHEY_SIMPLEX, 0.9, color, 2)
+
+
+class CameraCapture:
+    def __init__(self, frame_queue, sensor, camera_index=CAMERA_INDEX,
+                 scheduler=None):
+        self.frame_queue = frame_queue
+        self.sensor = sensor
+        self.camera_index = camera_index
+        self.scheduler = scheduler
+        self.cap = None
+
+    def step(self):
+        distance = get_distance(self.sensor)
+        if distance and distance < THRESHOLD_DISTANCE:
+            if self.cap is None:
+                self.cap = cv2.VideoCapture(self.camera_index)
+                print(f"Camera {self.camera_index} Opened")
+            ret, frame = self.cap.read()
+            if not ret:
+                return False
+            now = time.monotonic()
+            self.frame_queue.put((now, frame))
+            if self.scheduler is not None:
+                delay = self.scheduler.capture_delay(now)
+                if delay:
+                    time.sleep(delay)
+            return True
+
+        if self.cap:
+            self.close()
+            self.frame_queue.clear()
+            self.frame_queue.put(CAMERA_IDLE)
+            print(f"Camera {self.camera_index} closed to save power!")
+        return False
+
+    def close(self):
+        if self.cap:
+            self.cap.release()
+            self.cap = None
+
+
+class CameraSession:
+    def __init__(self, matcher, sensor, on_visit, camera_index=CAMERA_INDEX,
+                 on_identified=None,
+                 window_name="Face Recognition", camera_name=None):
+        self.matcher = matcher
+        self.camera_name = camera_name or f"camera-{camera_index}"
+        self.sensor = sensor
+        self.on_visit = on_visit
+        self.on_identified = on_identified
+        self.window_name = window_name
+
+        self.tracker = FaceTracker()
+        self.tracker_lock = threading.Lock()
+        self.scheduler = DetectionScheduler()
+        self.last_locations = []
+        self.last_tracked_at = float('-inf')
+        self.stale_frames = 0
+        self.emotion_worker = EmotionWorker(
+            batch_size=EMOTION_BATCH_SIZE,
+            sample_every_frames=EMOTION_SAMPLE_FRAMES,
+            sample_interval=EMOTION_SAMPLE_MS / 1000.0,
+            alpha=EMOTION_SMOOTHING)
+
+        self.frame_queue = BoundedQueue(
+            'frames', FRAME_QUEUE_SIZE, QUEUE_POLICY)
+        self.result_queue = BoundedQueue(
+            'results', RESULT_QUEUE_SIZE, QUEUE_POLICY)
+        self.stop_event = threading.Event()
+        self.capture = CameraCapture(self.frame_queue, sensor, camera_index,
+                                     scheduler=self.scheduler)
+        self.stages = [Stage('capture', self.capture.step, self.stop_event)]
+        self.stages += [Stage(f'inference-{i}', self.inference_step,
+                              self.stop_event)
+                        for i in range(INFERENCE_WORKERS)]
+        self.stats = PipelineStats([self.frame_queue, self.result_queue],
+                                   self.stages, interval=STATS_INTERVAL,
+                                   scheduler=self.scheduler)
+
+    def swap_matcher(self, matcher):
+        self.matcher = matcher
+
+    def detect_faces(self, frame, track_count, now):
+        scale = self.scheduler.scale
+        small_frame = cv2.resize(frame, (0, 0), fx=scale, fy=scale)
+        rgb = cv2.cvtColor(small_frame, cv2.COLOR_BGR2RGB)
+
+        start = time.perf_counter()
+        small_locations = face_recognition.face_locations(rgb)
+        face_locations = [tuple(int(round(v / scale)) for v in location)
+                          for location in small_locations]
+        self.scheduler.record_detection(time.perf_counter() - start,
+                                        face_locations, track_count, now)
+        return face_locations
+
+    def analyze_frame(self, frame, captured_at=None):
+        now = time.monotonic()
+        with self.tracker_lock:
+            track_count = len(self.tracker)
+            detect = self.scheduler.should_detect(frame, track_count, now)
+
+        if detect:
+            face_locations = self.detect_faces(frame, track_count, now)
+        else:
+            face_locations = self.last_locations
+
+        with self.tracker_lock:
+            # With several inference workers a frame can finish after a newer
+            # one; feeding it to the tracker would associate boxes against
+            # newer state, so it is dropped instead.
+            if captured_at is not None:
+                if captured_at <= self.last_tracked_at:
+                    self.stale_frames += 1
+                    return None
+                self.last_tracked_at = captured_at
+            self.last_locations = face_locations
+            tracks = self.tracker.update(face_locations, now)
+            # Only freshly detected new tracks and tracks due for
+            # re-verification are encoded.
+            pending = [i for i, track in enumerate(tracks)
+                       if detect and self.tracker.needs_identity(track, now)]
+
+        if pending:
+            rgb = cv2.cvtColor(frame, cv2.COLOR_BGR2RGB)
+            face_encodings = face_recognition.face_encodings(
+                rgb, [face_locations[i] for i in pending])
+            matches = self.matcher.match(face_encodings)
+        else:
+            matches = []
+
+        identified = set()
+        with self.tracker_lock:
+            for i, match in zip(pending, matches):
+                if self.tracker.assign_identity(tracks[i], match, now):
+                    identified.add(i)
+
+        faces = []
+        for track, (top, right, bottom, left) in zip(tracks, face_locations):
+            face_image = frame[top:bottom, left:right]
+            faces.append(face_image)
+            if track.known:
+                self.emotion_worker.maybe_submit(
+                    track.track_id, face_image, now)
+
+        # Several inference workers share the tracks, so the pending visit
+        # is claimed under the lock and each visit is recorded only once.
+        results, visits = [], []
+        with self.tracker_lock:
+            for i, (track, face_location) in enumerate(
+                    zip(tracks, face_locations)):
+                if track.known:
+                    track.emotion = self.emotion_worker.dominant(
+                        track.track_id)
+                    if i in identified:
+                        track.visit_pending = True
+
+                    # The visit is recorded once the smoothed emotion has
+                    # settled, so last_emotion and the greetings use it.
+                    settled = self.emotion_worker.sample_count(
+                        track.track_id) >= EMOTION_MIN_SAMPLES or \
+                        now - track.identified_at >= EMOTION_SETTLE_SECONDS
+                    if track.visit_pending and settled:
+                        track.visit_pending = False
+                        visits.append((track.name, faces[i], track.emotion,
+                                       track.distance))
+
+                name = track.name if track.known else "Unknown"
+                emotion = track.emotion if track.known else "Unknown"
+                results.append((tuple(face_location), name, emotion))
+
+        for name, face_image, emotion, distance in visits:
+            # The greeting is requested with the same settled emotion the
+            # visit uses, so the visit worker joins this request instead of
+            # making a second one, and the LLM call overlaps the customer
+            # lookup.
+            if self.on_identified is not None:
+                self.on_identified(name, emotion)
+            self.on_visit(name, face_image, emotion, camera=self.camera_name,
+                          distance=distance)
+        return results
+
+    def inference_step(self):
+        item = self.frame_queue.get(timeout=0.1)
+        if item is None:
+            return False
+        if item is CAMERA_IDLE:
+            self.result_queue.put(CAMERA_IDLE)
+            return True
+
+        captured_at, frame = item
+        results = self.analyze_frame(frame, captured_at)
+        if results is not None:
+            self.result_queue.put((captured_at, frame, results))
+        return True
+
+    def run(self):
+        try:
+            self.emotion_worker.start()
+            for stage in self.stages:
+                stage.start()
+
+            while True:
+                item = self.result_queue.get(timeout=0.05)
+                if item is CAMERA_IDLE:
+                    cv2.destroyAllWindows()
+                elif item is not None:
+                    captured_at, frame, results = item
+                    draw_results(frame, results)
+                    cv2.imshow(self.window_name, frame)
+                    self.stats.record_latency(captured_at)
+
+                self.stats.maybe_report()
+
+                if cv2.waitKey(1) == ord("q"):
+                    break
+
+        finally:
+            self.stop_event.set()
+            self.emotion_worker.stop()
+            for stage in self.stages:
+                stage.join(timeout=2)
+            self.capture.close()
+            cv2.destroyAllWindows()
+            if self.stale_frames:
+                print(f"{self.stale_frames} out-of-order frames skipped "
+                      f"by the tracker")
@@ -0,0 +1,146 @@
+import argparse
+import os
+import platform
+import threading
+from firebase_admin import firestore
+
+
+COUNTERS_COLLECTION = 'counters'
+CUSTOMER_IDS_DOC = 'customer_ids'
+ID_PREFIX = 'CUST'
+ID_WIDTH = 3
+BLOCK_SIZE = int(os.getenv('CUSTOMER_ID_BLOCK_SIZE', '1'))
+
+
+def format_id(number):
+    # Past 999 the IDs simply grow a digit; existing three-digit IDs stay
+    # valid because numbers are parsed, never compared as strings.
+    return f"{ID_PREFIX}{number:0{ID_WIDTH}d}"
+
+
+def parse_id(customer_id):
+    if not customer_id.startswith(ID_PREFIX):
+        return None
+    try:
+        return int(customer_id[len(ID_PREFIX):])
+    except ValueError:
+        return None
+
+
+def counter_ref(db):
+    return db.collection(COUNTERS_COLLECTION).document(CUSTOMER_IDS_DOC)
+
+
+class CounterNotSeeded(Exception):
+    pass
+
+
+@firestore.transactional
+def _reserve(transaction, ref, count, lessee):
+    snapshot = ref.get(transaction=transaction)
+    if not snapshot.exists:
+        raise CounterNotSeeded(f"{ref.path} does not exist")
+    start = snapshot.get('next')
+    transaction.update(ref, {
+        'next': start + count,
+        'last_lessee': lessee,
+        'updated_at': firestore.SERVER_TIMESTAMP,
+    })
+    return start
+
+
+@firestore.transactional
+def _seed(transaction, ref, next_number):
+    snapshot = ref.get(transaction=transaction)
+    current = snapshot.get('next') if snapshot.exists else 0
+    # Never moves the counter backwards, so re-running it is harmless.
+    if next_number > current:
+        transaction.set(ref, {'next': next_number,
+                              'updated_at': firestore.SERVER_TIMESTAMP},
+                        merge=True)
+        return next_number
+    return current
+
+
+def seed(db):
+    # One-time migration: start the counter after the highest existing ID.
+    # Only document references are listed, no customer data is read.
+    highest = 0
+    for ref in db.collection('customers').list_documents():
+        number = parse_id(ref.id)
+        if number is not None and number > highest:
+            highest = number
+    return _seed(db.transaction(), counter_ref(db), highest + 1)
+
+
+class IdAllocator:
+    # Each allocation is a transaction on the counter document, so two
+    # kiosks can never be handed the same ID. With block_size > 1 a kiosk
+    # leases that many IDs at once and hands them out from memory; IDs left
+    # in a block when the kiosk exits are skipped, never reused.
+
+    def __init__(self, db, block_size=BLOCK_SIZE, lessee=None):
+        self.db = db
+        self.block_size = max(1, block_size)
+        self.lessee = lessee or os.getenv('KIOSK_ID') or platform.node()
+        self.leases = 0
+        self._next = 0
+        self._end = 0
+        self._lock = threading.Lock()
+
+    def _lease(self):
+        ref = counter_ref(self.db)
+        try:
+            start = _reserve(self.db.transaction(), ref, self.block_size,
+                             self.lessee)
+        except CounterNotSeeded:
+            print("Customer ID counter not found, seeding it from existing "
+                  "customers...")
+            seed(self.db)
+            start = _reserve(self.db.transaction(), ref, self.block_size,
+                             self.lessee)
+        self._next = start
+        self._end = start + self.block_size
+        self.leases += 1
+
+    def allocate(self):
+        with self._lock:
+            if self._next >= self._end:
+                self._lease()
+            number = self._next
+            self._next += 1
+        return format_id(number)
+
+    def remaining(self):
+        with self._lock:
+            return self._end - self._next
+
+
+if __name__ == "__main__":
+    import firebase_admin
+    from firebase_admin import credentials
+
+    parser = argparse.ArgumentParser(
+        description="Seed, inspect or draw from the customer ID counter")
+    parser.add_argument('command', choices=['seed', 'show', 'allocate'])
+    parser.add_argument('--count', type=int, default=1)
+    args = parser.parse_args()
+
+    cred_path = os.environ.get("FIREBASE_CREDENTIAL_PATH")
+    if not cred_path:
+        raise ValueError("FIREBASE_CRED_PATH not set in environment variables")
+    firebase_admin.initialize_app(credentials.Certificate(cred_path))
+    db = firestore.client()
+
+    if args.command == 'seed':
+        print(f"Next customer ID: {format_id(seed(db))}")
+    elif args.command == 'show':
+        snapshot = counter_ref(db).get()
+        if snapshot.exists:
+            print(f"Next customer ID: {format_id(snapshot.get('next'))}")
+        else:
+            print("Counter not seeded yet, run: customer_ids.py seed")
+    else:
+        allocator = IdAllocator(db, block_size=args.count)
+        for _ in range(args.count):
+            print(allocator.allocate())
@@ -0,0 +1,132 @@
+import os
+import cv2
+import numpy as np
+
+
+CPU_BUDGET = float(os.getenv('DETECTION_CPU_BUDGET', '0.5'))
+BASE_SCALE = 0.25
+MIN_SCALE = 0.125
+MAX_SCALE = 0.5
+TARGET_FACE_PX = 60
+MIN_INTERVAL = 1
+MAX_INTERVAL = 15
+MOTION_THRESHOLD = 8.0
+IDLE_SECONDS = 5.0
+IDLE_FPS = 2.0
+THUMB_SIZE = (64, 48)
+
+
+class DetectionScheduler:
+    def __init__(self, cpu_budget=CPU_BUDGET, base_scale=BASE_SCALE,
+                 min_scale=MIN_SCALE, max_scale=MAX_SCALE,
+                 target_face_px=TARGET_FACE_PX, min_interval=MIN_INTERVAL,
+                 max_interval=MAX_INTERVAL,
+                 motion_threshold=MOTION_THRESHOLD,
+                 idle_seconds=IDLE_SECONDS, idle_fps=IDLE_FPS):
+        self.cpu_budget = cpu_budget
+        self.base_scale = base_scale
+        self.min_scale = min_scale
+        self.max_scale = max_scale
+        self.target_face_px = target_face_px
+        self.min_interval = min_interval
+        self.max_interval = max_interval
+        self.motion_threshold = motion_threshold
+        self.idle_seconds = idle_seconds
+        self.idle_fps = idle_fps
+
+        self.scale = base_scale
+        self.interval = min_interval
+        self.frames_since_detect = max_interval
+        self.detect_cost = None
+        self.frame_period = None
+        self.detections = 0
+        self.skipped = 0
+        self._last_frame_at = None
+        self._last_face_at = None
+        self._previous_thumb = None
+
+    def _ema(self, previous, value, alpha=0.2):
+        return value if previous is None else \
+            alpha * value + (1.0 - alpha) * previous
+
+    def _motion(self, frame):
+        thumb = cv2.resize(cv2.cvtColor(frame, cv2.COLOR_BGR2GRAY),
+                           THUMB_SIZE, interpolation=cv2.INTER_AREA)
+        thumb = thumb.astype(np.int16)
+        previous, self._previous_thumb = self._previous_thumb, thumb
+        if previous is None:
+            return float('inf')
+        return float(np.abs(thumb - previous).mean())
+
+    def should_detect(self, frame, track_count, now):
+        if self._last_frame_at is not None:
+            self.frame_period = self._ema(
+                self.frame_period, now - self._last_frame_at)
+        self._last_frame_at = now
+        if self._last_face_at is None:
+            self._last_face_at = now
+        self.frames_since_detect += 1
+
+        motion = self._motion(frame)
+        if motion > self.motion_threshold:
+            self.interval = max(self.min_interval, self.interval // 2)
+
+        # With nothing tracked every frame is searched; the idle frame rate
+        # keeps that cheap once the entrance has been empty for a while.
+        detect = track_count == 0 or motion > self.motion_threshold or \
+            self.frames_since_detect >= self.interval
+        if not detect:
+            self.skipped += 1
+        return detect
+
+    def record_detection(self, seconds, boxes, track_count, now):
+        self.frames_since_detect = 0
+        self.detections += 1
+        self.detect_cost = self._ema(self.detect_cost, seconds)
+
+        if boxes:
+            self._last_face_at = now
+            smallest = min(min(right - left, bottom - top)
+                           for top, right, bottom, left in boxes)
+            desired = self.target_face_px / max(smallest, 1)
+        else:
+            desired = self.base_scale
+        if len(boxes) > track_count:
+            self.interval = self.min_interval
+
+        load = self.load()
+        if load is not None and load > self.cpu_budget:
+            if self.interval < self.max_interval:
+                self.interval += 1
+            else:
+                desired = min(desired, self.scale * 0.8)
+        elif load is not None and load < 0.5 * self.cpu_budget and \
+                self.interval > self.min_interval:
+            self.interval -= 1
+
+        # Round to coarse steps so the resize target does not jitter.
+        self.scale = min(self.max_scale,
+                         max(self.min_scale, round(desired * 20) / 20))
+
+    def load(self):
+        if self.detect_cost is None or not self.frame_period:
+            return None
+        return self.detect_cost / (self.interval * self.frame_period)
+
+    def idle(self, now):
+        return self._last_face_at is not None and \
+            now - self._last_face_at > self.idle_seconds
+
+    def capture_delay(self, now):
+        return 1.0 / self.idle_fps if self.idle(now) else 0.0
+
+    def stats(self):
+        load = self.load()
+        return {
+            'scale': self.scale,
+            'interval': self.interval,
+            'detections': self.detections,
+            'skipped': self.skipped,
+            'detect_ms': 1000 * self.detect_cost if self.detect_cost else None,
+            'cpu_load': round(load, 3) if load is not None else None,
+        }
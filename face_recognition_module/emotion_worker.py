@@ -0,0 +1,177 @@
+import threading
+import time
+import cv2
+import numpy as np
+from deepface import DeepFace
+from pipeline import BoundedQueue
+
+
+EMOTIONS = ['angry', 'disgust', 'fear', 'happy', 'sad', 'surprise', 'neutral']
+CROP_SIZE = (224, 224)
+BATCH_RETRY_SECONDS = 5.0
+MAX_BATCH_RETRY_SECONDS = 300.0
+
+
+class EmotionWorker(threading.Thread):
+    def __init__(self, batch_size=8, batch_wait=0.05, sample_every_frames=10,
+                 sample_interval=0.5, alpha=0.3, queue_size=32,
+                 state_ttl=30.0):
+        super().__init__(name='emotion', daemon=True)
+        self.batch_size = batch_size
+        self.batch_wait = batch_wait
+        self.sample_every_frames = sample_every_frames
+        self.sample_interval = sample_interval
+        self.alpha = alpha
+        self.state_ttl = state_ttl
+        self.queue = BoundedQueue('emotion', queue_size)
+        self.batching_retry_at = 0.0
+        self.batching_backoff = BATCH_RETRY_SECONDS
+        self.batching_failures = 0
+        self.batches = 0
+        self.samples = 0
+
+        self._lock = threading.Lock()
+        self._stop_event = threading.Event()
+        self._frames_since = {}
+        self._last_submit = {}
+        self._distributions = {}
+        self._sample_counts = {}
+
+    def maybe_submit(self, key, face_image, now=None):
+        if face_image is None or face_image.size == 0:
+            return False
+        now = time.monotonic() if now is None else now
+
+        with self._lock:
+            frames = self._frames_since.get(key, self.sample_every_frames)
+            last = self._last_submit.get(key)
+            due = frames >= self.sample_every_frames or \
+                last is None or now - last >= self.sample_interval
+            if not due:
+                self._frames_since[key] = frames + 1
+                return False
+            self._frames_since[key] = 1
+            self._last_submit[key] = now
+
+        crop = cv2.resize(face_image, CROP_SIZE)
+        self.queue.put((key, crop))
+        return True
+
+    def dominant(self, key):
+        with self._lock:
+            distribution = self._distributions.get(key)
+        if distribution is None:
+            return "Unknown"
+        return EMOTIONS[int(np.argmax(distribution))]
+
+    def distribution(self, key):
+        with self._lock:
+            distribution = self._distributions.get(key)
+        if distribution is None:
+            return None
+        return dict(zip(EMOTIONS, distribution.tolist()))
+
+    def sample_count(self, key):
+        with self._lock:
+            return self._sample_counts.get(key, 0)
+
+    def stop(self):
+        self._stop_event.set()
+
+    def run(self):
+        while not self._stop_event.is_set():
+            item = self.queue.get(timeout=0.2)
+            if item is None:
+                self._prune()
+                continue
+
+            batch = [item]
+            deadline = time.monotonic() + self.batch_wait
+            while len(batch) < self.batch_size:
+                remaining = deadline - time.monotonic()
+                if remaining <= 0:
+                    break
+                item = self.queue.get(timeout=remaining)
+                if item is None:
+                    break
+                batch.append(item)
+
+            keys = [key for key, _ in batch]
+            crops = [crop for _, crop in batch]
+            try:
+                distributions = self._analyze(crops)
+            except Exception as e:
+                print(f"Emotion detection failed: {e}")
+                self._prune()
+                continue
+
+            with self._lock:
+                for key, distribution in zip(keys, distributions):
+                    if distribution is None:
+                        continue
+                    previous = self._distributions.get(key)
+                    if previous is None:
+                        smoothed = distribution
+                    else:
+                        smoothed = self.alpha * distribution + \
+                            (1.0 - self.alpha) * previous
+                    self._distributions[key] = smoothed
+                    self._sample_counts[key] = self._sample_counts.get(
+                        key, 0) + 1
+            self.batches += 1
+            self.samples += len(batch)
+            # Tracks that left the scene are forgotten even when the queue
+            # never goes idle.
+            self._prune()
+
+    def _analyze(self, crops):
+        if len(crops) > 1 and time.monotonic() >= self.batching_retry_at:
+            error = "unexpected result shape"
+            try:
+                results = DeepFace.analyze(
+                    np.stack(crops), actions=['emotion'],
+                    detector_backend='skip', enforce_detection=False,
+                    silent=True)
+                if len(results) == len(crops) and \
+                        all(isinstance(r, list) for r in results):
+                    self.batching_backoff = BATCH_RETRY_SECONDS
+                    return [_to_distribution(r[0]) for r in results]
+            except Exception as e:
+                error = e
+            # A failed batch falls back to single crops for a while, then
+            # batching is tried again with a growing backoff.
+            self.batching_failures += 1
+            self.batching_retry_at = time.monotonic() + self.batching_backoff
+            print(f"Batched emotion analysis failed ({error}), using single "
+                  f"crops for {self.batching_backoff:.0f}s")
+            self.batching_backoff = min(MAX_BATCH_RETRY_SECONDS,
+                                        self.batching_backoff * 2)
+
+        distributions = []
+        for crop in crops:
+            results = DeepFace.analyze(
+                crop, actions=['emotion'], detector_backend='skip',
+                enforce_detection=False, silent=True)
+            distributions.append(_to_distribution(results[0]))
+        return distributions
+
+    def _prune(self):
+        now = time.monotonic()
+        with self._lock:
+            stale = [key for key, last in self._last_submit.items()
+                     if now - last > self.state_ttl]
+            for key in stale:
+                for state in (self._frames_since, self._last_submit,
+                              self._distributions, self._sample_counts):
+                    state.pop(key, None)
+
+
+def _to_distribution(analysis):
+    scores = analysis.get('emotion') if analysis else None
+    if not scores:
+        return None
+    distribution = np.array([float(scores.get(e, 0.0)) for e in EMOTIONS])
+    total = distribution.sum()
+    if total <= 0:
+        return None
+    return distribution / total
@@ -0,0 +1,197 @@
+import argparse
+import os
+import time
+import numpy as np
+
+
+FORMAT_VERSION = 1
+PACKED_FIELD = 'encodings_packed'
+LEGACY_FIELD = 'encodings'
+ENCODING_DIM = 128
+MODEL_TAG = 'dlib_resnet_v1'
+STORAGE_DTYPE = os.getenv('ENCODING_DTYPE', 'float32')
+# 'packed' writes only the blob; 'both' also writes the flat list, for while
+# older readers are still deployed.
+WRITE_FORMAT = os.getenv('ENCODING_WRITE_FORMAT', 'packed')
+DTYPES = {'float32': '<f4', 'float16': '<f2'}
+MIGRATION_BATCH = 200
+
+
+class UnsupportedEncodingFormat(ValueError):
+    pass
+
+
+def pack_encodings(encodings, dtype=STORAGE_DTYPE, model=MODEL_TAG):
+    rows = np.asarray(encodings, dtype=np.float32).reshape(-1, ENCODING_DIM)
+    return {
+        'version': FORMAT_VERSION,
+        'dtype': dtype,
+        'count': len(rows),
+        'dim': ENCODING_DIM,
+        'model': model,
+        'data': rows.astype(DTYPES[dtype]).tobytes(),
+    }
+
+
+def unpack_encodings(packed):
+    if packed.get('version') != FORMAT_VERSION:
+        raise UnsupportedEncodingFormat(
+            f"encoding format version {packed.get('version')}")
+    if packed.get('dtype') not in DTYPES:
+        raise UnsupportedEncodingFormat(f"encoding dtype {packed.get('dtype')}")
+    rows = np.frombuffer(packed['data'], dtype=DTYPES[packed['dtype']])
+    return rows.astype(np.float32).reshape(
+        packed.get('count', -1), packed.get('dim', ENCODING_DIM))
+
+
+def stored_encodings(data):
+    # Either representation, whichever the document has; the packed one wins
+    # when a document carries both during a rollout.
+    packed = data.get(PACKED_FIELD)
+    if packed:
+        return packed
+    return data.get(LEGACY_FIELD)
+
+
+def encoding_fields(encodings, write_format=WRITE_FORMAT):
+    fields = {}
+    if write_format in ('packed', 'both'):
+        fields[PACKED_FIELD] = pack_encodings(encodings)
+    if write_format in ('legacy', 'both'):
+        fields[LEGACY_FIELD] = [float(value) for value in
+                                np.asarray(encodings, dtype=np.float64).ravel()]
+    return fields
+
+
+def firestore_size(value):
+    # Storage size as Firestore counts it: 8 bytes per number, string and
+    # bytes length (+1 for strings), map keys as strings.
+    if isinstance(value, dict):
+        return sum(len(key) + 1 + firestore_size(item)
+                   for key, item in value.items())
+    if isinstance(value, (list, tuple)):
+        return sum(firestore_size(item) for item in value)
+    if isinstance(value, bytes):
+        return len(value)
+    if isinstance(value, str):
+        return len(value.encode('utf-8')) + 1
+    return 8
+
+
+def migrate(db, dtype=STORAGE_DTYPE, batch_size=MIGRATION_BATCH,
+            dry_run=False, keep_legacy=False):
+    # Pages through customers by document id and rewrites those still on the
+    # flat list, one batched commit per page. updated_at is bumped so gallery
+    # snapshots and listeners pick up the rewritten documents.
+    from firebase_admin import firestore
+
+    counters = {'scanned': 0, 'migrated': 0, 'already_packed': 0,
+                'no_encodings': 0, 'bytes_before': 0, 'bytes_after': 0}
+    customers = db.collection('customers')
+    last = None
+    while True:
+        query = customers.select([LEGACY_FIELD, PACKED_FIELD]).order_by(
+            firestore.FieldPath.document_id()).limit(batch_size)
+        if last is not None:
+            query = query.start_after(last)
+        docs = list(query.stream())
+        if not docs:
+            break
+        last = docs[-1]
+
+        batch = db.batch()
+        writes = 0
+        for doc in docs:
+            counters['scanned'] += 1
+            data = doc.to_dict() or {}
+            if data.get(PACKED_FIELD):
+                counters['already_packed'] += 1
+                continue
+            legacy = data.get(LEGACY_FIELD)
+            if not legacy or len(legacy) % ENCODING_DIM:
+                counters['no_encodings'] += 1
+                continue
+
+            fields = {PACKED_FIELD: pack_encodings(legacy, dtype=dtype),
+                      'updated_at': firestore.SERVER_TIMESTAMP}
+            if not keep_legacy:
+                fields[LEGACY_FIELD] = firestore.DELETE_FIELD
+            counters['bytes_before'] += firestore_size({LEGACY_FIELD: legacy})
+            counters['bytes_after'] += firestore_size(
+                {PACKED_FIELD: fields[PACKED_FIELD]}) + \
+                (firestore_size({LEGACY_FIELD: legacy}) if keep_legacy else 0)
+            batch.update(doc.reference, fields)
+            writes += 1
+
+        if writes and not dry_run:
+            batch.commit()
+        counters['migrated'] += writes
+        print(f"{counters['scanned']} scanned, {counters['migrated']} "
+              f"{'to migrate' if dry_run else 'migrated'}")
+    return counters
+
+
+def benchmark(customers=2000, samples=10, dtype=STORAGE_DTYPE):
+    # Local measurement of document size and decode time for both formats
+    # with random encodings shaped like real ones.
+    rng = np.random.default_rng(0)
+    matrices = [rng.normal(0, 0.09, (samples, ENCODING_DIM))
+                for _ in range(customers)]
+    legacy = [m.ravel().tolist() for m in matrices]
+    packed = [pack_encodings(m, dtype=dtype) for m in matrices]
+
+    start = time.perf_counter()
+    for values in legacy:
+        np.asarray(values, dtype=np.float32).reshape(-1, ENCODING_DIM)
+    legacy_seconds = time.perf_counter() - start
+
+    start = time.perf_counter()
+    for value in packed:
+        unpack_encodings(value)
+    packed_seconds = time.perf_counter() - start
+
+    error = max(float(np.abs(unpack_encodings(p) - m).max())
+                for p, m in zip(packed[:100], matrices[:100]))
+    return {
+        'legacy_bytes': firestore_size({LEGACY_FIELD: legacy[0]}),
+        'packed_bytes': firestore_size({PACKED_FIELD: packed[0]}),
+        'legacy_decode_us': 1e6 * legacy_seconds / customers,
+        'packed_decode_us': 1e6 * packed_seconds / customers,
+        'max_abs_error': error,
+    }
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(
+        description="Migrate customer encodings to the packed format, or "
+                    "measure the two formats")
+    parser.add_argument('command', choices=['migrate', 'benchmark'])
+    parser.add_argument('--dtype', choices=sorted(DTYPES),
+                        default=STORAGE_DTYPE)
+    parser.add_argument('--batch-size', type=int, default=MIGRATION_BATCH)
+    parser.add_argument('--dry-run', action='store_true')
+    parser.add_argument('--keep-legacy', action='store_true',
+                        help="leave the flat list in place for old readers")
+    parser.add_argument('--customers', type=int, default=2000)
+    args = parser.parse_args()
+
+    if args.command == 'benchmark':
+        result = benchmark(args.customers, dtype=args.dtype)
+        print(f"Per customer (10 samples): {result['legacy_bytes']} bytes as "
+              f"a list vs {result['packed_bytes']} packed as {args.dtype}; "
+              f"decode {result['legacy_decode_us']:.0f}us vs "
+              f"{result['packed_decode_us']:.1f}us; "
+              f"max abs error {result['max_abs_error']:.2e}")
+    else:
+        import firebase_admin
+        from firebase_admin import credentials, firestore
+
+        cred_path = os.environ.get("FIREBASE_CREDENTIAL_PATH")
+        if not cred_path:
+            raise ValueError("FIREBASE_CRED_PATH not set in environment variables")
+        firebase_admin.initialize_app(credentials.Certificate(cred_path))
+        start = time.perf_counter()
+        counters = migrate(firestore.client(), dtype=args.dtype,
+                           batch_size=min(args.batch_size, 500),
+                           dry_run=args.dry_run, keep_legacy=args.keep_legacy)
+        print(f"Done in {time.perf_counter() - start:.1f}s: {counters}")
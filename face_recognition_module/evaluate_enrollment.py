@@ -0,0 +1,155 @@
+import argparse
+import os
+import time
+import cv2
+import face_recognition
+import numpy as np
+from gallery import GalleryMatcher
+from sample_selector import (Candidate, SampleSelector, candidate_from_frame,
+                             ENROLL_SAMPLES)
+
+
+BASELINE_SAMPLES = 10
+MATCH_TOLERANCE = 0.5
+SYNTHETIC_FRAMES = 90
+
+
+def largest_face(frame):
+    rgb = cv2.cvtColor(frame, cv2.COLOR_BGR2RGB)
+    locations = face_recognition.face_locations(rgb)
+    if not locations:
+        return None
+    return max(locations, key=lambda l: (l[1] - l[3]) * (l[2] - l[0]))
+
+
+def load_person(directory, enroll_frames):
+    # Frames are taken in filename order: the first enroll_frames stand in
+    # for the kiosk capture, the rest are held out as the test set.
+    filenames = sorted(f for f in os.listdir(directory)
+                       if f.lower().endswith(('.jpg', '.jpeg', '.png')))
+    enroll, test = [], []
+    for i, filename in enumerate(filenames):
+        frame = cv2.imread(os.path.join(directory, filename))
+        if frame is None:
+            continue
+        location = largest_face(frame)
+        if location is None:
+            continue
+        candidate = candidate_from_frame(frame, location)
+        (enroll if i < enroll_frames else test).append(candidate)
+    return enroll, test
+
+
+def synthetic_person(rng, enroll_frames, frames=SYNTHETIC_FRAMES, drift=0.006):
+    # Stand-in for a capture without a camera: the encoding random-walks
+    # away from the person's centre (pose and lighting drifting over the
+    # session) with per-frame noise, and a fifth of the frames are blurry.
+    centre = rng.normal(size=128) * 0.09
+    walk = np.cumsum(rng.normal(size=(frames, 128)) * drift, axis=0)
+    sequence = [Candidate(centre + walk[i] + rng.normal(size=128) * 0.006,
+                          rng.choice([20, 200], p=[0.2, 0.8]), 150, 0.0)
+                for i in range(frames)]
+    return sequence[:enroll_frames], sequence[enroll_frames:]
+
+
+def baseline_samples(candidates):
+    # What register_customer used to keep: the first frames with the face.
+    return candidates[:BASELINE_SAMPLES]
+
+
+def selected_samples(candidates, k):
+    selector = SampleSelector(k)
+    for candidate in candidates:
+        if selector.full:
+            break
+        selector.offer(candidate)
+    return selector.select()
+
+
+def build_matcher(enrolled):
+    blocks, labels, names = [], [], []
+    for name, samples in enrolled.items():
+        if not samples:
+            continue
+        labels.append(np.full(len(samples), len(names), dtype=np.int32))
+        names.append(name)
+        blocks.append(np.stack([s.encoding for s in samples]))
+    return GalleryMatcher(np.concatenate(blocks), np.concatenate(labels),
+                          names, tolerance=MATCH_TOLERANCE, index='exact')
+
+
+def evaluate(matcher, test_sets):
+    names, queries = [], []
+    for name, candidates in test_sets.items():
+        names.extend([name] * len(candidates))
+        queries.extend(c.encoding for c in candidates)
+    if not queries:
+        return None
+
+    start = time.perf_counter()
+    matches = matcher.match(queries)
+    seconds = time.perf_counter() - start
+
+    correct = sum(m.known and m.name == name for m, name in zip(matches, names))
+    rejected = sum(not m.known for m in matches)
+    return {
+        'gallery_rows': len(matcher),
+        'queries': len(queries),
+        'accuracy': correct / len(queries),
+        'rejected': rejected / len(queries),
+        'wrong_person': (len(queries) - correct - rejected) / len(queries),
+        'us_per_query': 1e6 * seconds / len(queries),
+    }
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(
+        description="Compare first-N enrollment with quality/diversity sample "
+                    "selection on a folder of per-person frame sequences")
+    parser.add_argument('dataset', nargs='?',
+                        help="directory with one folder of frames per person, "
+                             "in capture order")
+    parser.add_argument('--enroll-frames', type=int, default=30)
+    parser.add_argument('-k', type=int, default=ENROLL_SAMPLES)
+    parser.add_argument('--synthetic', type=int, metavar='PEOPLE',
+                        help="use drifting random encodings for this many "
+                             "people instead of a dataset")
+    parser.add_argument('--drift', type=float, default=0.006)
+    parser.add_argument('--seed', type=int, default=1)
+    args = parser.parse_args()
+    if (args.dataset is None) == (args.synthetic is None):
+        parser.error("give either a dataset or --synthetic")
+
+    if args.synthetic:
+        rng = np.random.default_rng(args.seed)
+        people = ((f"person_{i}", synthetic_person(rng, args.enroll_frames,
+                                                   drift=args.drift))
+                  for i in range(args.synthetic))
+    else:
+        people = ((name, load_person(os.path.join(args.dataset, name),
+                                     args.enroll_frames))
+                  for name in sorted(os.listdir(args.dataset))
+                  if os.path.isdir(os.path.join(args.dataset, name)))
+
+    baseline, selected, test_sets = {}, {}, {}
+    for name, (enroll, test) in people:
+        if not enroll or not test:
+            print(f"Skipping {name}: {len(enroll)} enrollment and "
+                  f"{len(test)} test frames with a face")
+            continue
+        baseline[name] = baseline_samples(enroll)
+        selected[name] = selected_samples(enroll, args.k)
+        test_sets[name] = test
+
+    if not test_sets:
+        raise SystemExit("No usable people in the dataset")
+
+    print(f"{len(test_sets)} people")
+    for label, enrolled in ((f"first {BASELINE_SAMPLES}", baseline),
+                            (f"selected k={args.k}", selected)):
+        result = evaluate(build_matcher(enrolled), test_sets)
+        print(f"{label:>14}: {result['gallery_rows']} gallery rows, "
+              f"accuracy {result['accuracy']:.1%} on {result['queries']} "
+              f"test frames (rejected {result['rejected']:.1%}, wrong person "
+              f"{result['wrong_person']:.1%}), "
+              f"{result['us_per_query']:.0f}us per query")
@@ -0,0 +1,235 @@
+import argparse
+import time
+import numpy as np
+
+
+def _row_norms(matrix):
+    return np.einsum('ij,ij->i', matrix, matrix)
+
+
+def _squared_distances(queries, matrix, matrix_norms):
+    squared = _row_norms(queries)[:, None] + matrix_norms[None, :] - \
+        2.0 * (queries @ matrix.T)
+    np.maximum(squared, 0.0, out=squared)
+    return squared
+
+
+def _segment_starts(labels):
+    if not len(labels):
+        return np.empty(0, dtype=np.intp)
+    starts = np.flatnonzero(np.diff(labels)) + 1
+    return np.concatenate(([0], starts)).astype(np.intp)
+
+
+def _top_k(row_distances, row_labels, k):
+    k = min(k, len(row_distances))
+    if k == 0:
+        return [], []
+    best = np.argpartition(row_distances, k - 1)[:k]
+    best = best[np.argsort(row_distances[best])]
+    return row_labels[best].tolist(), row_distances[best].tolist()
+
+
+class ExactIndex:
+    name = 'exact'
+
+    def __init__(self, matrix, labels):
+        self.matrix = matrix
+        self.labels = labels
+        self.norms = _row_norms(matrix)
+        self.starts = _segment_starts(labels)
+        self.start_labels = labels[self.starts]
+
+    def search(self, queries, k=2):
+        if not len(self.matrix):
+            return [([], []) for _ in range(len(queries))]
+
+        squared = _squared_distances(queries, self.matrix, self.norms)
+        per_customer = np.sqrt(np.minimum.reduceat(
+            squared, self.starts, axis=1))
+        return [_top_k(row, self.start_labels, k) for row in per_customer]
+
+
+class IVFIndex:
+    name = 'ivf'
+
+    def __init__(self, matrix, labels, n_lists=64, n_probe=4,
+                 n_iter=20, seed=0):
+        self.matrix = matrix
+        self.labels = labels
+        self.norms = _row_norms(matrix)
+        self.n_probe = n_probe
+
+        starts = _segment_starts(labels)
+        customer_labels = labels[starts]
+        if len(starts):
+            sizes = np.diff(np.append(starts, len(labels)))
+            centroids = np.add.reduceat(matrix, starts, axis=0) / \
+                sizes[:, None].astype(np.float32)
+        else:
+            sizes = np.empty(0, dtype=np.intp)
+            centroids = np.empty((0, matrix.shape[1]), dtype=np.float32)
+
+        self.n_lists = max(1, min(n_lists, len(centroids)))
+        self.list_centroids, assignment = kmeans(
+            centroids, self.n_lists, n_iter=n_iter, seed=seed)
+        self.list_centroid_norms = _row_norms(self.list_centroids)
+
+        # Every customer lives in exactly one list, so a list's rows stay
+        # grouped by label and can be reduced to per-customer minimums.
+        self.list_rows = []
+        self.list_starts = []
+        self.list_labels = []
+        for list_id in range(self.n_lists):
+            members = np.flatnonzero(assignment == list_id)
+            rows = [np.arange(starts[m], starts[m] + sizes[m])
+                    for m in members]
+            rows = np.concatenate(rows) if rows else \
+                np.empty(0, dtype=np.intp)
+            self.list_rows.append(rows)
+            self.list_starts.append(_segment_starts(labels[rows]))
+            self.list_labels.append(customer_labels[members])
+
+    def search(self, queries, k=2):
+        if not len(self.matrix):
+            return [([], []) for _ in range(len(queries))]
+
+        n_probe = min(self.n_probe, self.n_lists)
+        list_distances = _squared_distances(
+            queries, self.list_centroids, self.list_centroid_norms)
+        probes = np.argpartition(list_distances, n_probe - 1,
+                                 axis=1)[:, :n_probe]
+
+        results = []
+        for query, query_probes in zip(queries, probes):
+            rows = []
+            segment_starts = []
+            candidate_labels = []
+            offset = 0
+            for list_id in query_probes:
+                list_rows = self.list_rows[list_id]
+                if not len(list_rows):
+                    continue
+                rows.append(list_rows)
+                segment_starts.append(self.list_starts[list_id] + offset)
+                candidate_labels.append(self.list_labels[list_id])
+                offset += len(list_rows)
+
+            if not rows:
+                results.append(([], []))
+                continue
+
+            rows = np.concatenate(rows)
+            squared = _squared_distances(
+                query[None, :], self.matrix[rows], self.norms[rows])[0]
+            per_customer = np.sqrt(np.minimum.reduceat(
+                squared, np.concatenate(segment_starts)))
+            results.append(_top_k(per_customer,
+                                  np.concatenate(candidate_labels), k))
+        return results
+
+
+INDEX_TYPES = {
+    ExactIndex.name: ExactIndex,
+    IVFIndex.name: IVFIndex,
+}
+
+
+def make_index(kind, matrix, labels, **params):
+    if kind not in INDEX_TYPES:
+        raise ValueError(f"Unknown gallery index type: {kind}")
+    return INDEX_TYPES[kind](matrix, labels, **params)
+
+
+def kmeans(points, n_clusters, n_iter=20, seed=0):
+    rng = np.random.default_rng(seed)
+    if not len(points):
+        return np.empty((0, points.shape[1]), dtype=np.float32), \
+            np.empty(0, dtype=np.intp)
+
+    centers = points[rng.choice(len(points), n_clusters,
+                                replace=False)].copy()
+    assignment = np.zeros(len(points), dtype=np.intp)
+    for _ in range(n_iter):
+        squared = _squared_distances(points, centers, _row_norms(centers))
+        new_assignment = squared.argmin(axis=1)
+
+        counts = np.bincount(new_assignment, minlength=n_clusters)
+        sums = np.zeros_like(centers)
+        np.add.at(sums, new_assignment, points)
+        filled = counts > 0
+        centers[filled] = sums[filled] / counts[filled, None]
+
+        # Reseed empty clusters with the points farthest from their center.
+        empty = np.flatnonzero(~filled)
+        if len(empty):
+            farthest = np.argsort(
+                squared[np.arange(len(points)), new_assignment])[::-1]
+            centers[empty] = points[farthest[:len(empty)]]
+
+        if np.array_equal(new_assignment, assignment) and not len(empty):
+            break
+        assignment = new_assignment
+    return centers.astype(np.float32), assignment
+
+
+def recall_benchmark(matrix, labels, index, n_queries=1000, noise=0.02,
+                     seed=0):
+    rng = np.random.default_rng(seed)
+    picks = rng.integers(0, len(matrix), n_queries)
+    queries = matrix[picks] + rng.normal(
+        0.0, noise, (n_queries, matrix.shape[1])).astype(np.float32)
+
+    exact = ExactIndex(matrix, labels)
+    start = time.perf_counter()
+    truth = exact.search(queries, k=1)
+    exact_seconds = time.perf_counter() - start
+
+    start = time.perf_counter()
+    approx = index.search(queries, k=1)
+    index_seconds = time.perf_counter() - start
+
+    hits = sum(1 for (t, _), (a, _) in zip(truth, approx)
+               if a and t[0] == a[0])
+    return {
+        'recall_at_1': hits / n_queries,
+        'exact_ms_per_query': 1000.0 * exact_seconds / n_queries,
+        'index_ms_per_query': 1000.0 * index_seconds / n_queries,
+    }
+
+
+def synthetic_gallery(n_customers, samples_per_customer, spread=0.04,
+                      seed=0):
+    rng = np.random.default_rng(seed)
+    centers = rng.normal(0.0, 1.0, (n_customers, 128)).astype(np.float32)
+    centers /= np.linalg.norm(centers, axis=1, keepdims=True)
+    matrix = np.repeat(centers, samples_per_customer, axis=0) + rng.normal(
+        0.0, spread, (n_customers * samples_per_customer, 128)
+    ).astype(np.float32)
+    labels = np.repeat(np.arange(n_customers, dtype=np.int32),
+                       samples_per_customer)
+    return matrix.astype(np.float32), labels
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(
+        description="Recall/latency benchmark of the IVF gallery index against exact search")
+    parser.add_argument('--customers', type=int, default=20000)
+    parser.add_argument('--samples', type=int, default=10)
+    parser.add_argument('--queries', type=int, default=1000)
+    parser.add_argument('--lists', type=int, default=256)
+    parser.add_argument('--probe', type=int, nargs='+', default=[1, 4, 8, 16])
+    args = parser.parse_args()
+
+    matrix, labels = synthetic_gallery(args.customers, args.samples)
+    for n_probe in args.probe:
+        start = time.perf_counter()
+        index = IVFIndex(matrix, labels, n_lists=args.lists, n_probe=n_probe)
+        build_seconds = time.perf_counter() - start
+        result = recall_benchmark(matrix, labels, index,
+                                  n_queries=args.queries)
+        print(f"lists={args.lists} probe={n_probe} "
+              f"build={build_seconds:.2f}s "
+              f"recall@1={result['recall_at_1']:.4f} "
+              f"exact={result['exact_ms_per_query']:.3f}ms/query "
+              f"ivf={result['index_ms_per_query']:.3f}ms/query")
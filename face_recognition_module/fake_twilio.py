@@ -0,0 +1,113 @@
+import argparse
+import json
+import random
+import re
+import threading
+import time
+import urllib.parse
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+
+
+MESSAGES_PATH = re.compile(r"^/2010-04-01/Accounts/([^/]+)/Messages\.json$")
+
+
+class FakeTwilioHandler(BaseHTTPRequestHandler):
+    latency = 0.2
+    fail_rate = 0.0
+    max_rate = 0.0
+    received = []
+    window = []
+    lock = threading.Lock()
+
+    def _throttled(self):
+        if not self.max_rate:
+            return False
+        now = time.monotonic()
+        with self.lock:
+            self.window[:] = [t for t in self.window if now - t < 1.0]
+            if len(self.window) >= self.max_rate:
+                return True
+            self.window.append(now)
+        return False
+
+    def _reply(self, status, body):
+        payload = json.dumps(body).encode('utf-8')
+        self.send_response(status)
+        self.send_header('Content-Type', 'application/json')
+        self.send_header('Content-Length', str(len(payload)))
+        self.end_headers()
+        self.wfile.write(payload)
+
+    def do_POST(self):
+        match = MESSAGES_PATH.match(self.path)
+        if not match:
+            self.send_error(404)
+            return
+
+        length = int(self.headers.get('Content-Length', 0))
+        form = urllib.parse.parse_qs(self.rfile.read(length).decode('utf-8'))
+        form = {key: values[0] for key, values in form.items()}
+
+        time.sleep(max(0.0, self.latency))
+        if self._throttled():
+            self._reply(429, {'code': 20429, 'message': 'Too Many Requests'})
+            return
+        if random.random() < self.fail_rate:
+            self._reply(503, {'code': 20503, 'message': 'Service Unavailable'})
+            return
+        if not form.get('To', '').startswith('whatsapp:+'):
+            self._reply(400, {'code': 21211,
+                              'message': f"Invalid 'To' Phone Number: {form.get('To')}"})
+            return
+
+        sid = f"SM{time.time_ns():032x}"[:34]
+        with self.lock:
+            self.received.append({'sid': sid, 'to': form['To'],
+                                  'body': form.get('Body', '')})
+        self._reply(201, {'sid': sid, 'account_sid': match.group(1),
+                          'to': form['To'], 'from': form.get('From'),
+                          'body': form.get('Body', ''), 'status': 'queued'})
+
+    def do_GET(self):
+        # Not part of the Twilio API; lets a test see what was delivered.
+        if self.path.rstrip('/') != '/received':
+            self.send_error(404)
+            return
+        with self.lock:
+            received = list(self.received)
+        self._reply(200, {'count': len(received), 'messages': received})
+
+    def log_message(self, format, *args):
+        pass
+
+
+def serve(host='127.0.0.1', port=8090, latency=0.2, fail_rate=0.0,
+          max_rate=0.0):
+    FakeTwilioHandler.latency = latency
+    FakeTwilioHandler.fail_rate = fail_rate
+    FakeTwilioHandler.max_rate = max_rate
+    server = ThreadingHTTPServer((host, port), FakeTwilioHandler)
+    server.daemon_threads = True
+    return server
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(
+        description="Local stand-in for the Twilio Messages API")
+    parser.add_argument('--host', default='127.0.0.1')
+    parser.add_argument('--port', type=int, default=8090)
+    parser.add_argument('--latency', type=float, default=0.2)
+    parser.add_argument('--fail-rate', type=float, default=0.0)
+    parser.add_argument('--max-rate', type=float, default=0.0,
+                        help="answer 429 above this many messages per second")
+    args = parser.parse_args()
+
+    server = serve(args.host, args.port, args.latency, args.fail_rate,
+                   args.max_rate)
+    print(f"Fake Twilio listening on http://{args.host}:{args.port} "
+          f"(set TWILIO_API_BASE to this address)")
+    try:
+        server.serve_forever()
+    except KeyboardInterrupt:
+        pass
+    print(f"{len(FakeTwilioHandler.received)} messages received")
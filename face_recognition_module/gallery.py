@@ -0,0 +1,154 @@
+import os
+import numpy as np
+from collections import namedtuple
+from multiprocessing import shared_memory
+from face_index import make_index
+from encoding_format import unpack_encodings
+
+
+ENCODING_SIZE = 128
+MATCH_TOLERANCE = 0.6
+GALLERY_INDEX = os.getenv('GALLERY_INDEX', 'exact')
+IVF_LISTS = int(os.getenv('GALLERY_IVF_LISTS', '64'))
+IVF_PROBE = int(os.getenv('GALLERY_IVF_PROBE', '4'))
+
+Match = namedtuple('Match', ['name', 'label', 'distance', 'margin', 'known'])
+
+
+def parse_encodings(encodings):
+    if isinstance(encodings, dict):
+        try:
+            return unpack_encodings(encodings)
+        except (ValueError, KeyError) as e:
+            print(f"Unreadable packed encodings: {e}")
+            return np.empty((0, ENCODING_SIZE), dtype=np.float32)
+    flat = np.asarray(encodings if encodings is not None else [],
+                      dtype=np.float32).ravel()
+    if flat.size == 0 or flat.size % ENCODING_SIZE != 0:
+        return np.empty((0, ENCODING_SIZE), dtype=np.float32)
+    return flat.reshape(-1, ENCODING_SIZE)
+
+
+def default_index_params(kind):
+    if kind == 'ivf':
+        return {'n_lists': IVF_LISTS, 'n_probe': IVF_PROBE}
+    return {}
+
+
+class GalleryMatcher:
+    def __init__(self, matrix, labels, names, tolerance=MATCH_TOLERANCE,
+                 index=None, index_params=None):
+        self.matrix = np.ascontiguousarray(matrix, dtype=np.float32)
+        self.labels = np.ascontiguousarray(labels, dtype=np.int32)
+        self.names = list(names)
+        self.tolerance = tolerance
+        self.norms = np.einsum('ij,ij->i', self.matrix, self.matrix)
+
+        kind = index or GALLERY_INDEX
+        if index_params is None:
+            index_params = default_index_params(kind)
+        self.index = make_index(kind, self.matrix, self.labels,
+                                **index_params)
+
+    @classmethod
+    def from_customers(cls, customers, tolerance=MATCH_TOLERANCE,
+                       index=None, index_params=None):
+        blocks = []
+        labels = []
+        names = []
+        for name, encodings in customers:
+            rows = parse_encodings(encodings)
+            if not len(rows):
+                print(f"Skipping {name}: invalid encodings")
+                continue
+            label = len(names)
+            names.append(name)
+            blocks.append(rows)
+            labels.append(np.full(len(rows), label, dtype=np.int32))
+
+        if blocks:
+            matrix = np.concatenate(blocks)
+            labels = np.concatenate(labels)
+        else:
+            matrix = np.empty((0, ENCODING_SIZE), dtype=np.float32)
+            labels = np.empty(0, dtype=np.int32)
+        return cls(matrix, labels, names, tolerance=tolerance,
+                   index=index, index_params=index_params)
+
+    def __len__(self):
+        return len(self.matrix)
+
+    @property
+    def customer_count(self):
+        return len(self.names)
+
+    def distances(self, face_encodings):
+        queries = np.asarray(face_encodings, dtype=np.float32).reshape(
+            -1, ENCODING_SIZE)
+        query_norms = np.einsum('ij,ij->i', queries, queries)
+        squared = query_norms[:, None] + self.norms[None, :] - \
+            2.0 * (queries @ self.matrix.T)
+        np.maximum(squared, 0.0, out=squared)
+        return np.sqrt(squared, out=squared)
+
+    def match(self, face_encodings):
+        if len(face_encodings) == 0:
+            return []
+        queries = np.asarray(face_encodings, dtype=np.float32).reshape(
+            -1, ENCODING_SIZE)
+
+        results = []
+        for labels, distances in self.index.search(queries, k=2):
+            if not labels:
+                results.append(Match(None, -1, float('inf'), 0.0, False))
+                continue
+
+            label = int(labels[0])
+            distance = float(distances[0])
+            margin = float(distances[1] - distance) if len(distances) > 1 \
+                else float('inf')
+            results.append(Match(self.names[label], label, distance, margin,
+                                 distance <= self.tolerance))
+        return results
+
+
+def _to_shared(array):
+    handle = shared_memory.SharedMemory(create=True, size=max(array.nbytes, 1))
+    shared = np.ndarray(array.shape, dtype=array.dtype, buffer=handle.buf)
+    shared[...] = array
+    return handle, (handle.name, array.shape, array.dtype.str)
+
+
+def _from_shared(spec):
+    name, shape, dtype = spec
+    handle = shared_memory.SharedMemory(name=name)
+    try:
+        # Attaching processes must not unlink the block when they exit;
+        # only the owner that created it does.
+        from multiprocessing import resource_tracker
+        resource_tracker.unregister(handle._name, 'shared_memory')
+    except Exception:
+        pass
+    array = np.ndarray(shape, dtype=np.dtype(dtype), buffer=handle.buf)
+    array.flags.writeable = False
+    return handle, array
+
+
+def share_matcher(matcher):
+    matrix_handle, matrix_spec = _to_shared(matcher.matrix)
+    labels_handle, labels_spec = _to_shared(matcher.labels)
+    spec = {
+        'matrix': matrix_spec,
+        'labels': labels_spec,
+        'names': matcher.names,
+        'tolerance': matcher.tolerance,
+    }
+    return [matrix_handle, labels_handle], spec
+
+
+def attach_matcher(spec):
+    matrix_handle, matrix = _from_shared(spec['matrix'])
+    labels_handle, labels = _from_shared(spec['labels'])
+    matcher = GalleryMatcher(matrix, labels, spec['names'],
+                             tolerance=spec['tolerance'])
+    return matcher, [matrix_handle, labels_handle]
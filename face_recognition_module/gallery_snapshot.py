@@ -0,0 +1,308 @@
+import argparse
+import datetime
+import json
+import os
+import time
+import numpy as np
+from filelock import FileLock
+from gallery import ENCODING_SIZE, GalleryMatcher, parse_encodings
+from encoding_format import stored_encodings
+
+
+SNAPSHOT_VERSION = 1
+EPOCH = datetime.datetime(1970, 1, 1, tzinfo=datetime.timezone.utc)
+SNAPSHOT_DIR = os.getenv('GALLERY_SNAPSHOT_DIR', os.path.join(
+    os.path.dirname(os.path.abspath(__file__)), 'gallery_snapshot'))
+LOCK_TIMEOUT = 60
+
+
+class GallerySnapshot:
+    def __init__(self, ids, names, matrix, labels, watermark=None,
+                 generation=0):
+        self.ids = list(ids)
+        self.names = list(names)
+        self.matrix = matrix
+        self.labels = labels
+        self.watermark = watermark
+        self.generation = generation
+
+    @classmethod
+    def empty(cls):
+        return cls([], [], np.empty((0, ENCODING_SIZE), dtype=np.float32),
+                   np.empty(0, dtype=np.int32))
+
+    @classmethod
+    def from_rows(cls, customers, watermark=None):
+        ids = []
+        names = []
+        blocks = []
+        labels = []
+        for customer_id, name, rows in customers:
+            if not len(rows):
+                continue
+            labels.append(np.full(len(rows), len(ids), dtype=np.int32))
+            ids.append(customer_id)
+            names.append(name)
+            blocks.append(rows)
+
+        if not blocks:
+            snapshot = cls.empty()
+            snapshot.watermark = watermark
+            return snapshot
+        return cls(ids, names, np.concatenate(blocks).astype(np.float32),
+                   np.concatenate(labels), watermark)
+
+    @classmethod
+    def load(cls, path=SNAPSHOT_DIR, mmap=True):
+        meta_path = os.path.join(path, 'meta.json')
+        if not os.path.exists(meta_path):
+            return None
+        # A missing or unreadable snapshot is treated as no snapshot, so
+        # the caller rebuilds it from Firestore.
+        try:
+            with snapshot_lock(path):
+                with open(meta_path) as f:
+                    meta = json.load(f)
+                if meta.get('version') != SNAPSHOT_VERSION:
+                    print(f"Ignoring gallery snapshot version "
+                          f"{meta.get('version')}")
+                    return None
+
+                mmap_mode = 'r' if mmap else None
+                matrix = np.load(
+                    os.path.join(path, meta.get('matrix', 'matrix.npy')),
+                    mmap_mode=mmap_mode)
+                labels = np.load(
+                    os.path.join(path, meta.get('labels', 'labels.npy')),
+                    mmap_mode=mmap_mode)
+        except (OSError, ValueError, KeyError) as e:
+            print(f"Ignoring unreadable gallery snapshot: {e}")
+            return None
+        if len(labels) != len(matrix):
+            print("Ignoring gallery snapshot with mismatched arrays")
+            return None
+        watermark = meta.get('watermark')
+        if watermark:
+            watermark = datetime.datetime.fromisoformat(watermark)
+        return cls(meta['ids'], meta['names'], matrix, labels, watermark,
+                   meta.get('generation', 0))
+
+    def save(self, path=SNAPSHOT_DIR):
+        os.makedirs(path, exist_ok=True)
+        # Recognition, registration and the CLI all save here; the lock
+        # keeps one writer from deleting files another has just pointed
+        # meta.json at.
+        with snapshot_lock(path):
+            self._save(path)
+
+    def _save(self, path):
+        # Arrays go to new generation-numbered files and meta.json is
+        # switched to them last. Files another process has memory-mapped
+        # are never replaced, which Windows would refuse, and a crash never
+        # leaves a mismatched snapshot.
+        generation = max(self.generation, latest_generation(path)) + 1
+        previous = current_files(path)
+        meta = {
+            'version': SNAPSHOT_VERSION,
+            'generation': generation,
+            'matrix': f"matrix-{generation}.npy",
+            'labels': f"labels-{generation}.npy",
+            'watermark': self.watermark.isoformat() if self.watermark else None,
+            'saved_at': datetime.datetime.utcnow().isoformat(),
+            'ids': self.ids,
+            'names': self.names,
+        }
+
+        for key, array in (('matrix', self.matrix), ('labels', self.labels)):
+            with open(os.path.join(path, meta[key]), 'wb') as f:
+                np.save(f, np.asarray(array))
+
+        tmp_path = os.path.join(path, 'meta.json.tmp')
+        with open(tmp_path, 'w') as f:
+            json.dump(meta, f)
+        os.replace(tmp_path, os.path.join(path, 'meta.json'))
+        self.generation = generation
+        # The generation meta.json pointed at until now is kept too, for a
+        # reader that loaded the old meta.json just before the switch.
+        remove_old_generations(
+            path, keep={meta['matrix'], meta['labels']} | previous)
+
+    def customers(self):
+        if not len(self.labels):
+            return
+        starts = np.concatenate(
+            ([0], np.flatnonzero(np.diff(self.labels)) + 1))
+        ends = np.append(starts[1:], len(self.labels))
+        for start, end in zip(starts, ends):
+            label = int(self.labels[start])
+            yield self.ids[label], self.names[label], \
+                np.asarray(self.matrix[start:end])
+
+    def apply_changes(self, upserts, deletes=()):
+        changed = {customer_id: (name, rows)
+                   for customer_id, name, rows in upserts}
+        deleted = set(deletes)
+
+        customers = []
+        for customer_id, name, rows in self.customers():
+            if customer_id in deleted:
+                continue
+            if customer_id in changed:
+                name, rows = changed.pop(customer_id)
+            customers.append((customer_id, name, rows))
+        customers.extend((customer_id, name, rows)
+                         for customer_id, (name, rows) in changed.items())
+
+        updated = GallerySnapshot.from_rows(customers, self.watermark)
+        self.ids = updated.ids
+        self.names = updated.names
+        self.matrix = updated.matrix
+        self.labels = updated.labels
+
+    def to_matcher(self, **kwargs):
+        return GalleryMatcher(self.matrix, self.labels, self.names, **kwargs)
+
+
+def snapshot_lock(path):
+    return FileLock(os.path.join(path, 'snapshot.lock'), timeout=LOCK_TIMEOUT)
+
+
+def current_files(path):
+    try:
+        with open(os.path.join(path, 'meta.json')) as f:
+            meta = json.load(f)
+    except (OSError, ValueError):
+        return set()
+    return {meta.get('matrix', 'matrix.npy'), meta.get('labels', 'labels.npy')}
+
+
+def latest_generation(path):
+    generations = [0]
+    for filename in os.listdir(path):
+        stem, ext = os.path.splitext(filename)
+        if ext == '.npy' and '-' in stem:
+            try:
+                generations.append(int(stem.rsplit('-', 1)[1]))
+            except ValueError:
+                continue
+    return max(generations)
+
+
+def remove_old_generations(path, keep):
+    # Files still mapped by a running process cannot be deleted on Windows;
+    # they are left for a later save to clean up.
+    for filename in os.listdir(path):
+        if filename.endswith('.npy') and filename not in keep:
+            try:
+                os.remove(os.path.join(path, filename))
+            except OSError:
+                pass
+
+
+def doc_rows(doc):
+    data = doc.to_dict() or {}
+    return doc.id, data.get('name'), \
+        parse_encodings(stored_encodings(data))
+
+
+def latest_update(docs, watermark=None):
+    for doc in docs:
+        updated_at = (doc.to_dict() or {}).get('updated_at')
+        if isinstance(updated_at, datetime.datetime) and \
+                (watermark is None or updated_at > watermark):
+            watermark = updated_at
+    return watermark
+
+
+def build_snapshot(db):
+    docs = list(db.collection('customers').stream())
+    # Documents written before updated_at existed only arrive through a
+    # full build, so an all-legacy collection still gets a watermark.
+    return GallerySnapshot.from_rows((doc_rows(doc) for doc in docs),
+                                     watermark=latest_update(docs, EPOCH))
+
+
+def fetch_changes(db, watermark):
+    return list(db.collection('customers')
+                .where('updated_at', '>', watermark)
+                .order_by('updated_at')
+                .stream())
+
+
+def refresh_snapshot(db, snapshot):
+    if snapshot.watermark is None:
+        snapshot = build_snapshot(db)
+        return snapshot, len(snapshot.ids)
+
+    docs = fetch_changes(db, snapshot.watermark)
+    if docs:
+        snapshot.apply_changes(doc_rows(doc) for doc in docs)
+        snapshot.watermark = latest_update(docs, snapshot.watermark)
+    return snapshot, len(docs)
+
+
+def live_customer_ids(db):
+    # Only document references are listed; no customer data is read.
+    return {ref.id for ref in db.collection('customers').list_documents()}
+
+
+def prune_deleted(db, snapshot):
+    live_ids = live_customer_ids(db)
+    deleted = [customer_id for customer_id in snapshot.ids
+               if customer_id not in live_ids]
+    if deleted:
+        snapshot.apply_changes([], deleted)
+    return len(deleted)
+
+
+def load_or_build(db, path=SNAPSHOT_DIR):
+    start = time.perf_counter()
+    snapshot = GallerySnapshot.load(path)
+    if snapshot is None:
+        print("No gallery snapshot found, building it from Firestore...")
+        snapshot = build_snapshot(db)
+        snapshot.save(path)
+        changed = len(snapshot.ids)
+    else:
+        snapshot, changed = refresh_snapshot(db, snapshot)
+        if changed:
+            snapshot.save(path)
+    print(f"Gallery snapshot: {len(snapshot.ids)} customers, "
+          f"{changed} changed since last sync, "
+          f"loaded in {time.perf_counter() - start:.2f}s")
+    return snapshot
+
+
+if __name__ == "__main__":
+    import firebase_admin
+    from firebase_admin import credentials, firestore
+
+    parser = argparse.ArgumentParser(
+        description="Build or refresh the local face gallery snapshot")
+    parser.add_argument('command', choices=['build', 'refresh'])
+    parser.add_argument('--path', default=SNAPSHOT_DIR)
+    parser.add_argument('--prune', action='store_true',
+                        help="also drop customers deleted from Firestore")
+    args = parser.parse_args()
+
+    cred_path = os.environ.get("FIREBASE_CREDENTIAL_PATH")
+    if not cred_path:
+        raise ValueError("FIREBASE_CRED_PATH not set in environment variables")
+    firebase_admin.initialize_app(credentials.Certificate(cred_path))
+    db = firestore.client()
+
+    start = time.perf_counter()
+    if args.command == 'build':
+        snapshot = build_snapshot(db)
+    else:
+        snapshot = GallerySnapshot.load(args.path, mmap=False)
+        if snapshot is None:
+            snapshot = build_snapshot(db)
+        else:
+            snapshot, changed = refresh_snapshot(db, snapshot)
+            print(f"{changed} customers changed since last sync")
+    if args.prune:
+        print(f"{prune_deleted(db, snapshot)} deleted customers pruned")
+    snapshot.save(args.path)
+    print(f"Saved {len(snapshot.ids)} customers / {len(snapshot.matrix)} "
+          f"encodings to {args.path} in {time.perf_counter() - start:.2f}s")
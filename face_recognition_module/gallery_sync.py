@@ -0,0 +1,168 @@
+import os
+import threading
+import time
+import gallery_snapshot
+from gallery_snapshot import (doc_rows, fetch_changes, latest_update,
+                              live_customer_ids)
+
+
+SYNC_MODE = os.getenv('GALLERY_SYNC_MODE', 'listener')
+POLL_SECONDS = float(os.getenv('GALLERY_SYNC_POLL_SECONDS', '30'))
+PRUNE_SECONDS = float(os.getenv('GALLERY_PRUNE_SECONDS', '60'))
+DEBOUNCE_SECONDS = 1.0
+
+
+class GallerySync:
+    def __init__(self, db, snapshot, on_swap, mode=SYNC_MODE,
+                 poll_seconds=POLL_SECONDS, prune_seconds=PRUNE_SECONDS,
+                 snapshot_path=gallery_snapshot.SNAPSHOT_DIR):
+        if mode not in ('listener', 'poll'):
+            raise ValueError(f"Unknown gallery sync mode: {mode}")
+        self.db = db
+        self.snapshot = snapshot
+        self.on_swap = on_swap
+        self.mode = mode
+        self.poll_seconds = poll_seconds
+        self.prune_seconds = prune_seconds
+        self.snapshot_path = snapshot_path
+        self.counters = {'added': 0, 'updated': 0, 'deleted': 0,
+                         'swaps': 0}
+
+        self._lock = threading.Lock()
+        self._wake = threading.Event()
+        self._stop_event = threading.Event()
+        self._pending_upserts = {}
+        self._pending_deletes = set()
+        self._versions = {}
+        self._next_prune_at = 0.0
+        self._watch = None
+        self._thread = threading.Thread(
+            target=self._run, name='gallery-sync', daemon=True)
+
+    @property
+    def applied_deltas(self):
+        return self.counters['added'] + self.counters['updated'] + \
+            self.counters['deleted']
+
+    def start(self):
+        if self.mode == 'listener':
+            query = self.db.collection('customers').where(
+                'updated_at', '>', self.snapshot.watermark)
+            self._watch = query.on_snapshot(self._on_snapshot)
+        self._thread.start()
+
+    def stop(self):
+        self._stop_event.set()
+        self._wake.set()
+        if self._watch is not None:
+            self._watch.unsubscribe()
+        self._thread.join(timeout=5)
+
+    def _on_snapshot(self, docs, changes, read_time):
+        with self._lock:
+            for change in changes:
+                if change.type.name == 'REMOVED':
+                    self._queue_delete(change.document.id)
+                else:
+                    self._queue_upsert(change.document)
+        self._wake.set()
+
+    def _queue_upsert(self, doc):
+        # Visit updates also touch documents, but only a new updated_at
+        # means the name or encodings changed.
+        updated_at = (doc.to_dict() or {}).get('updated_at')
+        if updated_at is not None and self._versions.get(doc.id) == updated_at:
+            return
+        self._versions[doc.id] = updated_at
+        self._pending_deletes.discard(doc.id)
+        self._pending_upserts[doc.id] = doc
+
+    def _queue_delete(self, customer_id):
+        self._versions.pop(customer_id, None)
+        self._pending_upserts.pop(customer_id, None)
+        self._pending_deletes.add(customer_id)
+
+    def _prune(self):
+        # Deleting a document does not move updated_at, so neither the
+        # listener query nor polling sees it. Deletions are found by
+        # comparing the ids in the gallery with the collection's ids.
+        self._next_prune_at = time.monotonic() + self.prune_seconds
+        try:
+            live_ids = live_customer_ids(self.db)
+        except Exception as e:
+            print(f"Gallery sync prune failed: {e}")
+            return
+        with self._lock:
+            pending = set(self._pending_upserts)
+            for customer_id in self.snapshot.ids:
+                if customer_id not in live_ids and customer_id not in pending:
+                    self._queue_delete(customer_id)
+
+    def _poll(self):
+        try:
+            docs = fetch_changes(self.db, self.snapshot.watermark)
+        except Exception as e:
+            print(f"Gallery sync poll failed: {e}")
+            return
+        with self._lock:
+            for doc in docs:
+                self._queue_upsert(doc)
+
+    def _run(self):
+        next_poll_at = 0.0
+        while not self._stop_event.is_set():
+            now = time.monotonic()
+            due = [self._next_prune_at] if self.prune_seconds > 0 else []
+            if self.mode == 'poll':
+                due.append(next_poll_at)
+            timeout = max(0.0, min(due) - now) if due else None
+            woken = self._wake.wait(timeout)
+            self._wake.clear()
+            if self._stop_event.is_set():
+                break
+            now = time.monotonic()
+            if self.prune_seconds > 0 and now >= self._next_prune_at:
+                self._prune()
+            if self.mode == 'poll' and now >= next_poll_at:
+                next_poll_at = now + self.poll_seconds
+                self._poll()
+            elif woken:
+                # Let a burst of listener events settle into one swap.
+                self._stop_event.wait(DEBOUNCE_SECONDS)
+            try:
+                self._apply()
+            except Exception as e:
+                print(f"Gallery sync failed to apply changes: {e}")
+
+    def _apply(self):
+        with self._lock:
+            docs = list(self._pending_upserts.values())
+            deletes = set(self._pending_deletes)
+            self._pending_upserts.clear()
+            self._pending_deletes.clear()
+        if not docs and not deletes:
+            return
+
+        known = set(self.snapshot.ids)
+        added = sum(1 for doc in docs if doc.id not in known)
+        deleted = len(deletes & known)
+
+        self.snapshot.apply_changes((doc_rows(doc) for doc in docs), deletes)
+        self.snapshot.watermark = latest_update(docs, self.snapshot.watermark)
+
+        # Matching keeps using the old matcher until this single reference
+        # swap, so the frame loop never waits on a rebuild.
+        self.on_swap(self.snapshot.to_matcher())
+
+        self.counters['added'] += added
+        self.counters['updated'] += len(docs) - added
+        self.counters['deleted'] += deleted
+        self.counters['swaps'] += 1
+        print(f"Gallery sync: +{added} ~{len(docs) - added} -{deleted} "
+              f"({self.applied_deltas} deltas applied, "
+              f"{len(self.snapshot.ids)} customers)")
+
+        try:
+            self.snapshot.save(self.snapshot_path)
+        except Exception as e:
+            print(f"Failed to save gallery snapshot: {e}")
@@ -0,0 +1,223 @@
+import argparse
+import datetime
+import os
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor, TimeoutError
+from visit_workers import TTLCache
+
+
+GREETING_MODEL = os.getenv('GREETING_MODEL', 'llama-3.3-70b-versatile')
+LLM_TIMEOUT = float(os.getenv('GREETING_LLM_TIMEOUT', '8'))
+VOICE_BUDGET = float(os.getenv('GREETING_VOICE_BUDGET', '1.5'))
+MESSAGE_BUDGET = float(os.getenv('GREETING_MESSAGE_BUDGET', '10'))
+MAX_CONCURRENCY = int(os.getenv('GREETING_MAX_CONCURRENCY', '4'))
+MAX_PENDING = 32
+CACHE_SECONDS = 86400
+
+VOICE_TEMPLATES = {
+    'happy': "Welcome back {name}! Great to see you smiling, enjoy your shopping.",
+    'sad': "Welcome back {name}. We hope your visit brightens your day a little.",
+    'angry': "Welcome back {name}. We're here to make your shopping quick and easy.",
+    'fear': "Welcome back {name}. Take your time, our staff are happy to help.",
+    'surprise': "Welcome back {name}! Lots of new offers are waiting for you today.",
+    'neutral': "Welcome back {name}! Enjoy your shopping today.",
+}
+
+MESSAGE_TEMPLATE = (
+    "Hello {name}, welcome back to Smart Supermarket! {recommendation}"
+    "Don't miss this week's discounts across the store. "
+    "Thank you for shopping with Smart Supermarket!")
+
+
+def normalize_emotion(emotion):
+    emotion = (emotion or '').lower()
+    return emotion if emotion in VOICE_TEMPLATES else 'neutral'
+
+
+def voice_prompt(name, emotion):
+    return f"""
+    Generate a short and friendly supermarket greeting.
+    Customer name: {name}
+    Detected emotion: {emotion}
+
+    Rules:
+    - Mention the name naturally.
+    - Adapt tone to the emotion (e.g., if happy → cheerful, if sad → comforting).
+    - Maximum 15 words.
+    - Example: "Welcome back Tony! You look happy today, enjoy your shopping."
+    """
+
+
+def message_prompt(name, emotion, purchase_history):
+    if purchase_history:
+        purchases_text = ", ".join(
+            [f"{item['item']} at ${item['price']}" for item in purchase_history])
+    else:
+        purchases_text = "No previous purchases found"
+
+    return f"""
+    Write a professional WhatsApp message for a customer in a supermarket.
+
+    Customer name: {name}
+    Emotion: {emotion}
+    Purchase history: {purchases_text}
+
+    Requirements:
+    - Start with a warm welcome.
+    - Recommend products and mention discounts naturally.
+    - Adjust tone based on emotion (happy, sad, neutral, angry).
+    - End with gratitude and brand name "Smart Supermarket".
+    - Keep it friendly but professional.
+    - IMPORTANT: The entire message must be under 1000 characters.
+    """
+
+
+def template_voice(name, emotion):
+    return VOICE_TEMPLATES[normalize_emotion(emotion)].format(name=name)
+
+
+def template_message(name, emotion, purchase_history):
+    items = sorted({item['item'] for item in purchase_history or []})
+    recommendation = f"Your favourites like {', '.join(items[:3])} are in stock. " \
+        if items else ""
+    return MESSAGE_TEMPLATE.format(name=name, recommendation=recommendation)
+
+
+class GreetingService:
+    def __init__(self, client, model=GREETING_MODEL, timeout=LLM_TIMEOUT,
+                 max_concurrency=MAX_CONCURRENCY, max_pending=MAX_PENDING):
+        if hasattr(client, 'with_options'):
+            client = client.with_options(timeout=timeout, max_retries=0)
+        self.client = client
+        self.model = model
+        self.max_pending = max_pending
+        self.cache = TTLCache(CACHE_SECONDS, maxsize=5000)
+        self.counters = {'hits': 0, 'misses': 0, 'prefetched': 0,
+                         'fallbacks': 0, 'timeouts': 0, 'errors': 0,
+                         'rejected': 0}
+
+        self._executor = ThreadPoolExecutor(
+            max_concurrency, thread_name_prefix='greeting')
+        self._lock = threading.Lock()
+        self._pending = 0
+
+    def _complete(self, prompt):
+        chat_completion = self.client.chat.completions.create(
+            messages=[{"role": "user", "content": prompt}],
+            model=self.model
+        )
+        return chat_completion.choices[0].message.content
+
+    def _finished(self, key, future):
+        with self._lock:
+            self._pending -= 1
+        if future.cancelled() or future.exception() is not None:
+            # Failed generations are not cached so the next call retries.
+            self.cache.pop(key)
+
+    def _submit(self, key, prompt):
+        with self._lock:
+            future = self.cache.get(key)
+            if future is not None:
+                self.counters['hits'] += 1
+                return future
+            self.counters['misses'] += 1
+            if self._pending >= self.max_pending:
+                self.counters['rejected'] += 1
+                return None
+            self._pending += 1
+            future = self._executor.submit(self._complete, prompt)
+            self.cache[key] = future
+        future.add_done_callback(lambda f: self._finished(key, f))
+        return future
+
+    def _await(self, future, budget, fallback):
+        if future is None:
+            self.counters['fallbacks'] += 1
+            return fallback()
+        try:
+            return future.result(timeout=budget)
+        except TimeoutError:
+            # The call keeps running and its result is cached for next time.
+            self.counters['timeouts'] += 1
+        except Exception as e:
+            self.counters['errors'] += 1
+            print(f"Greeting generation failed: {e}")
+        self.counters['fallbacks'] += 1
+        return fallback()
+
+    def _voice_key(self, name, emotion):
+        return ('voice', normalize_emotion(emotion), name,
+                datetime.date.today().isoformat())
+
+    def prefetch(self, name, emotion):
+        key = self._voice_key(name, emotion)
+        if key not in self.cache:
+            self.counters['prefetched'] += 1
+        return self._submit(key, voice_prompt(name, normalize_emotion(emotion)))
+
+    def voice_greeting(self, name, emotion, budget=VOICE_BUDGET):
+        emotion = normalize_emotion(emotion)
+        future = self._submit(self._voice_key(name, emotion),
+                              voice_prompt(name, emotion))
+        return self._await(future, budget,
+                           lambda: template_voice(name, emotion))
+
+    def whatsapp_message(self, name, emotion, purchase_history,
+                         budget=MESSAGE_BUDGET):
+        emotion = normalize_emotion(emotion)
+        key = ('message', emotion, name, datetime.date.today().isoformat())
+        future = self._submit(key, message_prompt(
+            name, emotion, purchase_history))
+        return self._await(future, budget, lambda: template_message(
+            name, emotion, purchase_history))
+
+    def stats(self):
+        with self._lock:
+            stats = dict(self.counters)
+            stats['pending'] = self._pending
+        return stats
+
+    def shutdown(self):
+        self._executor.shutdown(wait=False, cancel_futures=True)
+
+
+def benchmark(service, customers=50, budget=VOICE_BUDGET, prefetch=True):
+    emotions = list(VOICE_TEMPLATES)
+    names = [f"Customer {i}" for i in range(customers)]
+    if prefetch:
+        for i, name in enumerate(names):
+            service.prefetch(name, emotions[i % len(emotions)])
+        time.sleep(budget)
+
+    latencies = []
+    for i, name in enumerate(names):
+        start = time.perf_counter()
+        service.voice_greeting(name, emotions[i % len(emotions)],
+                               budget=budget)
+        latencies.append(time.perf_counter() - start)
+    latencies.sort()
+    return {
+        'p50_ms': 1000 * latencies[len(latencies) // 2],
+        'p99_ms': 1000 * latencies[int(len(latencies) * 0.99) - 1],
+        'max_ms': 1000 * latencies[-1],
+        **service.stats(),
+    }
+
+
+if __name__ == "__main__":
+    from groq import Groq
+
+    parser = argparse.ArgumentParser(
+        description="Benchmark greeting latency, e.g. against stub_llm_server.py "
+                    "(set GROQ_BASE_URL=http://127.0.0.1:8089)")
+    parser.add_argument('--customers', type=int, default=50)
+    parser.add_argument('--budget', type=float, default=VOICE_BUDGET)
+    parser.add_argument('--no-prefetch', action='store_true')
+    args = parser.parse_args()
+
+    service = GreetingService(Groq(api_key=os.getenv('GROQ_API_KEY', 'stub')))
+    print(benchmark(service, args.customers, args.budget,
+                    prefetch=not args.no_prefetch))
+    service.shutdown()
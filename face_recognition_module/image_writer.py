@@ -0,0 +1,54 @@
+import queue
+import threading
+import time
+import cv2
+
+
+JPEG_QUALITY = 90
+
+
+class ImageWriter(threading.Thread):
+    # Writes captured frames to disk off the capture loop. close() waits for
+    # everything queued, so callers can rely on the files afterwards.
+
+    def __init__(self, jpeg_quality=JPEG_QUALITY):
+        super().__init__(name='image-writer', daemon=True)
+        self.params = [cv2.IMWRITE_JPEG_QUALITY, jpeg_quality]
+        self.counters = {'written': 0, 'failed': 0, 'write_seconds': 0.0}
+        self._queue = queue.Queue()
+        self.start()
+
+    def write(self, path, image):
+        self._queue.put((path, image))
+
+    def flush(self):
+        self._queue.join()
+
+    def close(self):
+        self._queue.put(None)
+        self.join()
+        return self.counters
+
+    def run(self):
+        while True:
+            item = self._queue.get()
+            if item is None:
+                self._queue.task_done()
+                return
+            try:
+                self._write(*item)
+            finally:
+                self._queue.task_done()
+
+    def _write(self, path, image):
+        start = time.perf_counter()
+        try:
+            if cv2.imwrite(path, image, self.params):
+                self.counters['written'] += 1
+            else:
+                self.counters['failed'] += 1
+                print(f"Could not write {path}")
+        except Exception as e:
+            self.counters['failed'] += 1
+            print(f"Could not write {path}: {e}")
+        self.counters['write_seconds'] += time.perf_counter() - start
@@ -0,0 +1,242 @@
+import argparse
+import json
+import multiprocessing
+import queue
+import threading
+import time
+from gallery import share_matcher, attach_matcher
+from camera_session import CameraSession, open_sensor
+
+# Camera processes import only the camera pipeline. Firestore, the visit
+# and greeting workers and the WhatsApp dispatcher live in the parent
+# (recognition is imported in main()), so there is one of each however many
+# cameras run.
+
+
+DEDUPE_SECONDS = 60
+
+
+def load_config(path):
+    with open(path) as f:
+        config = json.load(f)
+    cameras = config.get('cameras', [])
+    if not cameras:
+        raise ValueError(f"No cameras configured in {path}")
+    for i, camera in enumerate(cameras):
+        camera.setdefault('name', f"camera-{i}")
+        camera.setdefault('camera_index', i)
+        if 'arduino_port' not in camera:
+            raise ValueError(f"Camera {camera['name']} has no arduino_port")
+    return config
+
+
+class SharedGallery:
+    # The parent's copy of the gallery in shared memory. Each swap shares a
+    # new matcher and sends its spec to every camera process. A segment is
+    # unlinked only two swaps later, so a camera that is slow to switch
+    # still finds the one it was sent.
+
+    def __init__(self, matcher):
+        self.handles, self.spec = share_matcher(matcher)
+        self.queues = []
+        self._retired = []
+        self._lock = threading.Lock()
+
+    def add_camera(self, context):
+        gallery_queue = context.Queue()
+        self.queues.append(gallery_queue)
+        return gallery_queue
+
+    def swap(self, matcher):
+        handles, spec = share_matcher(matcher)
+        with self._lock:
+            self._retired.append(self.handles)
+            self.handles, self.spec = handles, spec
+            for gallery_queue in self.queues:
+                gallery_queue.put(spec)
+            while len(self._retired) > 2:
+                _release(self._retired.pop(0), unlink=True)
+
+    def close(self):
+        with self._lock:
+            for handles in self._retired + [self.handles]:
+                _release(handles, unlink=True)
+            self._retired = []
+
+
+def _release(handles, unlink=False):
+    for handle in handles:
+        try:
+            handle.close()
+        except BufferError:
+            # A matcher built on it is still referenced; the mapping goes
+            # away with it.
+            pass
+        if unlink:
+            try:
+                handle.unlink()
+            except FileNotFoundError:
+                pass
+
+
+def follow_gallery(session, gallery_queue, handles, stop_event):
+    # Runs in the camera process: switches the session to each gallery the
+    # parent publishes. Old handles are closed one swap later, once no
+    # inference step can still be matching against them.
+    previous = []
+    while not stop_event.is_set():
+        try:
+            spec = gallery_queue.get(timeout=1)
+        except queue.Empty:
+            continue
+        while True:
+            try:
+                spec = gallery_queue.get_nowait()
+            except queue.Empty:
+                break
+        try:
+            matcher, new_handles = attach_matcher(spec)
+        except FileNotFoundError:
+            print("Gallery update missed, waiting for the next one")
+            continue
+        session.swap_matcher(matcher)
+        _release(previous)
+        previous, handles = handles, new_handles
+    _release(previous)
+    _release(handles)
+
+
+def camera_worker(camera, gallery_spec, visit_queue, gallery_queue=None):
+    matcher, handles = attach_matcher(gallery_spec)
+    sensor = open_sensor(camera['arduino_port'])
+
+    def on_visit(name, face_image, emotion, camera=None, distance=None):
+        visit_queue.put({
+            'camera': camera,
+            'name': name,
+            'emotion': emotion,
+            'distance': distance,
+            'time': time.time(),
+        })
+
+    # Greetings are generated in the coordinator, so there is nothing
+    # useful to prefetch in the camera process.
+    session = CameraSession(matcher, sensor, camera_index=camera['camera_index'],
+                            on_visit=on_visit, on_identified=None,
+                            window_name=f"Face Recognition - {camera['name']}",
+                            camera_name=camera['name'])
+    follower = None
+    if gallery_queue is not None:
+        follower = threading.Thread(
+            target=follow_gallery, name='gallery-follow', daemon=True,
+            args=(session, gallery_queue, handles, session.stop_event))
+        follower.start()
+    try:
+        session.run()
+    finally:
+        sensor.close()
+        if follower is not None:
+            follower.join(timeout=2)
+        else:
+            _release(handles)
+        print(f"Camera {camera['name']} stopped")
+
+
+class VisitCoordinator:
+    def __init__(self, visit_queue, on_visit, dedupe_seconds=DEDUPE_SECONDS):
+        self.visit_queue = visit_queue
+        self.dedupe_seconds = dedupe_seconds
+        self.on_visit = on_visit
+        self.last_seen = {}
+        self.accepted = 0
+        self.duplicates = 0
+
+    def handle(self, event):
+        name = event['name']
+        last = self.last_seen.get(name)
+        self.last_seen[name] = event['time']
+        # The same customer walking past two entrances is one visit.
+        if last is not None and event['time'] - last < self.dedupe_seconds:
+            self.duplicates += 1
+            return False
+        self.accepted += 1
+        print(f"{name} seen at {event['camera']}")
+        self.on_visit(name, None, event['emotion'], camera=event['camera'],
+                      distance=event.get('distance'), seen_at=event['time'])
+        return True
+
+    def prune(self, now):
+        for name in [n for n, t in self.last_seen.items()
+                     if now - t >= self.dedupe_seconds]:
+            del self.last_seen[name]
+
+    def run(self, processes):
+        while any(p.is_alive() for p in processes):
+            try:
+                event = self.visit_queue.get(timeout=1)
+            except queue.Empty:
+                self.prune(time.time())
+                continue
+            self.handle(event)
+
+
+def main(config_path):
+    import gallery_snapshot
+    from gallery_sync import GallerySync, SYNC_MODE
+    from visit_log import Compactor
+    from recognition import (db, load_gallery, record_visit, visit_pool,
+                             visit_recorder, visit_log, tts)
+
+    config = load_config(config_path)
+    snapshot = gallery_snapshot.load_or_build(db)
+    gallery = SharedGallery(load_gallery(snapshot))
+
+    context = multiprocessing.get_context('spawn')
+    visit_queue = context.Queue()
+    processes = [context.Process(target=camera_worker,
+                                 args=(camera, gallery.spec, visit_queue,
+                                       gallery.add_camera(context)),
+                                 name=camera['name'], daemon=True)
+                 for camera in config['cameras']]
+
+    coordinator = VisitCoordinator(
+        visit_queue, record_visit,
+        config.get('dedupe_seconds', DEDUPE_SECONDS))
+    # Visits are logged by this process, so it also compacts the log.
+    compactor = Compactor(visit_log.root)
+    compactor.start()
+    # Registrations and edits reach the cameras through the shared gallery.
+    sync = None
+    if SYNC_MODE != 'off':
+        sync = GallerySync(db, snapshot, on_swap=gallery.swap)
+        sync.start()
+    try:
+        for process in processes:
+            process.start()
+        coordinator.run(processes)
+    except KeyboardInterrupt:
+        pass
+    finally:
+        if sync is not None:
+            sync.stop()
+            print(f"{sync.applied_deltas} gallery deltas applied live")
+        for process in processes:
+            process.terminate()
+            process.join(timeout=5)
+        gallery.close()
+        visit_pool.stop()
+        tts.stop()
+        visit_recorder.stop()
+        compactor.stop()
+        visit_log.close()
+        print(f"{coordinator.accepted} visits recorded, "
+              f"{coordinator.duplicates} cross-camera duplicates dropped")
+        print("Program stopped safely")
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(
+        description="Run face recognition on several camera/sensor pairs")
+    parser.add_argument('--config', default='cameras.json')
+    args = parser.parse_args()
+    main(args.config)
@@ -0,0 +1,475 @@
+import argparse
+import base64
+import collections
+import datetime
+import json
+import os
+import random
+import sqlite3
+import threading
+import time
+import urllib.error
+import urllib.parse
+import urllib.request
+import uuid
+from concurrent.futures import ThreadPoolExecutor
+from contextlib import closing
+from dotenv import load_dotenv
+
+load_dotenv()
+
+OUTBOX_PATH = os.getenv('WHATSAPP_OUTBOX_PATH', os.path.join(
+    os.path.dirname(os.path.abspath(__file__)), 'outbox.db'))
+TWILIO_API_BASE = os.getenv('TWILIO_API_BASE', 'https://api.twilio.com')
+RATE_PER_SECOND = float(os.getenv('WHATSAPP_RATE_PER_SECOND', '5'))
+DISPATCH_WORKERS = int(os.getenv('WHATSAPP_DISPATCH_WORKERS', '4'))
+DISPATCH_IN_PROCESS = os.getenv('WHATSAPP_DISPATCH_IN_PROCESS', '1') == '1'
+SEND_TIMEOUT = 15
+POLL_SECONDS = 1.0
+MAX_ATTEMPTS = 8
+MAX_BACKOFF_SECONDS = 600
+MAX_OUTBOX_BACKOFF_SECONDS = 60
+# A message left in 'sending' this long belongs to a dispatcher that died.
+STALE_SECONDS = 300
+
+QUEUED = 'queued'
+SENDING = 'sending'
+SENT = 'sent'
+FAILED = 'failed'
+CANCELLED = 'cancelled'
+KEY_CHUNK = 500
+
+SCHEMA = """
+CREATE TABLE IF NOT EXISTS messages (
+    id INTEGER PRIMARY KEY AUTOINCREMENT,
+    idempotency_key TEXT NOT NULL UNIQUE,
+    phone TEXT NOT NULL,
+    body TEXT NOT NULL,
+    status TEXT NOT NULL,
+    attempts INTEGER NOT NULL DEFAULT 0,
+    next_attempt_at REAL NOT NULL,
+    claimed_at REAL,
+    created_at REAL NOT NULL,
+    updated_at REAL NOT NULL,
+    sid TEXT,
+    last_error TEXT
+);
+CREATE INDEX IF NOT EXISTS messages_due ON messages (status, next_attempt_at);
+CREATE TABLE IF NOT EXISTS rate_limit (
+    name TEXT PRIMARY KEY,
+    tokens REAL NOT NULL,
+    updated_at REAL NOT NULL
+);
+"""
+
+OutboxMessage = collections.namedtuple(
+    'OutboxMessage', ['id', 'key', 'phone', 'body', 'attempts'])
+
+
+class PermanentSendError(Exception):
+    pass
+
+
+def message_key(campaign, customer, day=None):
+    day = day or datetime.date.today().isoformat()
+    return f"{campaign}:{customer}:{day}"
+
+
+def backoff_seconds(attempts):
+    # Full jitter keeps a burst of failures from retrying in lockstep.
+    return random.uniform(0.5, 1.0) * min(MAX_BACKOFF_SECONDS, 2 ** attempts)
+
+
+class Outbox:
+    def __init__(self, path=OUTBOX_PATH):
+        self.path = path
+        directory = os.path.dirname(os.path.abspath(path))
+        os.makedirs(directory, exist_ok=True)
+        with closing(self._connect()) as conn:
+            conn.execute('PRAGMA journal_mode=WAL')
+            conn.executescript(SCHEMA)
+
+    def _connect(self):
+        # Autocommit connections; multi-statement updates open their own
+        # transaction. Each call gets a fresh connection so any thread or
+        # process can use the outbox.
+        return sqlite3.connect(self.path, timeout=30, isolation_level=None)
+
+    def enqueue(self, phone, body, key=None):
+        now = time.time()
+        key = key or f"adhoc:{uuid.uuid4().hex}"
+        with closing(self._connect()) as conn:
+            # A cancelled message can be queued again; any other existing
+            # row makes this a duplicate.
+            cursor = conn.execute(
+                "INSERT INTO messages (idempotency_key, phone, body, "
+                "status, next_attempt_at, created_at, updated_at) "
+                "VALUES (?, ?, ?, ?, ?, ?, ?) "
+                "ON CONFLICT (idempotency_key) DO UPDATE SET "
+                "status = excluded.status, body = excluded.body, attempts = 0, "
+                "next_attempt_at = excluded.next_attempt_at, "
+                "updated_at = excluded.updated_at "
+                "WHERE messages.status = ?",
+                (key, phone, body, QUEUED, now, now, now, CANCELLED))
+            return cursor.rowcount == 1
+
+    def claim(self, limit):
+        now = time.time()
+        with closing(self._connect()) as conn:
+            conn.execute('BEGIN IMMEDIATE')
+            try:
+                conn.execute(
+                    "UPDATE messages SET status = ?, updated_at = ? "
+                    "WHERE status = ? AND claimed_at < ?",
+                    (QUEUED, now, SENDING, now - STALE_SECONDS))
+                rows = conn.execute(
+                    "SELECT id, idempotency_key, phone, body, attempts "
+                    "FROM messages WHERE status = ? AND next_attempt_at <= ? "
+                    "ORDER BY next_attempt_at, id LIMIT ?",
+                    (QUEUED, now, limit)).fetchall()
+                conn.executemany(
+                    "UPDATE messages SET status = ?, claimed_at = ?, "
+                    "updated_at = ? WHERE id = ?",
+                    [(SENDING, now, now, row[0]) for row in rows])
+                conn.execute('COMMIT')
+            except Exception:
+                conn.execute('ROLLBACK')
+                raise
+        return [OutboxMessage(*row) for row in rows]
+
+    def mark_sent(self, message, sid):
+        now = time.time()
+        with closing(self._connect()) as conn:
+            conn.execute(
+                "UPDATE messages SET status = ?, sid = ?, attempts = ?, "
+                "updated_at = ?, last_error = NULL WHERE id = ?",
+                (SENT, sid, message.attempts + 1, now, message.id))
+
+    def mark_failed(self, message, error, retry=True):
+        now = time.time()
+        attempts = message.attempts + 1
+        if retry and attempts < MAX_ATTEMPTS:
+            status, next_attempt_at = QUEUED, now + backoff_seconds(attempts)
+        else:
+            status, next_attempt_at = FAILED, now
+        with closing(self._connect()) as conn:
+            conn.execute(
+                "UPDATE messages SET status = ?, attempts = ?, "
+                "next_attempt_at = ?, updated_at = ?, last_error = ? "
+                "WHERE id = ?",
+                (status, attempts, next_attempt_at, now, str(error)[:500],
+                 message.id))
+        return status
+
+    def release(self, messages):
+        now = time.time()
+        with closing(self._connect()) as conn:
+            conn.executemany(
+                "UPDATE messages SET status = ?, claimed_at = NULL, "
+                "updated_at = ? WHERE id = ? AND status = ?",
+                [(QUEUED, now, message.id, SENDING) for message in messages])
+
+    def take_token(self, rate, burst=1, name='whatsapp'):
+        # Token bucket kept in the database, so every process dispatching
+        # from this outbox shares one limit. Returns 0 when a token was
+        # taken, otherwise the seconds until the next one.
+        now = time.time()
+        with closing(self._connect()) as conn:
+            conn.execute('BEGIN IMMEDIATE')
+            try:
+                row = conn.execute(
+                    "SELECT tokens, updated_at FROM rate_limit WHERE name = ?",
+                    (name,)).fetchone()
+                tokens, updated_at = row if row else (float(burst), now)
+                tokens = min(burst, tokens + max(0.0, now - updated_at) * rate)
+                if tokens >= 1:
+                    tokens -= 1
+                    wait = 0.0
+                else:
+                    wait = (1 - tokens) / rate
+                conn.execute(
+                    "INSERT OR REPLACE INTO rate_limit (name, tokens, "
+                    "updated_at) VALUES (?, ?, ?)", (name, tokens, now))
+                conn.execute('COMMIT')
+            except Exception:
+                conn.execute('ROLLBACK')
+                raise
+        return wait
+
+    def retry_failed(self):
+        now = time.time()
+        with closing(self._connect()) as conn:
+            cursor = conn.execute(
+                "UPDATE messages SET status = ?, attempts = 0, "
+                "next_attempt_at = ?, updated_at = ? WHERE status = ?",
+                (QUEUED, now, now, FAILED))
+            return cursor.rowcount
+
+    def status(self, key):
+        with closing(self._connect()) as conn:
+            conn.row_factory = sqlite3.Row
+            row = conn.execute(
+                "SELECT idempotency_key, phone, status, attempts, sid, "
+                "last_error, created_at, updated_at FROM messages "
+                "WHERE idempotency_key = ?", (key,)).fetchone()
+        return dict(row) if row is not None else None
+
+    def counts(self):
+        with closing(self._connect()) as conn:
+            rows = conn.execute(
+                "SELECT status, COUNT(*) FROM messages GROUP BY status")
+            counts = {QUEUED: 0, SENDING: 0, SENT: 0, FAILED: 0, CANCELLED: 0}
+            counts.update(dict(rows.fetchall()))
+        return counts
+
+    def counts_for(self, keys):
+        counts = {QUEUED: 0, SENDING: 0, SENT: 0, FAILED: 0, CANCELLED: 0}
+        keys = list(keys)
+        with closing(self._connect()) as conn:
+            for i in range(0, len(keys), KEY_CHUNK):
+                chunk = keys[i:i + KEY_CHUNK]
+                rows = conn.execute(
+                    "SELECT status, COUNT(*) FROM messages WHERE "
+                    f"idempotency_key IN ({','.join('?' * len(chunk))}) "
+                    "GROUP BY status", chunk)
+                for status, count in rows:
+                    counts[status] = counts.get(status, 0) + count
+        return counts
+
+    def cancel(self, keys):
+        # Only messages still waiting are cancelled; one being sent finishes.
+        now = time.time()
+        keys = list(keys)
+        cancelled = 0
+        with closing(self._connect()) as conn:
+            for i in range(0, len(keys), KEY_CHUNK):
+                chunk = keys[i:i + KEY_CHUNK]
+                cancelled += conn.execute(
+                    "UPDATE messages SET status = ?, updated_at = ? "
+                    "WHERE status = ? AND idempotency_key IN "
+                    f"({','.join('?' * len(chunk))})",
+                    [CANCELLED, now, QUEUED] + chunk).rowcount
+        return cancelled
+
+    def due_count(self):
+        with closing(self._connect()) as conn:
+            return conn.execute(
+                "SELECT COUNT(*) FROM messages WHERE status = ? "
+                "AND next_attempt_at <= ?", (QUEUED, time.time())).fetchone()[0]
+
+
+class TwilioSender:
+    def __init__(self, account_sid=None, auth_token=None, from_number=None,
+                 api_base=TWILIO_API_BASE, timeout=SEND_TIMEOUT):
+        self.account_sid = account_sid or os.getenv('TWILIO_ACCOUNT_SID')
+        self.auth_token = auth_token or os.getenv('TWILIO_AUTH_TOKEN')
+        self.from_number = from_number or os.getenv('TWILIO_WHATSAPP_NUMBER')
+        self.api_base = api_base.rstrip('/')
+        self.timeout = timeout
+
+    def send(self, phone, body):
+        url = (f"{self.api_base}/2010-04-01/Accounts/"
+               f"{self.account_sid}/Messages.json")
+        data = urllib.parse.urlencode({
+            'From': f'whatsapp:{self.from_number}',
+            'To': f'whatsapp:{phone}',
+            'Body': body,
+        }).encode('utf-8')
+        credentials = base64.b64encode(
+            f"{self.account_sid}:{self.auth_token}".encode('utf-8')).decode()
+        request = urllib.request.Request(url, data=data, method='POST')
+        request.add_header('Authorization', f'Basic {credentials}')
+
+        try:
+            with urllib.request.urlopen(request, timeout=self.timeout) as response:
+                return json.loads(response.read()).get('sid')
+        except urllib.error.HTTPError as e:
+            detail = e.read()[:200].decode('utf-8', 'replace')
+            # Throttling and server errors are worth retrying; anything else
+            # (bad number, auth) will fail the same way next time.
+            if e.code == 429 or e.code >= 500:
+                raise RuntimeError(f"HTTP {e.code}: {detail}")
+            raise PermanentSendError(f"HTTP {e.code}: {detail}")
+
+
+class RateLimiter:
+    def __init__(self, outbox, rate, burst=1):
+        self.outbox = outbox
+        self.rate = rate
+        self.burst = max(1, burst)
+
+    def acquire(self, stop_event=None):
+        while True:
+            wait = self.outbox.take_token(self.rate, self.burst)
+            if wait <= 0:
+                return True
+            if stop_event is not None:
+                if stop_event.wait(wait):
+                    return False
+            else:
+                time.sleep(wait)
+
+
+class Dispatcher:
+    def __init__(self, outbox, sender=None, workers=DISPATCH_WORKERS,
+                 rate=RATE_PER_SECOND, poll_seconds=POLL_SECONDS):
+        self.outbox = outbox
+        self.sender = sender or TwilioSender()
+        self.workers = workers
+        self.poll_seconds = poll_seconds
+        self.limiter = RateLimiter(outbox, rate)
+        self.counters = {'sent': 0, 'retried': 0, 'failed': 0}
+        self.outbox_errors = 0
+
+        self._slots = threading.Semaphore(workers)
+        self._lock = threading.Lock()
+        self._in_flight = 0
+        self._wake = threading.Event()
+        self._stop_event = threading.Event()
+        self._executor = None
+        self._thread = None
+
+    def start(self):
+        with self._lock:
+            if self._thread is not None:
+                self._wake.set()
+                return
+            self._executor = ThreadPoolExecutor(
+                self.workers, thread_name_prefix='whatsapp')
+            self._thread = threading.Thread(
+                target=self._run, name='whatsapp-dispatcher', daemon=True)
+        self._thread.start()
+
+    def notify(self):
+        self._wake.set()
+
+    def _run(self):
+        failures = 0
+        while not self._stop_event.is_set():
+            pending = []
+            try:
+                pending = self.outbox.claim(self.workers)
+                if not pending:
+                    self._wake.wait(self.poll_seconds)
+                    self._wake.clear()
+                    failures = 0
+                    continue
+                while pending:
+                    if not self.limiter.acquire(self._stop_event):
+                        # Unsent claims go back to the queue for the next run.
+                        self.outbox.release(pending)
+                        return
+                    message = pending.pop(0)
+                    self._slots.acquire()
+                    with self._lock:
+                        self._in_flight += 1
+                    self._executor.submit(self._send, message)
+                failures = 0
+            except sqlite3.Error as e:
+                # A locked or unavailable database must not end the thread;
+                # claims not handed to a worker are released, or reclaimed
+                # once stale.
+                failures += 1
+                self.outbox_errors += 1
+                backoff = min(MAX_OUTBOX_BACKOFF_SECONDS,
+                              self.poll_seconds * 2 ** failures)
+                print(f"Outbox error ({e}), retrying in {backoff:.1f}s")
+                if pending:
+                    try:
+                        self.outbox.release(pending)
+                    except sqlite3.Error:
+                        pass
+                self._stop_event.wait(backoff)
+
+    def _send(self, message):
+        outcome = 'failed'
+        try:
+            sid = self.sender.send(message.phone, message.body)
+            self.outbox.mark_sent(message, sid)
+            outcome = 'sent'
+            print(f"Message sent to number {message.phone}: SID {sid}")
+        except PermanentSendError as e:
+            self.outbox.mark_failed(message, e, retry=False)
+            print(f"Failed to send message to {message.phone}: {e}")
+        except Exception as e:
+            status = self.outbox.mark_failed(message, e)
+            if status == QUEUED:
+                outcome = 'retried'
+            print(f"Failed to send message to {message.phone} "
+                  f"(attempt {message.attempts + 1}, {status}): {e}")
+        finally:
+            with self._lock:
+                self.counters[outcome] += 1
+                self._in_flight -= 1
+            self._slots.release()
+
+    def in_flight(self):
+        with self._lock:
+            return self._in_flight
+
+    def drain(self, timeout=30):
+        self.start()
+        deadline = time.monotonic() + timeout
+        while time.monotonic() < deadline:
+            if not self.in_flight() and not self.outbox.due_count():
+                return True
+            self._wake.set()
+            time.sleep(0.1)
+        return False
+
+    def stop(self, timeout=10):
+        self._stop_event.set()
+        self._wake.set()
+        if self._thread is not None:
+            self._thread.join(timeout)
+            self._executor.shutdown(wait=True)
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(
+        description="WhatsApp outbox. Point TWILIO_API_BASE at fake_twilio.py "
+                    "to test without sending real messages.")
+    parser.add_argument('--path', default=OUTBOX_PATH)
+    commands = parser.add_subparsers(dest='command', required=True)
+
+    dispatch = commands.add_parser('dispatch', help="send queued messages")
+    dispatch.add_argument('--once', action='store_true',
+                          help="exit once nothing is due")
+    dispatch.add_argument('--rate', type=float, default=RATE_PER_SECOND)
+    dispatch.add_argument('--workers', type=int, default=DISPATCH_WORKERS)
+
+    status = commands.add_parser('status', help="show delivery status")
+    status.add_argument('--key')
+
+    enqueue = commands.add_parser('enqueue', help="queue a message")
+    enqueue.add_argument('phone')
+    enqueue.add_argument('body')
+    enqueue.add_argument('--key')
+
+    commands.add_parser('retry-failed', help="requeue failed messages")
+    args = parser.parse_args()
+
+    outbox = Outbox(args.path)
+    if args.command == 'dispatch':
+        dispatcher = Dispatcher(outbox, workers=args.workers, rate=args.rate)
+        start = time.perf_counter()
+        try:
+            if args.once:
+                dispatcher.drain(timeout=float('inf'))
+            else:
+                dispatcher.start()
+                while True:
+                    time.sleep(1)
+        except KeyboardInterrupt:
+            pass
+        finally:
+            dispatcher.stop()
+        elapsed = time.perf_counter() - start
+        print(f"{dispatcher.counters} in {elapsed:.1f}s, outbox: {outbox.counts()}")
+    elif args.command == 'status':
+        print(outbox.status(args.key) if args.key else outbox.counts())
+    elif args.command == 'enqueue':
+        print("queued" if outbox.enqueue(args.phone, args.body, args.key)
+              else "duplicate")
+    else:
+        print(f"{outbox.retry_failed()} messages requeued")
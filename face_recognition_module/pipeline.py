@@ -0,0 +1,125 @@
+import collections
+import threading
+import time
+
+
+DROP_OLDEST = 'drop_oldest'
+DROP_NEWEST = 'drop_newest'
+BLOCK = 'block'
+
+
+class BoundedQueue:
+    def __init__(self, name, maxsize=2, policy=DROP_OLDEST):
+        if policy not in (DROP_OLDEST, DROP_NEWEST, BLOCK):
+            raise ValueError(f"Unknown queue policy: {policy}")
+        self.name = name
+        self.maxsize = maxsize
+        self.policy = policy
+        self.dropped = 0
+        self.total = 0
+        self._items = collections.deque()
+        self._cond = threading.Condition()
+
+    def put(self, item, timeout=None):
+        with self._cond:
+            if len(self._items) >= self.maxsize:
+                if self.policy == DROP_OLDEST:
+                    self._items.popleft()
+                    self.dropped += 1
+                elif self.policy == DROP_NEWEST:
+                    self.dropped += 1
+                    return False
+                elif not self._cond.wait_for(
+                        lambda: len(self._items) < self.maxsize, timeout):
+                    self.dropped += 1
+                    return False
+            self._items.append(item)
+            self.total += 1
+            self._cond.notify_all()
+            return True
+
+    def get(self, timeout=None):
+        with self._cond:
+            if not self._cond.wait_for(lambda: self._items, timeout):
+                return None
+            item = self._items.popleft()
+            self._cond.notify_all()
+            return item
+
+    def clear(self):
+        with self._cond:
+            self._items.clear()
+            self._cond.notify_all()
+
+    def __len__(self):
+        with self._cond:
+            return len(self._items)
+
+
+class Stage(threading.Thread):
+    def __init__(self, name, target, stop_event):
+        super().__init__(name=name, daemon=True)
+        self.target = target
+        self.stop_event = stop_event
+        self.processed = 0
+        self.busy_seconds = 0.0
+
+    def run(self):
+        while not self.stop_event.is_set():
+            start = time.perf_counter()
+            try:
+                did_work = self.target()
+            except Exception as e:
+                print(f"Stage {self.name} failed: {e}")
+                did_work = False
+            if did_work:
+                self.processed += 1
+                self.busy_seconds += time.perf_counter() - start
+
+
+class PipelineStats:
+    def __init__(self, queues, stages, interval=5.0, scheduler=None):
+        self.queues = queues
+        self.stages = stages
+        self.interval = interval
+        self.scheduler = scheduler
+        self.latencies = collections.deque(maxlen=200)
+        self._last_report = time.monotonic()
+
+    def record_latency(self, captured_at):
+        self.latencies.append(time.monotonic() - captured_at)
+
+    def snapshot(self):
+        latencies = sorted(self.latencies)
+        return {
+            'queues': {q.name: {'depth': len(q), 'maxsize': q.maxsize,
+                                'dropped': q.dropped, 'total': q.total}
+                       for q in self.queues},
+            'stages': {s.name: {'processed': s.processed,
+                                'busy_seconds': round(s.busy_seconds, 2)}
+                       for s in self.stages},
+            'latency_p50_ms': 1000 * latencies[len(latencies) // 2]
+            if latencies else None,
+            'latency_max_ms': 1000 * latencies[-1] if latencies else None,
+            'detection': self.scheduler.stats() if self.scheduler else None,
+        }
+
+    def maybe_report(self):
+        now = time.monotonic()
+        if now - self._last_report < self.interval:
+            return
+        self._last_report = now
+        stats = self.snapshot()
+        depths = ", ".join(f"{name}={q['depth']}/{q['maxsize']} (dropped {q['dropped']})"
+                           for name, q in stats['queues'].items())
+        if stats['latency_p50_ms'] is not None:
+            latency = f"p50={stats['latency_p50_ms']:.0f}ms max={stats['latency_max_ms']:.0f}ms"
+        else:
+            latency = "no frames"
+        print(f"Pipeline queues: {depths}; latency {latency}")
+        if stats['detection']:
+            detection = stats['detection']
+            print(f"Detection: scale={detection['scale']} "
+                  f"every {detection['interval']} frames, "
+                  f"cpu load={detection['cpu_load']}, "
+                  f"{detection['skipped']} frames skipped")
@@ -6,14 +6,34 @@ import pickle
 import firebase_admin
 from firebase_admin import credentials, firestore
 from datetime import datetime, timedelta
+from collections import namedtuple
 import shutil
 import random
+import threading
+import time
 from dotenv import load_dotenv
+import gallery_snapshot
+from customer_ids import IdAllocator
+from image_writer import ImageWriter
+from sample_selector import SampleSelector, candidate_from_frame
 
 
 ENCODING_DIR = r'C:\Users\tmakh\OneDrive\Desktop\Python_AI\python\smart_supermarket_project\encodings'
 IMAGES_DIR = r'C:\Users\tmakh\OneDrive\Desktop\Python_AI\python\smart_supermarket_project\face_images'
 FACE_MATCH_TOLERANCE = 0.5
+GALLERY_REFRESH_SECONDS = float(os.getenv('DUPLICATE_REFRESH_SECONDS', '5'))
+DETECT_SCALE = float(os.getenv('REGISTER_DETECT_SCALE', '0.5'))
+LOCK_TOLERANCE = 50
+ENROLL_MAX_SECONDS = float(os.getenv('ENROLL_MAX_SECONDS', '20'))
+# Hard limit: capture gives up even without enough samples.
+ENROLL_TIMEOUT_SECONDS = float(os.getenv('ENROLL_TIMEOUT_SECONDS', '60'))
+REJECTION_REASONS = {
+    'failed_reads': "the camera returned no frames",
+    'no_face': "no face was found in the frames",
+    'blurry': "the frames were too blurry",
+    'small': "the face was too small, move closer to the camera",
+    'redundant': "the frames were too similar, turn the head slightly",
+}
 
 os.makedirs(ENCODING_DIR, exist_ok=True)
 os.makedirs(IMAGES_DIR, exist_ok=True)
@@ -26,6 +46,14 @@ cred = credentials.Certificate(cred_path)
 firebase_admin.initialize_app(cred)
 
 db = firestore.client()
+id_allocator = IdAllocator(db)
+
+NearestCustomer = namedtuple('NearestCustomer',
+                             ['customer_id', 'name', 'distance'])
+
+_gallery_lock = threading.Lock()
+_gallery = None
+_gallery_checked_at = 0.0
 
 
 def generate_random_purchased_history(num_items=3):
@@ -84,56 +112,63 @@ def is_duplicate_phone(phone):
 
 
 def generate_customer_id():
-    docs = db.collection('customers').get()
-    existing_ids = []
-
-    for doc in docs:
-        doc_id = doc.id
-        if doc_id.startswith("CUST"):
-            try:
-                number = int(doc_id[4:])
-                existing_ids.append(number)
-            except ValueError:
-                continue
-    if not existing_ids:
-        return "CUST001"
-
-    existing_ids.sort()
-    next_id = 1
-    for id_number in existing_ids:
-        if id_number == next_id:
-            next_id += 1
-        else:
-            break
-
-    return f"CUST{next_id:03d}"
+    return id_allocator.allocate()
+
+
+def gallery():
+    # The same local snapshot recognition uses, loaded once and then only
+    # topped up with customers changed since its watermark.
+    global _gallery, _gallery_checked_at
+    with _gallery_lock:
+        if _gallery is None:
+            snapshot = gallery_snapshot.load_or_build(db)
+            _gallery = (snapshot, snapshot.to_matcher(index='exact'))
+        elif time.monotonic() - _gallery_checked_at >= GALLERY_REFRESH_SECONDS:
+            snapshot, changed = gallery_snapshot.refresh_snapshot(
+                db, _gallery[0])
+            if changed:
+                _gallery = (snapshot, snapshot.to_matcher(index='exact'))
+        _gallery_checked_at = time.monotonic()
+        return _gallery
+
+
+def forget_customer(customer_id):
+    global _gallery
+    with _gallery_lock:
+        snapshot = _gallery[0]
+        snapshot.apply_changes([], [customer_id])
+        _gallery = (snapshot, snapshot.to_matcher(index='exact'))
+
+
+def nearest_customer(encoding):
+    snapshot, matcher = gallery()
+    if not len(matcher):
+        return None
+    distances = matcher.distances([encoding])[0]
+    row = int(np.argmin(distances))
+    label = int(matcher.labels[row])
+    return NearestCustomer(snapshot.ids[label], snapshot.names[label],
+                           float(distances[row]))
 
 
 def is_duplicate_face(new_encodings):
     try:
-        docs = db.collection('customers').stream()
-        for doc in docs:
-            data = doc.to_dict()
-            encs = data.get('encodings')
-            if not encs:
-                continue
-            num_values = len(encs)
-            if num_values % 128 != 0:
-                print("Encoding length not 128")
-                continue
-            num_faces = num_values // 128
-            stored_encodings = [np.asarray(encs[i*128:(i+1)*128], dtype=np.float64)
-                                for i in range(num_faces)]
-            matches = face_recognition.compare_faces(
-                stored_encodings, new_encodings, tolerance=FACE_MATCH_TOLERANCE)
-            if True in matches:
-                print(f"This face is already registered as {data['name']}")
-                return True
-
-        return False
+        nearest = nearest_customer(new_encodings)
+        while nearest is not None and nearest.distance <= FACE_MATCH_TOLERANCE:
+            # Deletions do not move the watermark, so make sure the match
+            # is still a customer before rejecting the registration.
+            if db.collection('customers').document(
+                    nearest.customer_id).get().exists:
+                print(f"This face is already registered as {nearest.name} "
+                      f"({nearest.customer_id}, distance "
+                      f"{nearest.distance:.3f})")
+                return nearest
+            forget_customer(nearest.customer_id)
+            nearest = nearest_customer(new_encodings)
+        return None
     except Exception as e:
         print(f"Error checking duplicate face from firestore: {e}")
-        return False
+        return None
 
 
 def is_duplicate_name(name):
@@ -144,6 +179,62 @@ def is_duplicate_name(name):
     return False
 
 
+def detect_faces(frame, scale=DETECT_SCALE):
+    # Detection runs on a downscaled copy; boxes are mapped back to the
+    # full-resolution frame.
+    small = cv2.resize(frame, (0, 0), fx=scale, fy=scale) \
+        if scale != 1 else frame
+    rgb = cv2.cvtColor(small, cv2.COLOR_BGR2RGB)
+    height, width = frame.shape[:2]
+    return [(max(0, int(round(top / scale))),
+             min(width, int(round(right / scale))),
+             min(height, int(round(bottom / scale))),
+             max(0, int(round(left / scale))))
+            for top, right, bottom, left in face_recognition.face_locations(rgb)]
+
+
+def enrollment_timing(started, finished, frames, detect_seconds,
+                      sample_seconds):
+    # sample_seconds are the gaps between accepted candidates.
+    return {
+        'total_seconds': finished - started,
+        'frames': frames,
+        'detect_ms_per_frame': 1000 * detect_seconds / max(frames, 1),
+        'first_sample_seconds': sample_seconds[0] if sample_seconds else None,
+        'seconds_per_sample': sum(sample_seconds[1:]) /
+        max(len(sample_seconds) - 1, 1),
+        'slowest_sample_seconds': max(sample_seconds[1:], default=None),
+    }
+
+
+def print_timing(timing):
+    if timing['first_sample_seconds'] is None:
+        # Capture gave up before any candidate was accepted.
+        print(f"Enrollment stopped after {timing['total_seconds']:.1f}s over "
+              f"{timing['frames']} frames without a candidate, detection "
+              f"{timing['detect_ms_per_frame']:.0f}ms per frame")
+        return
+    print(f"Enrollment took {timing['total_seconds']:.1f}s over "
+          f"{timing['frames']} frames: first candidate after "
+          f"{timing['first_sample_seconds']:.2f}s, then "
+          f"{timing['seconds_per_sample']:.2f}s per candidate "
+          f"(slowest {timing['slowest_sample_seconds'] or 0:.2f}s), "
+          f"detection {timing['detect_ms_per_frame']:.0f}ms per frame")
+
+
+def capture_failure(selector, failed_reads, no_face):
+    # Names the most frequent reason frames did not become samples.
+    counts = {'failed_reads': failed_reads, 'no_face': no_face,
+              **{key: selector.counters[key]
+                 for key in ('blurry', 'small', 'redundant')}}
+    reason = max(counts, key=counts.get)
+    message = (f"Failed to capture enough samples "
+               f"({len(selector.candidates)}/{selector.k})")
+    if counts[reason]:
+        message += f": {REJECTION_REASONS[reason]} ({counts[reason]} frames)"
+    return message
+
+
 def register_customer(name, phone, dob=None, gender=None, progress_callback=None):
     file_path = None
     person_image_dir = None
@@ -156,26 +247,44 @@ def register_customer(name, phone, dob=None, gender=None, progress_callback=None
         return False, f"The phone number {phone} is already registered. Please use a different one."
 
     cap = cv2.VideoCapture(0)
-    encodings = []
-    sample_count = 0
-    max_samples = 10
+    writer = ImageWriter()
+    selector = SampleSelector()
+    max_candidates = selector.max_candidates
+    frames = 0
+    failed_reads = 0
+    no_face = 0
+    detect_seconds = 0.0
+    sample_seconds = []
 
     lock_face = None
     person_image_dir = os.path.join(IMAGES_DIR, name)
+    started = time.perf_counter()
+    last_sample_at = started
 
     try:
 
-        while sample_count < max_samples:
+        while not selector.full:
+            elapsed = time.perf_counter() - started
+            if selector.enough and elapsed >= ENROLL_MAX_SECONDS:
+                break
+            if elapsed >= ENROLL_TIMEOUT_SECONDS:
+                break
+
             ret, frame = cap.read()
             if not ret or frame is None:
                 print("Failed to capture from the Camera")
+                failed_reads += 1
                 continue
+            frames += 1
 
-            rgb = cv2.cvtColor(frame, cv2.COLOR_BGR2RGB)
+            detect_start = time.perf_counter()
+            face_locations = detect_faces(frame)
+            detect_seconds += time.perf_counter() - detect_start
 
-            face_locations = face_recognition.face_locations(rgb)
-
-            if face_locations:
+            candidate = None
+            if not face_locations:
+                no_face += 1
+            else:
 
                 if lock_face is None:
                     areas = [(right-left)*(bottom-top)
@@ -184,55 +293,79 @@ def register_customer(name, phone, dob=None, gender=None, progress_callback=None
                     largest_index_face = areas.index(max(areas))
                     lock_face = face_locations[largest_index_face]
 
-                    face_encoding = face_recognition.face_encodings(rgb, [lock_face])[
-                        0]
-                    if is_duplicate_face(face_encoding):
-                        return False, f"Registration cancelled this face is already registered."
+                    # The first encoding serves both the duplicate check
+                    # and the first candidate.
+                    candidate = candidate_from_frame(frame, lock_face)
+                    duplicate = is_duplicate_face(candidate.encoding)
+                    if duplicate:
+                        return False, (
+                            f"Registration cancelled, this face is already "
+                            f"registered as {duplicate.name} "
+                            f"({duplicate.customer_id}, distance "
+                            f"{duplicate.distance:.2f}).")
 
                     if not os.path.exists(person_image_dir):
                         os.makedirs(person_image_dir)
 
                 else:
-                    matching_face_found = False
                     for location in face_locations:
                         top, right, bottom, left = location
                         (locked_top, locked_right,
                          locked_bottom, locked_left) = lock_face
 
-                        if (abs(top-locked_top) < 50 and abs(right-locked_right) < 50 and abs(bottom-locked_bottom) < 50 and abs(left-locked_left) < 50):
+                        if (abs(top-locked_top) < LOCK_TOLERANCE and abs(right-locked_right) < LOCK_TOLERANCE and abs(bottom-locked_bottom) < LOCK_TOLERANCE and abs(left-locked_left) < LOCK_TOLERANCE):
                             lock_face = location
-                            matching_face_found = True
+                            candidate = candidate_from_frame(frame, lock_face)
                             break
-                    if not matching_face_found:
-                        continue
-
-                face_encoding = face_recognition.face_encodings(rgb, [lock_face])[
-                    0]
-                encodings.append(face_encoding)
-                sample_count += 1
-                if progress_callback is not None:
-                    progress_callback(sample_count, max_samples)
 
-                image_path = os.path.join(
-                    person_image_dir, f"sample_{sample_count}.jpg")
-                cv2.imwrite(image_path, frame)
+            # Saved images are the untouched frame; overlays go on a copy
+            # that is shown on every frame, face or not.
+            display = frame.copy()
+
+            if candidate is not None:
+                # Blurry, too small or redundant frames are not kept.
+                held_before = len(selector.candidates)
+                dropped = selector.offer(candidate)
+                color = (0, 255, 0)
+                if dropped is candidate:
+                    color = (0, 200, 255)
+                else:
+                    candidate.payload = os.path.join(
+                        person_image_dir,
+                        f"candidate_{selector.counters['offered']}.jpg")
+                    writer.write(candidate.payload, frame)
+                    if len(selector.candidates) > held_before:
+                        now = time.perf_counter()
+                        sample_seconds.append(now - last_sample_at)
+                        last_sample_at = now
+                        if progress_callback is not None:
+                            progress_callback(len(selector.candidates),
+                                              max_candidates)
 
                 (top, right, bottom, left) = lock_face
-                cv2.rectangle(frame, (left, top),
-                              (right, bottom), (0, 255, 0), 2)
+                cv2.rectangle(display, (left, top),
+                              (right, bottom), color, 2)
+
+                cv2.putText(display, "Locked Face", (left, top-10),
+                            cv2.FONT_HERSHEY_SIMPLEX, 0.8, color, 2)
 
-                cv2.putText(frame, "Locked Face", (left, top-10),
-                            cv2.FONT_HERSHEY_SIMPLEX, 0.8, (0, 255, 0), 2)
+            cv2.putText(display, f"Sample {len(selector.candidates)}/{max_candidates}",
+                        (10, 30), cv2.FONT_HERSHEY_SIMPLEX, 1, (0, 255, 0), 2)
 
-                cv2.putText(frame, f"Sample {sample_count}/{max_samples}",
-                            (10, 30), cv2.FONT_HERSHEY_SIMPLEX, 1, (0, 255, 0), 2)
+            cv2.imshow("Register Customer", display)
 
-                cv2.imshow("Register Customer", frame)
+            if cv2.waitKey(1) & 0xFF == ord('q'):
+                return False, "Registration Cancelled by user."
 
-                if cv2.waitKey(1) & 0xFF == ord('q'):
-                    return False, "Registration Cancelled by user."
+        if selector.enough:
+            selected = selector.select()
+            print(f"Kept {len(selected)} of {len(selector.candidates)} "
+                  f"candidates (yaw spread {selector.yaw_spread(selected):.2f}), "
+                  f"frames: {selector.counters}")
+            writer.flush()
+            keep_samples(person_image_dir, selected)
+            encodings = [candidate.encoding for candidate in selected]
 
-        if len(encodings) == max_samples:
             if not os.path.exists(ENCODING_DIR):
                 os.makedirs(ENCODING_DIR)
             customer_id = generate_customer_id()
@@ -241,8 +374,11 @@ def register_customer(name, phone, dob=None, gender=None, progress_callback=None
             with open(file_path, 'wb') as f:
                 pickle.dump(encodings, f)
 
-            flattened_encodings = [
-                val for enc in encodings for val in enc.tolist()]
+            # Total time includes encoding and writing the samples out, not
+            # just capture up to the last accepted candidate.
+            timing = enrollment_timing(started, time.perf_counter(), frames,
+                                       detect_seconds, sample_seconds)
+            print_timing(timing)
 
             purchase_history = generate_random_purchased_history(num_items=3)
 
@@ -250,19 +386,38 @@ def register_customer(name, phone, dob=None, gender=None, progress_callback=None
                 'message': "Customer registered successfully",
                 'customer_id': customer_id,
                 'encodings': encodings,
-                'flattened_encodings': flattened_encodings,
                 'purchase_history': purchase_history,
                 'file_path': file_path,
                 'person_image_dir': person_image_dir,
                 'dob': dob,
-                'gender': gender
+                'gender': gender,
+                'timing': timing
             }
 
         else:
-            return False, "Failed to capture enough samples"
+            print_timing(enrollment_timing(started, time.perf_counter(),
+                                           frames, detect_seconds,
+                                           sample_seconds))
+            return False, capture_failure(selector, failed_reads, no_face)
     finally:
         cap.release()
         cv2.destroyAllWindows()
+        # Samples must be on disk before the caller keeps or removes them.
+        writes = writer.close()
+        if writes['failed']:
+            print(f"{writes['failed']} sample images could not be written")
+
+
+def keep_samples(person_image_dir, selected):
+    # Selected candidates become sample_1..k.jpg; the other candidate
+    # images are removed.
+    for i, candidate in enumerate(selected, start=1):
+        if candidate.payload and os.path.exists(candidate.payload):
+            os.replace(candidate.payload, os.path.join(
+                person_image_dir, f"sample_{i}.jpg"))
+    for filename in os.listdir(person_image_dir):
+        if filename.startswith("candidate_"):
+            os.remove(os.path.join(person_image_dir, filename))
 
 
 if __name__ == "__main__":
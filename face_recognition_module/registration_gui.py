@@ -8,7 +8,9 @@ from firebase_admin import credentials, firestore
 import os
 import shutil
 from datetime import datetime
-from send_message import send_whatsapp_message
+from send_message import send_whatsapp_message, message_key, dispatcher
+from aggregates import AggregateCounters
+from encoding_format import encoding_fields
 from tkcalendar import DateEntry
 from dotenv import load_dotenv
 
@@ -20,6 +22,7 @@ cred = credentials.Certificate(cred_path)
 firebase_admin.initialize_app(cred)
 
 db = firestore.client()
+aggregates = AggregateCounters(db)
 
 
 def normalize_phone(phone):
@@ -245,23 +248,28 @@ class RegistrationApp:
                 return
             data = self.registration_data
             doc_ref = db.collection('customers').document(data['customer_id'])
-            doc_ref.set({
+            batch = db.batch()
+            batch.set(doc_ref, {
                 'name': self.name_var.get(),
                 'phone_number': normalize_phone(self.phone_var.get()),
                 'date_of_birth': data['dob'].strftime("%Y-%m-%d"),
                 'gender': data['gender'],
-                'encodings': data['flattened_encodings'],
+                **encoding_fields(data['encodings']),
                 'created_at': datetime.utcnow().isoformat(),
+                'updated_at': firestore.SERVER_TIMESTAMP,
                 'last_visit': None,
                 'purchase_history': data['purchase_history'],
                 'last_emotion': None
             })
+            aggregates.customer_added(batch, data['gender'])
+            batch.commit()
             self.registration_done = True
             self.status_label.config(
                 text="Registration saved succesfully!", fg="green")
             welcome_message = f'Hello {self.name_var.get()}, Welcome to our supermarket! Enjoy your first visit.'
             send_whatsapp_message(normalize_phone(
-                self.phone_var.get()), welcome_message)
+                self.phone_var.get()), welcome_message,
+                key=message_key('welcome', data['customer_id'], day='once'))
             self.root.destroy()
 
         except Exception as e:
@@ -312,3 +320,8 @@ if __name__ == "__main__":
     root.title("Customer registration")
     app = RegistrationApp(root)
     root.mainloop()
+    if dispatcher is not None:
+        # Give the welcome message a chance to go out before exiting; if it
+        # does not, it stays in the outbox for the next dispatcher.
+        dispatcher.drain(timeout=15)
+        dispatcher.stop()
@@ -0,0 +1,152 @@
+import os
+import cv2
+import face_recognition
+import numpy as np
+
+
+ENROLL_SAMPLES = int(os.getenv('ENROLL_SAMPLES', '5'))
+CANDIDATE_FACTOR = 3
+MIN_SHARPNESS = float(os.getenv('ENROLL_MIN_SHARPNESS', '60'))
+MIN_FACE_SIZE = int(os.getenv('ENROLL_MIN_FACE_SIZE', '80'))
+MIN_DISTANCE = float(os.getenv('ENROLL_MIN_DISTANCE', '0.12'))
+# Encodings of one person are ~0.3 apart at most; yaw (nose offset in eye
+# distances, roughly -0.5..0.5) is scaled to count about as much.
+YAW_WEIGHT = 0.5
+ROI_MARGIN = 0.25
+
+
+def sharpness(gray):
+    return float(cv2.Laplacian(gray, cv2.CV_64F).var())
+
+
+def estimate_yaw(landmarks):
+    # Horizontal offset of the nose tip from the midpoint between the eyes,
+    # in eye distances: 0 facing the camera, negative/positive turned away.
+    left_eye = np.mean(landmarks['left_eye'], axis=0)
+    right_eye = np.mean(landmarks['right_eye'], axis=0)
+    nose = np.mean(landmarks['nose_tip'], axis=0)
+    eye_distance = np.linalg.norm(right_eye - left_eye)
+    if eye_distance == 0:
+        return 0.0
+    return float((nose[0] - (left_eye[0] + right_eye[0]) / 2) / eye_distance)
+
+
+def measure(rgb_roi, location):
+    # location is relative to the ROI. Returns (sharpness, face size, yaw).
+    top, right, bottom, left = location
+    gray = cv2.cvtColor(rgb_roi[top:bottom, left:right], cv2.COLOR_RGB2GRAY)
+    landmarks = face_recognition.face_landmarks(
+        rgb_roi, [location], model='small')
+    yaw = estimate_yaw(landmarks[0]) if landmarks else 0.0
+    return sharpness(gray), min(bottom - top, right - left), yaw
+
+
+def candidate_from_frame(frame, location, margin=ROI_MARGIN):
+    # Only the face and a margin around it are converted, encoded and
+    # scored. frame is BGR, location in frame coordinates.
+    top, right, bottom, left = location
+    height, width = frame.shape[:2]
+    pad_y = int((bottom - top) * margin)
+    pad_x = int((right - left) * margin)
+    y0, y1 = max(0, top - pad_y), min(height, bottom + pad_y)
+    x0, x1 = max(0, left - pad_x), min(width, right + pad_x)
+    roi = cv2.cvtColor(frame[y0:y1, x0:x1], cv2.COLOR_BGR2RGB)
+    roi_location = (top - y0, right - x0, bottom - y0, left - x0)
+    encoding = face_recognition.face_encodings(roi, [roi_location])[0]
+    return Candidate(encoding, *measure(roi, roi_location))
+
+
+class Candidate:
+    def __init__(self, encoding, sharpness, face_size, yaw, payload=None):
+        self.encoding = np.asarray(encoding)
+        self.sharpness = sharpness
+        self.face_size = face_size
+        self.yaw = yaw
+        self.payload = payload
+
+    @property
+    def quality(self):
+        return np.log1p(self.sharpness) * min(self.face_size, 200)
+
+    @property
+    def features(self):
+        return np.append(self.encoding.astype(np.float32),
+                         YAW_WEIGHT * self.yaw)
+
+
+class SampleSelector:
+    # Collects quality-gated candidates during capture. A candidate too close
+    # to one already held replaces it only if it is better, so a run of
+    # near-identical frames leaves one sample. select() then keeps the k
+    # candidates that are farthest apart, starting from the best one.
+
+    def __init__(self, k=ENROLL_SAMPLES, max_candidates=None,
+                 min_sharpness=MIN_SHARPNESS, min_face_size=MIN_FACE_SIZE,
+                 min_distance=MIN_DISTANCE):
+        self.k = k
+        self.max_candidates = max_candidates or k * CANDIDATE_FACTOR
+        self.min_sharpness = min_sharpness
+        self.min_face_size = min_face_size
+        self.min_distance = min_distance
+        self.candidates = []
+        self.counters = {'offered': 0, 'blurry': 0, 'small': 0,
+                         'redundant': 0, 'replaced': 0, 'accepted': 0}
+
+    def offer(self, candidate):
+        # Returns the candidate it displaced (or the new one, if rejected)
+        # so the caller can drop its payload; None when simply added.
+        self.counters['offered'] += 1
+        if candidate.sharpness < self.min_sharpness:
+            self.counters['blurry'] += 1
+            return candidate
+        if candidate.face_size < self.min_face_size:
+            self.counters['small'] += 1
+            return candidate
+
+        if self.candidates:
+            kept = np.stack([c.features for c in self.candidates])
+            distances = np.linalg.norm(kept - candidate.features, axis=1)
+            nearest = int(np.argmin(distances))
+            if distances[nearest] < self.min_distance:
+                if candidate.quality <= self.candidates[nearest].quality:
+                    self.counters['redundant'] += 1
+                    return candidate
+                self.counters['replaced'] += 1
+                replaced = self.candidates[nearest]
+                self.candidates[nearest] = candidate
+                return replaced
+
+        self.candidates.append(candidate)
+        self.counters['accepted'] += 1
+        return None
+
+    @property
+    def full(self):
+        return len(self.candidates) >= self.max_candidates
+
+    @property
+    def enough(self):
+        return len(self.candidates) >= self.k
+
+    def select(self, k=None):
+        k = min(k or self.k, len(self.candidates))
+        if k == 0:
+            return []
+        features = np.stack([c.features for c in self.candidates])
+        quality = np.array([c.quality for c in self.candidates])
+
+        chosen = [int(np.argmax(quality))]
+        nearest = np.linalg.norm(features - features[chosen[0]], axis=1)
+        while len(chosen) < k:
+            # Farthest from everything kept so far; quality breaks ties.
+            score = nearest + 1e-6 * quality / max(quality.max(), 1e-9)
+            score[chosen] = -1
+            index = int(np.argmax(score))
+            chosen.append(index)
+            nearest = np.minimum(
+                nearest, np.linalg.norm(features - features[index], axis=1))
+        return [self.candidates[i] for i in chosen]
+
+    def yaw_spread(self, candidates=None):
+        yaws = [c.yaw for c in (candidates or self.candidates)]
+        return max(yaws) - min(yaws) if yaws else 0.0
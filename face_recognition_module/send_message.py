@@ -1,23 +1,20 @@
-from twilio.rest import Client
-import os
-from dotenv import load_dotenv
+from outbox import Outbox, Dispatcher, DISPATCH_IN_PROCESS, message_key
 
-load_dotenv()
+# The one WhatsApp entry point for recognition, registration and the
+# dashboard, which imports it from here.
+outbox = Outbox()
+# Sends happen on the dispatcher's threads; callers only write to the outbox.
+# Messages left behind when this process exits are picked up by the next
+# dispatcher (in-process or `python outbox.py dispatch`).
+dispatcher = Dispatcher(outbox) if DISPATCH_IN_PROCESS else None
 
-account_sid = os.getenv('TWILIO_ACCOUNT_SID')
-auth_token = os.getenv('TWILIO_AUTH_TOKEN')
-twilio_whatsapp_number = os.getenv('TWILIO_WHATSAPP_NUMBER')
 
-client = Client(account_sid, auth_token)
-
-
-def send_whatsapp_message(number, message):
-    try:
-        message = client.messages.create(
-            from_=f'whatsapp:{twilio_whatsapp_number}',
-            body=message,
-            to=f'whatsapp:{number}'
-        )
-        print(f"Message send to number {number}: SID {message.sid}")
-    except Exception as e:
-        print(f'Failed to send message to {number}: {str(e)}')
+def send_whatsapp_message(number, message, key=None):
+    if not number:
+        return False
+    queued = outbox.enqueue(number, message, key)
+    if not queued:
+        print(f"Message to {number} already queued ({key})")
+    elif dispatcher is not None:
+        dispatcher.start()
+    return queued
@@ -0,0 +1,88 @@
+import argparse
+import json
+import random
+import re
+import time
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+
+
+class StubLLMHandler(BaseHTTPRequestHandler):
+    latency = 0.5
+    jitter = 0.2
+    fail_rate = 0.0
+    hang_rate = 0.0
+
+    def do_POST(self):
+        if not self.path.rstrip('/').endswith('/chat/completions'):
+            self.send_error(404)
+            return
+
+        length = int(self.headers.get('Content-Length', 0))
+        body = json.loads(self.rfile.read(length) or b'{}')
+        prompt = " ".join(m.get('content', '') for m in body.get('messages', []))
+
+        if random.random() < self.hang_rate:
+            time.sleep(300)
+        time.sleep(max(0.0, random.gauss(self.latency, self.jitter)))
+        if random.random() < self.fail_rate:
+            self.send_error(503, "Stub overloaded")
+            return
+
+        name = re.search(r"Customer name: (.+)", prompt)
+        name = name.group(1).strip() if name else "there"
+        content = f"Welcome back {name}! Enjoy your shopping at Smart Supermarket."
+        response = {
+            'id': f"stub-{time.time_ns()}",
+            'object': 'chat.completion',
+            'created': int(time.time()),
+            'model': body.get('model', 'stub'),
+            'choices': [{
+                'index': 0,
+                'message': {'role': 'assistant', 'content': content},
+                'finish_reason': 'stop',
+            }],
+            'usage': {'prompt_tokens': len(prompt.split()),
+                      'completion_tokens': len(content.split()),
+                      'total_tokens': len(prompt.split()) + len(content.split())},
+        }
+        payload = json.dumps(response).encode('utf-8')
+        self.send_response(200)
+        self.send_header('Content-Type', 'application/json')
+        self.send_header('Content-Length', str(len(payload)))
+        self.end_headers()
+        self.wfile.write(payload)
+
+    def log_message(self, format, *args):
+        pass
+
+
+def serve(host='127.0.0.1', port=8089, latency=0.5, jitter=0.2,
+          fail_rate=0.0, hang_rate=0.0):
+    StubLLMHandler.latency = latency
+    StubLLMHandler.jitter = jitter
+    StubLLMHandler.fail_rate = fail_rate
+    StubLLMHandler.hang_rate = hang_rate
+    server = ThreadingHTTPServer((host, port), StubLLMHandler)
+    server.daemon_threads = True
+    return server
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(
+        description="OpenAI/Groq-compatible stub chat completion server")
+    parser.add_argument('--host', default='127.0.0.1')
+    parser.add_argument('--port', type=int, default=8089)
+    parser.add_argument('--latency', type=float, default=0.5)
+    parser.add_argument('--jitter', type=float, default=0.2)
+    parser.add_argument('--fail-rate', type=float, default=0.0)
+    parser.add_argument('--hang-rate', type=float, default=0.0)
+    args = parser.parse_args()
+
+    server = serve(args.host, args.port, args.latency, args.jitter,
+                   args.fail_rate, args.hang_rate)
+    print(f"Stub LLM listening on http://{args.host}:{args.port} "
+          f"(set GROQ_BASE_URL to this address)")
+    try:
+        server.serve_forever()
+    except KeyboardInterrupt:
+        pass
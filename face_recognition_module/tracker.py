@@ -0,0 +1,151 @@
+import itertools
+import time
+
+
+IOU_THRESHOLD = 0.3
+CENTROID_DISTANCE_RATIO = 0.5
+TRACK_EXPIRY_SECONDS = 1.5
+REVERIFY_SECONDS = 3.0
+UNKNOWN_RETRY_SECONDS = 0.5
+MAX_FAILED_VERIFICATIONS = 2
+
+
+def box_iou(a, b):
+    a_top, a_right, a_bottom, a_left = a
+    b_top, b_right, b_bottom, b_left = b
+
+    inter_w = min(a_right, b_right) - max(a_left, b_left)
+    inter_h = min(a_bottom, b_bottom) - max(a_top, b_top)
+    if inter_w <= 0 or inter_h <= 0:
+        return 0.0
+
+    intersection = inter_w * inter_h
+    area_a = (a_right - a_left) * (a_bottom - a_top)
+    area_b = (b_right - b_left) * (b_bottom - b_top)
+    return intersection / float(area_a + area_b - intersection)
+
+
+def box_centroid(box):
+    top, right, bottom, left = box
+    return (left + right) / 2.0, (top + bottom) / 2.0
+
+
+def centroid_distance(a, b):
+    (ax, ay), (bx, by) = box_centroid(a), box_centroid(b)
+    return ((ax - bx) ** 2 + (ay - by) ** 2) ** 0.5
+
+
+class Track:
+    def __init__(self, track_id, box, now):
+        self.track_id = track_id
+        self.box = box
+        self.created_at = now
+        self.last_seen = now
+        self.last_verified = None
+        self.name = None
+        self.label = -1
+        self.distance = None
+        self.emotion = "Unknown"
+        self.hits = 1
+        self.failed_verifications = 0
+        self.identified_at = None
+        self.visit_pending = False
+
+    @property
+    def known(self):
+        return self.name is not None
+
+
+class FaceTracker:
+    def __init__(self, iou_threshold=IOU_THRESHOLD,
+                 expiry_seconds=TRACK_EXPIRY_SECONDS,
+                 reverify_seconds=REVERIFY_SECONDS,
+                 unknown_retry_seconds=UNKNOWN_RETRY_SECONDS):
+        self.iou_threshold = iou_threshold
+        self.expiry_seconds = expiry_seconds
+        self.reverify_seconds = reverify_seconds
+        self.unknown_retry_seconds = unknown_retry_seconds
+        self.tracks = {}
+        self._ids = itertools.count(1)
+
+    def update(self, boxes, now=None):
+        now = time.monotonic() if now is None else now
+
+        for track_id in [tid for tid, t in self.tracks.items()
+                         if now - t.last_seen > self.expiry_seconds]:
+            del self.tracks[track_id]
+
+        pairs = []
+        for box_index, box in enumerate(boxes):
+            for track in self.tracks.values():
+                iou = box_iou(box, track.box)
+                if iou >= self.iou_threshold:
+                    pairs.append((iou, box_index, track.track_id))
+        pairs.sort(reverse=True)
+
+        assigned = [None] * len(boxes)
+        used_tracks = set()
+        for _, box_index, track_id in pairs:
+            if assigned[box_index] is not None or track_id in used_tracks:
+                continue
+            assigned[box_index] = self.tracks[track_id]
+            used_tracks.add(track_id)
+
+        # Fast movers can fall below the IoU threshold between frames, so
+        # fall back to the nearest free track centroid.
+        for box_index, box in enumerate(boxes):
+            if assigned[box_index] is not None:
+                continue
+            top, right, bottom, left = box
+            limit = CENTROID_DISTANCE_RATIO * max(right - left, bottom - top)
+            candidates = [(centroid_distance(box, t.box), t.track_id)
+                          for t in self.tracks.values()
+                          if t.track_id not in used_tracks]
+            candidates = [c for c in candidates if c[0] <= limit]
+            if candidates:
+                _, track_id = min(candidates)
+                assigned[box_index] = self.tracks[track_id]
+                used_tracks.add(track_id)
+
+        for box_index, box in enumerate(boxes):
+            track = assigned[box_index]
+            if track is None:
+                track = Track(next(self._ids), box, now)
+                self.tracks[track.track_id] = track
+                assigned[box_index] = track
+            else:
+                track.box = box
+                track.last_seen = now
+                track.hits += 1
+
+        return assigned
+
+    def needs_identity(self, track, now=None):
+        now = time.monotonic() if now is None else now
+        if track.last_verified is None:
+            return True
+        interval = self.reverify_seconds if track.known \
+            else self.unknown_retry_seconds
+        return now - track.last_verified >= interval
+
+    def assign_identity(self, track, match, now=None):
+        now = time.monotonic() if now is None else now
+        previous = track.name
+        track.last_verified = now
+        track.distance = match.distance
+        if match.known:
+            if match.name != previous:
+                track.identified_at = now
+            track.name = match.name
+            track.label = match.label
+            track.failed_verifications = 0
+        elif track.known:
+            # One bad frame should not drop an identity that was confirmed.
+            track.failed_verifications += 1
+            if track.failed_verifications >= MAX_FAILED_VERIFICATIONS:
+                track.name = None
+                track.label = -1
+        return track.name != previous
+
+    def __len__(self):
+        return len(self.tracks)
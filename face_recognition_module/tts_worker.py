@@ -0,0 +1,181 @@
+import hashlib
+import heapq
+import itertools
+import os
+import shutil
+import subprocess
+import sys
+import threading
+import time
+import pyttsx3
+
+
+TTS_CACHE_DIR = os.getenv('TTS_CACHE_DIR', os.path.join(
+    os.path.dirname(os.path.abspath(__file__)), 'tts_cache'))
+GREETING_MAX_AGE = float(os.getenv('TTS_GREETING_MAX_AGE', '10'))
+CACHE_MAX_BYTES = int(float(os.getenv('TTS_CACHE_MAX_MB', '200')) * 2 ** 20)
+CACHE_MAX_AGE = float(os.getenv('TTS_CACHE_MAX_DAYS', '7')) * 86400
+CLEANUP_SECONDS = 60
+MAX_QUEUED = 20
+RATE_OFFSET = -50
+
+PLAY_PRIORITY = 0
+PRERENDER_PRIORITY = 10
+
+
+def _player():
+    if sys.platform == 'win32':
+        import winsound
+        return lambda path: winsound.PlaySound(path, winsound.SND_FILENAME)
+    for command in (['afplay'], ['aplay', '-q'], ['paplay']):
+        if shutil.which(command[0]):
+            return lambda path, command=command: subprocess.run(
+                command + [path], check=True)
+    return None
+
+
+class TTSWorker(threading.Thread):
+    def __init__(self, cache_dir=TTS_CACHE_DIR, max_age=GREETING_MAX_AGE,
+                 max_queued=MAX_QUEUED):
+        super().__init__(name='tts', daemon=True)
+        self.cache_dir = cache_dir
+        self.max_age = max_age
+        self.max_queued = max_queued
+        self.counters = {'played': 0, 'cache_hits': 0, 'rendered': 0,
+                         'dropped_stale': 0, 'dropped_full': 0,
+                         'direct': 0, 'evicted': 0}
+
+        self._heap = []
+        self._seq = itertools.count()
+        self._cond = threading.Condition()
+        self._launched = False
+        self._stopping = False
+        self._engine = None
+        self._play_file = _player()
+        self._cleaned_at = float('-inf')
+        os.makedirs(cache_dir, exist_ok=True)
+
+    def cache_path(self, text):
+        digest = hashlib.sha256(
+            f"{RATE_OFFSET}:{text}".encode('utf-8')).hexdigest()
+        return os.path.join(self.cache_dir, f"{digest}.wav")
+
+    def _put(self, priority, kind, text):
+        with self._cond:
+            plays = sum(1 for entry in self._heap if entry[3] == 'play')
+            if kind == 'play' and plays >= self.max_queued:
+                self.counters['dropped_full'] += 1
+                return False
+            heapq.heappush(self._heap, (priority, next(self._seq),
+                                        time.monotonic(), kind, text))
+            self._cond.notify()
+            return True
+
+    def say(self, text, priority=PLAY_PRIORITY):
+        if not text:
+            return False
+        self.start_once()
+        return self._put(priority, 'play', text)
+
+    def prerender(self, text):
+        if not text or os.path.exists(self.cache_path(text)):
+            return False
+        self.start_once()
+        return self._put(PRERENDER_PRIORITY, 'render', text)
+
+    def start_once(self):
+        with self._cond:
+            if self._launched:
+                return
+            self._launched = True
+        self.start()
+
+    def stop(self, timeout=5):
+        with self._cond:
+            self._stopping = True
+            self._cond.notify_all()
+        if self.is_alive():
+            self.join(timeout)
+
+    def run(self):
+        # pyttsx3 engines are bound to the thread that created them.
+        self._engine = pyttsx3.init()
+        rate = self._engine.getProperty('rate')
+        self._engine.setProperty('rate', rate + RATE_OFFSET)
+        self._cleanup()
+
+        while True:
+            with self._cond:
+                self._cond.wait_for(lambda: self._heap or self._stopping)
+                if self._stopping:
+                    return
+                _, _, queued_at, kind, text = heapq.heappop(self._heap)
+
+            try:
+                if kind == 'render':
+                    self._render(text)
+                elif time.monotonic() - queued_at > self.max_age:
+                    # The customer has walked on; a late greeting is noise.
+                    self.counters['dropped_stale'] += 1
+                else:
+                    self._play(text)
+            except Exception as e:
+                print(f"Text-to-speech failed: {e}")
+
+    def _render(self, text):
+        path = self.cache_path(text)
+        if os.path.exists(path):
+            return path
+        tmp_path = path + '.tmp.wav'
+        self._engine.save_to_file(text, tmp_path)
+        self._engine.runAndWait()
+        if not os.path.exists(tmp_path) or not os.path.getsize(tmp_path):
+            return None
+        os.replace(tmp_path, path)
+        self.counters['rendered'] += 1
+        if time.monotonic() - self._cleaned_at >= CLEANUP_SECONDS:
+            self._cleanup()
+        return path
+
+    def _cleanup(self):
+        # Greetings are per customer and per day, so the cache is bounded:
+        # files unused for CACHE_MAX_AGE go first, then the least recently
+        # used until it fits in CACHE_MAX_BYTES (hits refresh the mtime).
+        self._cleaned_at = time.monotonic()
+        now = time.time()
+        files = []
+        for entry in os.scandir(self.cache_dir):
+            if entry.is_file() and entry.name.endswith('.wav'):
+                stat = entry.stat()
+                files.append((stat.st_mtime, stat.st_size, entry.path))
+        files.sort()
+        total = sum(size for _, size, _ in files)
+        for mtime, size, path in files:
+            if now - mtime <= CACHE_MAX_AGE and total <= CACHE_MAX_BYTES:
+                break
+            try:
+                os.remove(path)
+            except OSError:
+                # Still being played (Windows keeps it locked).
+                continue
+            total -= size
+            self.counters['evicted'] += 1
+
+    def _play(self, text):
+        path = self.cache_path(text)
+        if os.path.exists(path):
+            self.counters['cache_hits'] += 1
+            try:
+                os.utime(path)
+            except OSError:
+                pass
+        elif self._play_file is not None:
+            path = self._render(text)
+
+        if path and self._play_file is not None and os.path.exists(path):
+            self._play_file(path)
+        else:
+            self.counters['direct'] += 1
+            self._engine.say(text)
+            self._engine.runAndWait()
+        self.counters['played'] += 1
@@ -0,0 +1,150 @@
+import argparse
+import datetime
+import numpy as np
+from visit_log import EMOTIONS, VISIT_LOG_DIR, load_day, local_day
+
+
+MS_PER_HOUR = 3600 * 1000
+MS_PER_DAY = 24 * MS_PER_HOUR
+
+
+def load_range(root, start, end):
+    # Concatenates the daily partitions in [start, end]. Each day has its own
+    # customer/camera dictionaries, so codes are remapped onto shared ones.
+    days = []
+    day = start
+    while day <= end:
+        columns = load_day(root, day)
+        if columns is not None and len(columns['ts']):
+            days.append(columns)
+        day += datetime.timedelta(days=1)
+
+    if not days:
+        return {'customer': np.zeros(0, dtype=np.int32),
+                'customers': np.zeros(0, dtype=str),
+                'camera': np.zeros(0, dtype=np.int16),
+                'cameras': np.zeros(0, dtype=str),
+                'ts': np.zeros(0, dtype=np.int64),
+                'emotion': np.zeros(0, dtype=np.int8),
+                'distance': np.zeros(0, dtype=np.float32)}
+
+    events = {}
+    for name, names in (('customer', 'customers'), ('camera', 'cameras')):
+        vocabulary, codes = np.unique(
+            np.concatenate([columns[names] for columns in days]),
+            return_inverse=True)
+        offsets = np.cumsum([0] + [len(columns[names]) for columns in days])
+        events[name] = np.concatenate([
+            codes[offsets[i]:offsets[i + 1]][columns[name]]
+            for i, columns in enumerate(days)]).astype(np.int32)
+        events[names] = vocabulary
+    for name in ('ts', 'emotion', 'distance'):
+        events[name] = np.concatenate([columns[name] for columns in days])
+    return events
+
+
+def local_ms(events, utc_offset_hours):
+    return events['ts'] + int(utc_offset_hours * MS_PER_HOUR)
+
+
+def hourly_footfall(events, utc_offset_hours=0):
+    hours = (local_ms(events, utc_offset_hours) // MS_PER_HOUR) % 24
+    return np.bincount(hours, minlength=24)
+
+
+def daily_footfall(events, start, days, utc_offset_hours=0):
+    index = day_index(events, start, utc_offset_hours)
+    keep = (index >= 0) & (index < days)
+    return np.bincount(index[keep], minlength=days)
+
+
+def day_index(events, start, utc_offset_hours=0):
+    epoch = datetime.datetime.combine(
+        start, datetime.time(), datetime.timezone.utc).timestamp()
+    return (local_ms(events, utc_offset_hours) - int(epoch * 1000)) \
+        // MS_PER_DAY
+
+
+def repeat_visit_rate(events, utc_offset_hours=0):
+    # A repeat visitor is a customer seen on more than one distinct day.
+    if not len(events['ts']):
+        return {'customers': 0, 'returning': 0, 'rate': 0.0}
+    days = local_ms(events, utc_offset_hours) // MS_PER_DAY
+    pairs = np.unique(events['customer'].astype(np.int64) * (1 << 32) +
+                      (days - days.min()))
+    days_per_customer = np.bincount(pairs >> 32)
+    customers = int(np.count_nonzero(days_per_customer))
+    returning = int(np.count_nonzero(days_per_customer > 1))
+    return {'customers': customers, 'returning': returning,
+            'rate': returning / customers}
+
+
+def emotion_trends(events, start, days, utc_offset_hours=0):
+    # Counts per (day, emotion); unknown emotions (code -1) are left out.
+    index = day_index(events, start, utc_offset_hours)
+    keep = (index >= 0) & (index < days) & (events['emotion'] >= 0)
+    cells = index[keep] * len(EMOTIONS) + events['emotion'][keep]
+    return np.bincount(cells, minlength=days * len(EMOTIONS)) \
+        .reshape(days, len(EMOTIONS))
+
+
+def camera_footfall(events):
+    counts = np.bincount(events['camera'], minlength=len(events['cameras']))
+    return {str(camera) or 'unknown': int(count)
+            for camera, count in zip(events['cameras'], counts)}
+
+
+def summary(root=VISIT_LOG_DIR, days=30, utc_offset_hours=0, today=None):
+    # Days are local to the store, including which one is today.
+    today = today or local_day(utc_offset_hours=utc_offset_hours)
+    start = today - datetime.timedelta(days=days - 1)
+    # A local day can begin on the previous UTC day or end on the next one.
+    events = load_range(root, start - datetime.timedelta(days=1),
+                        today + datetime.timedelta(days=1))
+    in_range = day_index(events, start, utc_offset_hours)
+    keep = (in_range >= 0) & (in_range < days)
+    for name in ('customer', 'camera', 'ts', 'emotion', 'distance'):
+        events[name] = events[name][keep]
+
+    distances = events['distance'][~np.isnan(events['distance'])]
+    return {
+        'start': start,
+        'days': [start + datetime.timedelta(days=i) for i in range(days)],
+        'visits': int(len(events['ts'])),
+        'hourly': hourly_footfall(events, utc_offset_hours).tolist(),
+        'daily': daily_footfall(events, start, days,
+                                utc_offset_hours).tolist(),
+        'repeat': repeat_visit_rate(events, utc_offset_hours),
+        'emotions': EMOTIONS,
+        'emotion_trends': emotion_trends(events, start, days,
+                                         utc_offset_hours).tolist(),
+        'cameras': camera_footfall(events),
+        'median_distance': float(np.median(distances))
+        if len(distances) else None,
+    }
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(
+        description="Footfall, repeat visits and emotion trends from the visit log")
+    parser.add_argument('--root', default=VISIT_LOG_DIR)
+    parser.add_argument('--days', type=int, default=30)
+    parser.add_argument('--utc-offset', type=float, default=0)
+    args = parser.parse_args()
+
+    result = summary(args.root, args.days, args.utc_offset)
+    print(f"Visits: {result['visits']} since {result['start']}")
+    print("Hourly footfall:")
+    for hour, count in enumerate(result['hourly']):
+        if count:
+            print(f"  {hour:02d}:00  {count}")
+    repeat = result['repeat']
+    print(f"Repeat visitors: {repeat['returning']}/{repeat['customers']} "
+          f"({repeat['rate']:.1%})")
+    print("Emotions per day:")
+    for day, counts in zip(result['days'], result['emotion_trends']):
+        if any(counts):
+            print(f"  {day}  " + "  ".join(
+                f"{emotion}={count}"
+                for emotion, count in zip(EMOTIONS, counts) if count))
+    print(f"Cameras: {result['cameras']}")
@@ -0,0 +1,226 @@
+import argparse
+import datetime
+import json
+import math
+import os
+import threading
+import numpy as np
+
+
+VISIT_LOG_DIR = os.getenv('VISIT_LOG_DIR', os.path.join(
+    os.path.dirname(os.path.abspath(__file__)), 'visit_log'))
+EMOTIONS = ['angry', 'disgust', 'fear', 'happy', 'sad', 'surprise', 'neutral']
+EMOTION_CODES = {emotion: code for code, emotion in enumerate(EMOTIONS)}
+COLUMNS = ('customer', 'camera', 'ts', 'emotion', 'distance')
+# The store's offset from UTC in hours. Visit counters, the dashboard and
+# analytics all count days in this time zone.
+UTC_OFFSET_HOURS = float(os.getenv(
+    'STORE_UTC_OFFSET', os.getenv('DASHBOARD_UTC_OFFSET', '0')))
+# How often the running process checks for finished days to compact; each
+# day is compacted within this long of UTC midnight.
+COMPACT_SECONDS = float(os.getenv('VISIT_LOG_COMPACT_SECONDS', '3600'))
+
+
+def utc_day(timestamp):
+    return datetime.datetime.fromtimestamp(
+        timestamp, datetime.timezone.utc).date()
+
+
+def local_day(when=None, utc_offset_hours=UTC_OFFSET_HOURS):
+    # The store's calendar day for a UTC time (naive values are UTC), or
+    # for now.
+    if when is None:
+        when = datetime.datetime.now(datetime.timezone.utc)
+    elif when.tzinfo is None:
+        when = when.replace(tzinfo=datetime.timezone.utc)
+    return (when + datetime.timedelta(hours=utc_offset_hours)).date()
+
+
+def events_path(root, day):
+    return os.path.join(root, 'events', f"{day.isoformat()}.jsonl")
+
+
+def partition_path(root, day):
+    return os.path.join(root, 'columns', f"day={day.isoformat()}.npz")
+
+
+class VisitLog:
+    # Append-only: one JSON line per visit in a file per UTC day. Lines are
+    # flushed as they are written; compaction never rewrites these files.
+
+    def __init__(self, root=VISIT_LOG_DIR):
+        self.root = root
+        self.appended = 0
+        self._lock = threading.Lock()
+        self._day = None
+        self._file = None
+        os.makedirs(os.path.join(root, 'events'), exist_ok=True)
+
+    def append(self, customer_id, camera, timestamp, emotion, distance=None):
+        if isinstance(timestamp, datetime.datetime):
+            if timestamp.tzinfo is None:
+                timestamp = timestamp.replace(tzinfo=datetime.timezone.utc)
+            timestamp = timestamp.timestamp()
+        line = json.dumps({
+            'customer': customer_id,
+            'camera': camera,
+            'ts': timestamp,
+            'emotion': emotion,
+            'distance': None if distance is None else round(float(distance), 4),
+        }, separators=(',', ':')) + "\n"
+
+        day = utc_day(timestamp)
+        with self._lock:
+            if day != self._day:
+                if self._file is not None:
+                    self._file.close()
+                self._file = open(events_path(self.root, day), 'a',
+                                  encoding='utf-8')
+                self._day = day
+            self._file.write(line)
+            self._file.flush()
+            self.appended += 1
+
+    def close(self):
+        with self._lock:
+            if self._file is not None:
+                self._file.close()
+                self._file = None
+                self._day = None
+
+
+def read_events(path):
+    records = []
+    if not os.path.exists(path):
+        return records
+    with open(path, encoding='utf-8') as f:
+        for line in f:
+            try:
+                records.append(json.loads(line))
+            except ValueError:
+                # A line cut short by a crash mid-write.
+                continue
+    return records
+
+
+def to_columns(records):
+    customers, customer_codes = np.unique(
+        np.array([str(r.get('customer')) for r in records], dtype=str),
+        return_inverse=True)
+    cameras, camera_codes = np.unique(
+        np.array([str(r.get('camera') or '') for r in records], dtype=str),
+        return_inverse=True)
+    distance = [r.get('distance') for r in records]
+    return {
+        'customer': customer_codes.astype(np.int32),
+        'customers': customers,
+        'camera': camera_codes.astype(np.int16),
+        'cameras': cameras,
+        'ts': np.array([int(1000 * r.get('ts', 0)) for r in records],
+                       dtype=np.int64),
+        'emotion': np.array([EMOTION_CODES.get(r.get('emotion'), -1)
+                             for r in records], dtype=np.int8),
+        'distance': np.array([math.nan if d is None else d for d in distance],
+                             dtype=np.float32),
+    }
+
+
+def compact_day(root, day):
+    columns = to_columns(read_events(events_path(root, day)))
+    order = np.argsort(columns['ts'], kind='stable')
+    for name in COLUMNS:
+        columns[name] = columns[name][order]
+
+    path = partition_path(root, day)
+    os.makedirs(os.path.dirname(path), exist_ok=True)
+    tmp_path = path + '.tmp.npz'
+    np.savez(tmp_path, **columns)
+    os.replace(tmp_path, path)
+    return len(order)
+
+
+def is_compacted(root, day):
+    partition = partition_path(root, day)
+    events = events_path(root, day)
+    return os.path.exists(partition) and (
+        not os.path.exists(events) or
+        os.path.getmtime(partition) >= os.path.getmtime(events))
+
+
+def logged_days(root):
+    directory = os.path.join(root, 'events')
+    if not os.path.isdir(directory):
+        return []
+    days = []
+    for name in os.listdir(directory):
+        if name.endswith('.jsonl'):
+            try:
+                days.append(datetime.date.fromisoformat(name[:-len('.jsonl')]))
+            except ValueError:
+                continue
+    return sorted(days)
+
+
+def compact(root=VISIT_LOG_DIR, today=None, include_today=False):
+    # Today's file is still being appended to; it is compacted once the day
+    # is over (readers fall back to the log for it meanwhile).
+    today = today or datetime.datetime.now(datetime.timezone.utc).date()
+    compacted = {}
+    for day in logged_days(root):
+        if day >= today and not include_today:
+            continue
+        if not is_compacted(root, day):
+            compacted[day.isoformat()] = compact_day(root, day)
+    return compacted
+
+
+class Compactor:
+    def __init__(self, root=VISIT_LOG_DIR, interval=COMPACT_SECONDS):
+        self.root = root
+        self.interval = interval
+        self._stop_event = threading.Event()
+        self._thread = threading.Thread(
+            target=self._run, name='visit-log-compact', daemon=True)
+
+    def start(self):
+        self._thread.start()
+
+    def stop(self):
+        self._stop_event.set()
+
+    def _run(self):
+        # Runs at startup and then on every interval; days already
+        # compacted are skipped, so most runs do nothing.
+        while True:
+            try:
+                for day, count in compact(self.root).items():
+                    print(f"Visit log for {day} compacted: {count} events")
+            except Exception as e:
+                print(f"Visit log compaction failed: {e}")
+            if self._stop_event.wait(self.interval):
+                return
+
+
+def load_day(root, day):
+    if is_compacted(root, day):
+        with np.load(partition_path(root, day), allow_pickle=False) as data:
+            return {name: data[name] for name in data.files}
+    records = read_events(events_path(root, day))
+    return to_columns(records) if records else None
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(
+        description="Compact the visit event log into daily columnar partitions")
+    parser.add_argument('--root', default=VISIT_LOG_DIR)
+    parser.add_argument('--day', help="compact only this day (YYYY-MM-DD)")
+    parser.add_argument('--include-today', action='store_true')
+    args = parser.parse_args()
+
+    if args.day:
+        day = datetime.date.fromisoformat(args.day)
+        print(f"{args.day}: {compact_day(args.root, day)} events")
+    else:
+        for day, count in compact(args.root,
+                                  include_today=args.include_today).items():
+            print(f"{day}: {count} events")
@@ -0,0 +1,238 @@
+import collections
+import os
+import threading
+import time
+from google.api_core.exceptions import (FailedPrecondition, InvalidArgument,
+                                        NotFound)
+from aggregates import counted_emotion
+from visit_log import local_day
+
+
+BATCH_SIZE = int(os.getenv('VISIT_BATCH_SIZE', '100'))
+FLUSH_SECONDS = float(os.getenv('VISIT_FLUSH_SECONDS', '2'))
+MAX_BATCH_WRITES = 500
+MAX_ATTEMPTS = 10
+MAX_BACKOFF_SECONDS = 60
+# Errors caused by one document (e.g. deleted since it was looked up) rather
+# than by Firestore being unavailable; retrying them never succeeds.
+PERMANENT_ERRORS = (NotFound, InvalidArgument, FailedPrecondition)
+
+
+class PendingVisit:
+    def __init__(self, ref, fields, previous_emotion=None):
+        self.ref = ref
+        self.fields = fields
+        self.previous_emotion = previous_emotion
+        self.visits = collections.Counter(
+            [local_day(fields['last_visit']).isoformat()])
+        self.attempts = 0
+
+    def merge(self, fields):
+        self.visits[local_day(fields['last_visit']).isoformat()] += 1
+        self.merge_fields(fields)
+
+    def absorb(self, older):
+        # A retried entry is folded into a newer one for the same customer;
+        # its visits still need counting and its emotion is the earlier one.
+        self.visits.update(older.visits)
+        self.previous_emotion = older.previous_emotion
+        self.merge_fields(older.fields)
+
+    def merge_fields(self, fields):
+        # The newest visit wins; an older retried write never overwrites it.
+        if fields['last_visit'] >= self.fields['last_visit']:
+            self.fields = fields
+
+
+class VisitRecorder:
+    def __init__(self, db, batch_size=BATCH_SIZE, flush_seconds=FLUSH_SECONDS,
+                 aggregates=None):
+        self.db = db
+        self.aggregates = aggregates
+        self.batch_size = min(batch_size, MAX_BATCH_WRITES)
+        self.flush_seconds = flush_seconds
+        self.counters = {'recorded': 0, 'coalesced': 0, 'committed': 0,
+                         'batches': 0, 'failed_batches': 0, 'dropped': 0,
+                         'rejected': 0}
+        self.last_error = None
+        self.next_retry_at = 0.0
+        self.consecutive_failures = 0
+
+        self._pending = {}
+        # Emotion this recorder last wrote per customer. It is what the
+        # document holds now, even when a later visit read it before the
+        # write landed.
+        self._written_emotion = {}
+        self._lock = threading.Lock()
+        self._wake = threading.Event()
+        self._stop_event = threading.Event()
+        self._thread = None
+
+    def start(self):
+        with self._lock:
+            if self._thread is not None:
+                return
+            self._thread = threading.Thread(
+                target=self._run, name='visit-recorder', daemon=True)
+        self._thread.start()
+
+    def record(self, ref, last_visit, emotion, previous_emotion=None):
+        fields = {'last_visit': last_visit, 'last_emotion': emotion}
+        with self._lock:
+            pending = self._pending.get(ref.path)
+            if pending is None:
+                self._pending[ref.path] = PendingVisit(
+                    ref, fields, previous_emotion)
+            else:
+                pending.merge(fields)
+                self.counters['coalesced'] += 1
+            self.counters['recorded'] += 1
+            full = len(self._pending) >= self.batch_size
+        self.start()
+        if full:
+            self._wake.set()
+
+    def pending_count(self):
+        with self._lock:
+            return len(self._pending)
+
+    def stop(self, timeout=10):
+        self._stop_event.set()
+        self._wake.set()
+        if self._thread is not None:
+            self._thread.join(timeout)
+        # Last chance to write what is still buffered.
+        self.next_retry_at = 0.0
+        self.flush()
+
+    def _run(self):
+        while not self._stop_event.is_set():
+            self._wake.wait(self.flush_seconds)
+            self._wake.clear()
+            self.flush()
+
+    def flush(self):
+        while True:
+            if time.monotonic() < self.next_retry_at:
+                return
+            with self._lock:
+                if not self._pending:
+                    return
+                paths = list(self._pending)[:self.batch_size]
+                entries = [self._pending.pop(path) for path in paths]
+
+            try:
+                self._commit(entries)
+            except PERMANENT_ERRORS as e:
+                # One bad document fails the whole atomic batch; split it
+                # until the bad ones are isolated and write the rest.
+                failed, error = self._commit_isolating(entries, e)
+                if failed:
+                    self._requeue(failed, error)
+                    return
+            except Exception as e:
+                self._requeue(entries, e)
+                return
+            else:
+                self.counters['committed'] += len(entries)
+                self.counters['batches'] += 1
+
+            self.consecutive_failures = 0
+            self.last_error = None
+
+            with self._lock:
+                if len(self._pending) < self.batch_size:
+                    return
+
+    def _commit(self, entries):
+        batch = self.db.batch()
+        for entry in entries:
+            batch.update(entry.ref, entry.fields)
+        if self.aggregates is not None:
+            # Counters ride in the same batch, so they only move when
+            # the visits they count are written.
+            self._add_aggregates(batch, entries)
+        batch.commit()
+        with self._lock:
+            for entry in entries:
+                self._written_emotion[entry.ref.path] = \
+                    entry.fields['last_emotion']
+
+    def _commit_isolating(self, entries, error):
+        # Returns the entries that failed for a transient reason (to be
+        # retried) and that error; permanently failing ones are dropped.
+        if len(entries) == 1:
+            if isinstance(error, PERMANENT_ERRORS):
+                self.counters['rejected'] += 1
+                print(f"Dropping visit update for {entries[0].ref.path}: "
+                      f"{error}")
+                return [], None
+            return entries, error
+
+        failed = []
+        last_error = None
+        middle = len(entries) // 2
+        for half in (entries[:middle], entries[middle:]):
+            try:
+                self._commit(half)
+            except PERMANENT_ERRORS as e:
+                half_failed, half_error = self._commit_isolating(half, e)
+                failed.extend(half_failed)
+                last_error = half_error or last_error
+            except Exception as e:
+                # Firestore being unavailable is not this half's fault;
+                # splitting it further would only multiply the attempts.
+                failed.extend(half)
+                last_error = e
+            else:
+                self.counters['committed'] += len(half)
+                self.counters['batches'] += 1
+        return failed, last_error
+
+    def _add_aggregates(self, batch, entries):
+        visits = collections.Counter()
+        emotion = collections.Counter()
+        for entry in entries:
+            visits.update(entry.visits)
+            # Only the coalesced first and last values count, whatever the
+            # visits in between saw.
+            with self._lock:
+                first = self._written_emotion.get(
+                    entry.ref.path, entry.previous_emotion)
+            first = counted_emotion(first)
+            last = counted_emotion(entry.fields['last_emotion'])
+            if first != last:
+                if last:
+                    emotion[last] += 1
+                if first:
+                    emotion[first] -= 1
+        self.aggregates.add(batch, emotion=emotion, visits=visits)
+
+    def _requeue(self, entries, error):
+        self.counters['failed_batches'] += 1
+        self.consecutive_failures += 1
+        self.last_error = str(error)
+        backoff = min(MAX_BACKOFF_SECONDS, 2 ** self.consecutive_failures)
+        self.next_retry_at = time.monotonic() + backoff
+        print(f"Visit batch of {len(entries)} failed, retrying in "
+              f"{backoff}s: {error}")
+
+        with self._lock:
+            for entry in entries:
+                entry.attempts += 1
+                if entry.attempts >= MAX_ATTEMPTS:
+                    self.counters['dropped'] += 1
+                    print(f"Dropping visit update for {entry.ref.path} "
+                          f"after {entry.attempts} attempts")
+                    continue
+                newer = self._pending.get(entry.ref.path)
+                if newer is None:
+                    self._pending[entry.ref.path] = entry
+                else:
+                    newer.absorb(entry)
+
+    def stats(self):
+        stats = dict(self.counters)
+        stats['pending'] = self.pending_count()
+        stats['last_error'] = self.last_error
+        return stats
@@ -0,0 +1,140 @@
+import collections
+import threading
+import time
+
+
+_MISSING = object()
+
+
+class TTLCache:
+    def __init__(self, ttl, maxsize=10000):
+        self.ttl = ttl
+        self.maxsize = maxsize
+        self._items = collections.OrderedDict()
+        self._lock = threading.Lock()
+
+    def _expire(self, now):
+        while self._items:
+            key, (expires_at, _) = next(iter(self._items.items()))
+            if expires_at > now:
+                break
+            del self._items[key]
+
+    def __setitem__(self, key, value):
+        now = time.monotonic()
+        with self._lock:
+            self._items.pop(key, None)
+            self._items[key] = (now + self.ttl, value)
+            self._expire(now)
+            while len(self._items) > self.maxsize:
+                self._items.popitem(last=False)
+
+    def get(self, key, default=None):
+        now = time.monotonic()
+        with self._lock:
+            item = self._items.get(key)
+            if item is None:
+                return default
+            if item[0] <= now:
+                del self._items[key]
+                return default
+            return item[1]
+
+    def pop(self, key, default=None):
+        with self._lock:
+            item = self._items.pop(key, None)
+        return default if item is None else item[1]
+
+    def __contains__(self, key):
+        return self.get(key, _MISSING) is not _MISSING
+
+    def add(self, key):
+        self[key] = True
+
+    def __len__(self):
+        with self._lock:
+            self._expire(time.monotonic())
+            return len(self._items)
+
+
+class VisitWorkerPool:
+    def __init__(self, handler, workers=4, max_queue=256):
+        self.handler = handler
+        self.workers = workers
+        self.max_queue = max_queue
+        self.counters = {'submitted': 0, 'merged': 0, 'dropped': 0,
+                         'processed': 0, 'failed': 0}
+
+        self._queue = collections.deque()
+        self._jobs = {}
+        self._in_flight = set()
+        self._cond = threading.Condition()
+        self._stopping = False
+        self._threads = []
+
+    def start(self):
+        with self._cond:
+            if self._threads:
+                return
+            self._threads = [threading.Thread(target=self._run,
+                                              name=f'visit-worker-{i}',
+                                              daemon=True)
+                             for i in range(self.workers)]
+        for thread in self._threads:
+            thread.start()
+
+    def submit(self, key, *args):
+        self.start()
+        with self._cond:
+            self.counters['submitted'] += 1
+            # A queued or running job for this customer absorbs the event;
+            # its latest arguments are used for the next run.
+            if key in self._jobs or key in self._in_flight:
+                self._jobs[key] = args
+                self.counters['merged'] += 1
+                return False
+            if len(self._queue) >= self.max_queue:
+                self.counters['dropped'] += 1
+                return False
+            self._jobs[key] = args
+            self._queue.append(key)
+            self._cond.notify()
+            return True
+
+    def _run(self):
+        while True:
+            with self._cond:
+                self._cond.wait_for(lambda: self._queue or self._stopping)
+                if not self._queue:
+                    return
+                key = self._queue.popleft()
+                args = self._jobs.pop(key)
+                self._in_flight.add(key)
+
+            try:
+                self.handler(*args)
+                outcome = 'processed'
+            except Exception as e:
+                outcome = 'failed'
+                print(f"Visit processing failed for {key}: {e}")
+
+            with self._cond:
+                self.counters[outcome] += 1
+                self._in_flight.discard(key)
+                if key in self._jobs:
+                    self._queue.append(key)
+                    self._cond.notify()
+
+    def stop(self, timeout=10):
+        with self._cond:
+            self._stopping = True
+            self._cond.notify_all()
+        for thread in self._threads:
+            thread.join(timeout)
+
+    def stats(self):
+        with self._cond:
+            stats = dict(self.counters)
+            stats['queued'] = len(self._queue)
+            stats['in_flight'] = len(self._in_flight)
+        return stats